@@ -0,0 +1,161 @@
+"""
+Метрики активности бота
+Общие счетчики (отправлено, вылуплено, заполнение multi egg) и кольцевые буферы
+по дням и часам фиксированного размера: счетчики обновляются обработчиками при
+каждом событии, ответ API не зависит от числа яиц и пользователей.
+Активные пользователи считаются без повторов за текущий день и час
+"""
+
+import logging
+import os
+import threading
+import time
+
+from serializers import dump_file, get_codec, load_file
+
+logger = logging.getLogger(__name__)
+
+TOTAL_FIELDS = ('eggs_sent', 'eggs_hatched', 'multi_eggs_sent', 'multi_slots', 'multi_hatches')
+
+# Поля ячейки кольцевого буфера
+SLOT_PERIOD, SLOT_SENT, SLOT_HATCHED, SLOT_ACTIVE = range(4)
+
+
+class _Ring:
+    """Последние size периодов (дней или часов): [номер периода, отправлено, вылуплено, активных]"""
+
+    def __init__(self, size, seconds):
+        self.size = max(1, size)
+        self.seconds = seconds
+        self.slots = [None] * self.size
+        self.period = None  # Текущий период
+        self.active = set()  # user_id, активные в текущем периоде
+
+    def record(self, now, field, user_id):
+        """Засчитывает событие в ячейку периода now (новый период сбрасывает активных)"""
+        period = int(now // self.seconds)
+        if self.period is None or period > self.period:
+            self.period = period
+            self.active = set()
+        slot = self.slots[period % self.size]
+        if slot is None or slot[SLOT_PERIOD] != period:
+            if slot is not None and slot[SLOT_PERIOD] > period:
+                return  # Событие старше буфера
+            slot = self.slots[period % self.size] = [period, 0, 0, 0]
+        slot[field] += 1
+        # Активные без повторов известны только для текущего периода
+        if period == self.period and user_id not in self.active:
+            self.active.add(user_id)
+            slot[SLOT_ACTIVE] += 1
+
+    def recent(self, count, now):
+        """Ячейки последних count периодов от текущего к старым (пустые - нули)"""
+        period = int(now // self.seconds)
+        result = []
+        for p in range(period, period - min(count, self.size), -1):
+            slot = self.slots[p % self.size]
+            if slot is None or slot[SLOT_PERIOD] != p:
+                slot = [p, 0, 0, 0]
+            result.append(slot)
+        return result
+
+    def to_dict(self):
+        return {
+            'slots': [list(slot) for slot in self.slots if slot is not None],
+            'period': self.period,
+            'active': list(self.active)
+        }
+
+    def load(self, data):
+        # По возрастанию периода: при меньшем буфере остаются самые новые
+        for slot in sorted(data.get('slots', ())):
+            self.slots[slot[SLOT_PERIOD] % self.size] = list(slot)
+        self.period = data.get('period')
+        self.active = set(data.get('active', ()))
+
+
+class ActivityMetrics:
+    """Счетчики активности: общие, по дням и по часам"""
+
+    def __init__(self, days=90, hours=48):
+        self.totals = dict.fromkeys(TOTAL_FIELDS, 0)
+        self.days = _Ring(days, 86400)
+        self.hours = _Ring(hours, 3600)
+        self._lock = threading.Lock()  # Обработчики бота пишут, поток API и поток сохранения читают
+
+    def record_sent(self, user_id, is_multi=False, max_hatches=1, now=None):
+        """Отправлено яйцо"""
+        now = time.time() if now is None else now
+        with self._lock:
+            self.totals['eggs_sent'] += 1
+            if is_multi:
+                self.totals['multi_eggs_sent'] += 1
+                self.totals['multi_slots'] += max_hatches
+            self.days.record(now, SLOT_SENT, user_id)
+            self.hours.record(now, SLOT_SENT, user_id)
+
+    def record_hatch(self, user_id, is_multi=False, now=None):
+        """Вылуплено яйцо (для multi egg - одно вылупление)"""
+        now = time.time() if now is None else now
+        with self._lock:
+            self.totals['eggs_hatched'] += 1
+            if is_multi:
+                self.totals['multi_hatches'] += 1
+            self.days.record(now, SLOT_HATCHED, user_id)
+            self.hours.record(now, SLOT_HATCHED, user_id)
+
+    def report(self, days=30, hours=24, now=None):
+        """Сводка для API: общие счетчики, заполнение multi egg, последние дни и часы"""
+        now = time.time() if now is None else now
+        with self._lock:
+            totals = dict(self.totals)
+            day_slots = [list(slot) for slot in self.days.recent(days, now)]
+            hour_slots = [list(slot) for slot in self.hours.recent(hours, now)]
+        multi_slots = totals['multi_slots']
+        totals['multi_fill_rate'] = round(totals['multi_hatches'] / multi_slots, 4) if multi_slots else 0.0
+        return {
+            'totals': totals,
+            'daily_active_users': day_slots[0][SLOT_ACTIVE] if day_slots else 0,
+            'days': [_slot_dict(slot, 86400, '%Y-%m-%d') for slot in day_slots],
+            'hours': [_slot_dict(slot, 3600, '%Y-%m-%dT%H:00') for slot in hour_slots]
+        }
+
+    # --- Сохранение вместе со снимком состояния ---
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'totals': dict(self.totals),
+                'days': self.days.to_dict(),
+                'hours': self.hours.to_dict()
+            }
+
+    def load(self, data):
+        with self._lock:
+            for name in TOTAL_FIELDS:
+                self.totals[name] = data.get('totals', {}).get(name, 0)
+            self.days.load(data.get('days', {}))
+            self.hours.load(data.get('hours', {}))
+
+    def save(self, path):
+        """Атомарно записывает метрики в файл"""
+        dump_file(path, self.to_dict(), get_codec('json'))
+
+    @classmethod
+    def from_file(cls, path, days=90, hours=48):
+        metrics = cls(days, hours)
+        if os.path.exists(path):
+            try:
+                metrics.load(load_file(path))
+            except Exception as e:
+                logger.error(f"Failed to load activity metrics from {path}: {e}")
+        return metrics
+
+
+def _slot_dict(slot, seconds, fmt):
+    return {
+        'period': time.strftime(fmt, time.gmtime(slot[SLOT_PERIOD] * seconds)),
+        'eggs_sent': slot[SLOT_SENT],
+        'eggs_hatched': slot[SLOT_HATCHED],
+        'active_users': slot[SLOT_ACTIVE]
+    }
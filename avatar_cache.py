@@ -0,0 +1,216 @@
+"""
+Дисковый кэш аватаров пользователей для Eggchain Explorer
+Файлы хранятся по file_unique_id фото (новое фото - новый файл), общий размер
+ограничен: при превышении удаляются давно не запрошенные. Какое фото у
+пользователя сейчас, запоминается на время жизни записи; после него аватар
+отдается из кэша, а проверка нового фото идет в фоне. Отсутствие фото и ошибки
+запроса запоминаются на короткое время
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class AvatarCache:
+    """Аватары на диске с ограничением размера и ленивым обновлением"""
+
+    def __init__(self, directory, fetch_photo, download, max_bytes=100 * 1024 * 1024, refresh_ttl=86400, max_users=100000,
+                 negative_ttl=60):
+        # fetch_photo(user_id) -> (file_id, file_unique_id) или None, download(file_id) -> bytes - корутины
+        self.directory = directory
+        self._fetch_photo = fetch_photo
+        self._download = download
+        self.max_bytes = max_bytes
+        self.refresh_ttl = refresh_ttl
+        self.negative_ttl = negative_ttl  # Сколько помнить, что фото нет или запрос не удался
+        self.max_users = max(1, max_users)
+        self._users = OrderedDict()  # user_id -> (проверить после, file_id, file_unique_id), file_id None - фото нет
+        self._files = None  # file_unique_id -> размер, от давно запрошенных к недавним
+        self._size = 0
+        self._inflight = {}  # Ключ загрузки -> задача
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.downloads = 0
+        self.refreshes = 0
+        self.evictions = 0
+
+    def remember(self, user_id, file_id, file_unique_id):
+        """Запоминает текущее фото пользователя (например, из уже полученного профиля)"""
+        self._put(user_id, self.refresh_ttl, file_id, file_unique_id)
+
+    def _put(self, user_id, ttl, file_id, file_unique_id):
+        self._users[user_id] = (time.monotonic() + ttl, file_id, file_unique_id)
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+    def path(self, file_unique_id):
+        return os.path.join(self.directory, f"{file_unique_id}.jpg")
+
+    async def get(self, user_id):
+        """file_unique_id аватара, уже лежащего на диске (None - у пользователя нет фото)"""
+        entry = self._users.get(user_id)
+        if entry is not None and entry[1] is None:
+            if entry[0] > time.monotonic():
+                self.negative_hits += 1
+                self._users.move_to_end(user_id)
+                return None
+            entry = None  # Отдать нечего - проверяем заново, не в фоне
+        if entry is None:
+            self.misses += 1
+            if not await self._single_flight(('user', user_id), self._refresh(user_id)):
+                return None
+            entry = self._users.get(user_id)
+            if entry is None or entry[1] is None:
+                return None
+        elif entry[0] <= time.monotonic():
+            # Отдаем известное фото сразу, новое проверяем в фоне
+            self.refreshes += 1
+            self._users[user_id] = (time.monotonic() + self.refresh_ttl,) + entry[1:]
+            self._spawn(('user', user_id), self._refresh(user_id))
+        else:
+            self.hits += 1
+            self._users.move_to_end(user_id)
+
+        _, file_id, file_unique_id = entry
+        self._load_files()
+        if file_unique_id in self._files:
+            self._files.move_to_end(file_unique_id)
+            return file_unique_id
+        if await self._single_flight(('file', file_unique_id), self._store(file_id, file_unique_id)):
+            return file_unique_id
+        return None
+
+    async def read(self, user_id):
+        """(file_unique_id, содержимое файла) или None. Файл мог быть вытеснен между
+        проверкой кэша и чтением - тогда он скачивается заново (один раз)"""
+        for _ in range(2):
+            file_unique_id = await self.get(user_id)
+            if file_unique_id is None:
+                return None
+            try:
+                with open(self.path(file_unique_id), 'rb') as f:
+                    return file_unique_id, f.read()
+            except FileNotFoundError:
+                self._forget_file(file_unique_id)
+        return None
+
+    def _forget_file(self, file_unique_id):
+        size = self._files.pop(file_unique_id, None) if self._files is not None else None
+        if size is not None:
+            self._size -= size
+
+    async def _refresh(self, user_id):
+        """Узнает текущее фото пользователя у Telegram"""
+        try:
+            photo = await self._fetch_photo(user_id)
+        except Exception as e:
+            logger.debug(f"Avatar lookup failed for {user_id}: {e}")
+            entry = self._users.get(user_id)
+            if entry is not None and entry[1] is not None:
+                # Известное фото отдается дальше, повторим после refresh_ttl
+                return True
+            photo = None
+        if photo is None:
+            self._put(user_id, self.negative_ttl, None, None)
+            return False
+        self.remember(user_id, *photo)
+        return True
+
+    async def _store(self, file_id, file_unique_id):
+        """Скачивает фото и атомарно кладет его в кэш"""
+        try:
+            data = await self._download(file_id)
+        except Exception as e:
+            logger.warning(f"Avatar download failed for {file_unique_id}: {e}")
+            return False
+        self.downloads += 1
+        path = self.path(file_unique_id)
+        temp_file = path + '.tmp'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp_file, 'wb') as f:
+                f.write(data)
+            os.replace(temp_file, path)
+        except OSError as e:
+            logger.warning(f"Failed to write avatar {path}: {e}")
+            return False
+        self._size += len(data) - self._files.pop(file_unique_id, 0)
+        self._files[file_unique_id] = len(data)
+        self._evict(keep=file_unique_id)
+        return True
+
+    def _load_files(self):
+        """При первом обращении подхватывает файлы прошлых запусков (по времени изменения)"""
+        if self._files is not None:
+            return
+        self._files = OrderedDict()
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith('.jpg')]
+        except OSError:
+            return
+        found = []
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            found.append((stat.st_mtime, name[:-len('.jpg')], stat.st_size))
+        for _, file_unique_id, size in sorted(found):
+            self._files[file_unique_id] = size
+            self._size += size
+        self._evict()
+
+    def _evict(self, keep=None):
+        while self._size > self.max_bytes and self._files:
+            file_unique_id, size = next(iter(self._files.items()))
+            if file_unique_id == keep:
+                break
+            del self._files[file_unique_id]
+            self._size -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(file_unique_id))
+            except OSError:
+                pass
+
+    async def _single_flight(self, key, coro):
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._spawn(key, coro)
+        else:
+            coro.close()
+        # shield: отмена запроса клиента не прерывает общую загрузку
+        return await asyncio.shield(task)
+
+    def _spawn(self, key, coro):
+        task = self._inflight.get(key)
+        if task is not None:
+            coro.close()
+            return task
+        task = self._inflight[key] = asyncio.ensure_future(coro)
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return task
+
+    def stats(self):
+        """Счетчики кэша и занятое место"""
+        return {
+            'users': len(self._users),
+            'files': len(self._files or ()),
+            'bytes': self._size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'downloads': self.downloads,
+            'evictions': self.evictions,
+            'inflight': len(self._inflight)
+        }
@@ -0,0 +1,83 @@
+"""
+Сравнение форматов снимка: время записи/чтения и размер на синтетическом состоянии
+
+Запуск: python benchmarks/bench_codecs.py [кол-во яиц] [кол-во пользователей]
+По умолчанию 1 000 000 яиц и 100 000 пользователей
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from egg_store import EggStore  # noqa: E402
+from serializers import CODECS, orjson  # noqa: E402
+from user_store import TASK_FLAGS, UserStore  # noqa: E402
+
+
+def synthetic_state(egg_count, user_count):
+    """Состояние в формате снимка bot_data.json"""
+    eggs = EggStore()
+    base_ts = 1700000000
+    for i in range(egg_count):
+        sender_id = 100000000 + i % user_count
+        egg_key = f"{sender_id}_{i:08x}"
+        is_multi = i % 10 == 0
+        eggs.create(egg_key, is_multi=is_multi, max_hatches=50 if is_multi else 1, ts_sent=base_ts + i)
+        if i % 2 == 0:
+            for j in range(5 if is_multi else 1):
+                eggs.hatch(egg_key, 200000000 + (i + j) % user_count, base_ts + i + 60)
+
+    users = UserStore()
+    for u in range(user_count):
+        record = users.record(100000000 + u)
+        record.eggs_hatched = u % 400
+        record.hatched_by_others = u % 300
+        record.eggs_sent = u % 150
+        record.points = u * 3
+        record.referral_earnings = u % 50
+        record.referrer = 100000000 + u // 3 if u % 3 else None
+        record.tasks = TASK_FLAGS['send_100_eggs'] if u % 150 >= 100 else 0
+        record.daily_date = '2024-01-01'
+        record.daily_count = u % 10
+
+    eggs_detail, hatched_eggs, multi_eggs = eggs.export_legacy()
+    return {
+        'hatched_eggs': hatched_eggs,
+        'users': users.to_table(),
+        'ton_payments': {
+            100000000 + u: [{'date': '2024-01-01', 'amount': 0.1, 'tx_hash': f"tx{u}", 'eggs': 10}]
+            for u in range(0, user_count, 20)
+        },
+        'eggs_detail': eggs_detail,
+        'multi_eggs': multi_eggs,
+        'journal_seq': 0
+    }
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+
+def main():
+    egg_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    user_count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    print(f"building synthetic state: {egg_count} eggs, {user_count} users")
+    state = synthetic_state(egg_count, user_count)
+
+    print(f"{'codec':<8} {'encode':>9} {'decode':>9} {'size':>12}")
+    for name, codec in CODECS.items():
+        if name == 'orjson' and orjson is None:
+            print(f"{name:<8} (not installed)")
+            continue
+        raw, encode_time = timed(codec.encode, state)
+        _, decode_time = timed(codec.decode, raw)
+        print(f"{name:<8} {encode_time:8.2f}s {decode_time:8.2f}s {len(raw) / 1024 / 1024:10.1f}MB")
+        del raw
+
+
+if __name__ == '__main__':
+    main()
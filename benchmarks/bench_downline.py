@@ -0,0 +1,86 @@
+"""
+Рефералы по уровням: построение, начисление поинтов и новый реферер с
+обновлением предков против обхода дерева рефералов на каждый запрос
+
+Запуск: python benchmarks/bench_downline.py [кол-во пользователей ...]
+По умолчанию 100 000 и 1 000 000 пользователей, 3 уровня
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from user_store import UserStore  # noqa: E402
+
+LEVELS = 3
+OPERATIONS = 100000
+WALK_REPEATS = 1000
+BASE_ID = 100000000
+
+
+def build_store(user_count):
+    # Каждый пользователь, кроме первой тысячи, приведен одним из ранее пришедших
+    store = UserStore()
+    for i in range(user_count):
+        record = store.record(BASE_ID + i)
+        record.points = random.randrange(0, 1000)
+        if i >= 1000:
+            store.set_referrer(BASE_ID + i, BASE_ID + random.randrange(i))
+    return store
+
+
+def walk_downline(store, user_id):
+    """Прежний способ: обход дерева рефералов в ширину на LEVELS уровней"""
+    counts, points = [], []
+    level = [user_id]
+    for _ in range(LEVELS):
+        level = [referral for parent in level for referral in store.referrals(parent)]
+        counts.append(len(level))
+        points.append(sum(store.get(referral).points for referral in level))
+    return counts, points
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100000, 1000000]
+    print(f"{'users':>10} {'build':>9} {'add_points':>11} {'referrer':>9} {'read':>9} {'tree walk':>10}")
+    for user_count in sizes:
+        store = build_store(user_count)
+        user_ids = [BASE_ID + random.randrange(user_count) for _ in range(OPERATIONS)]
+
+        started = time.perf_counter()
+        store.build_downline(LEVELS)
+        build_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for user_id in user_ids:
+            store.add_points(user_id, 2)
+        update_time = (time.perf_counter() - started) / OPERATIONS
+
+        # Новые пользователи приходят по ссылкам существующих
+        started = time.perf_counter()
+        for i, referrer_id in enumerate(user_ids):
+            store.set_referrer(BASE_ID + user_count + i, referrer_id)
+        link_time = (time.perf_counter() - started) / OPERATIONS
+
+        started = time.perf_counter()
+        for user_id in user_ids:
+            store.downline(user_id)
+        read_time = (time.perf_counter() - started) / OPERATIONS
+
+        # Обход от пользователей первой тысячи - у них самые большие деревья
+        roots = [BASE_ID + random.randrange(1000) for _ in range(WALK_REPEATS)]
+        started = time.perf_counter()
+        for user_id in roots:
+            walk_downline(store, user_id)
+        walk_time = (time.perf_counter() - started) / WALK_REPEATS
+
+        print(f"{user_count:>10} {build_time:8.2f}s {update_time * 1e6:9.2f}us {link_time * 1e6:7.2f}us "
+              f"{read_time * 1e6:7.2f}us {walk_time * 1e3:8.2f}ms")
+        del store
+
+
+if __name__ == '__main__':
+    main()
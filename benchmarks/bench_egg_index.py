@@ -0,0 +1,58 @@
+"""
+Поиск яйца по короткому egg_id: индекс EggStore.find против прежнего перебора
+
+Запуск: python benchmarks/bench_egg_index.py [кол-во яиц ...]
+По умолчанию 10 000, 100 000, 1 000 000 и 10 000 000 яиц
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from egg_store import EggStore, split_egg_key  # noqa: E402
+
+LOOKUPS = 100000
+SCAN_LOOKUPS = 20
+
+
+def build_store(egg_count):
+    store = EggStore()
+    for i in range(egg_count):
+        store.create(f"{100000000 + i % 100000}_{i:016x}", ts_sent=1700000000 + i)
+    return store
+
+
+def scan(store, egg_id):
+    """Прежний поиск: перебор всех ключей"""
+    for egg_key in store:
+        if split_egg_key(egg_key)[1] == egg_id:
+            return egg_key
+    return None
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000, 10000000]
+    print(f"{'eggs':>10} {'index lookup':>14} {'scan lookup':>14}")
+    for egg_count in sizes:
+        store = build_store(egg_count)
+        egg_ids = [f"{random.randrange(egg_count):016x}" for _ in range(LOOKUPS)]
+
+        started = time.perf_counter()
+        for egg_id in egg_ids:
+            store.find(egg_id)
+        index_time = (time.perf_counter() - started) / LOOKUPS
+
+        started = time.perf_counter()
+        for egg_id in egg_ids[:SCAN_LOOKUPS]:
+            scan(store, egg_id)
+        scan_time = (time.perf_counter() - started) / SCAN_LOOKUPS
+
+        print(f"{egg_count:>10} {index_time * 1e6:>12.2f}us {scan_time * 1e3:>12.1f}ms")
+        del store
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Сравнение памяти: прежние словари eggs_detail / hatched_eggs / multi_eggs против EggStore
+EggStore считается целиком и отдельно - без индексов по egg_id, отправителю и
+вылупившему (у прежних словарей индексов не было, поиск шел перебором)
+
+Запуск: python benchmarks/bench_egg_store.py [кол-во яиц]
+"""
+
+import os
+import sys
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from egg_store import EggStore  # noqa: E402
+
+MULTI_EVERY = 10  # Каждое 10-е яйцо - multi egg
+HATCHERS_PER_MULTI = 5
+
+
+def synthetic_eggs(count):
+    """Генерирует (egg_key, sender_id, is_multi, hatchers) для count яиц"""
+    for i in range(count):
+        sender_id = 100000000 + i % 50000
+        is_multi = i % MULTI_EVERY == 0
+        hatchers = [200000000 + i + j for j in range(HATCHERS_PER_MULTI if is_multi else 1)] if i % 2 == 0 else []
+        yield f"{sender_id}_{i:08x}", sender_id, is_multi, hatchers
+
+
+def build_legacy(count):
+    eggs_detail = {}
+    hatched_eggs = set()
+    multi_eggs = {}
+    now = datetime.now().isoformat()
+    for egg_key, sender_id, is_multi, hatchers in synthetic_eggs(count):
+        eggs_detail[egg_key] = {
+            'sender_id': sender_id,
+            'egg_id': egg_key.split('_', 1)[1],
+            'hatched_by': None if is_multi or not hatchers else hatchers[0],
+            'timestamp_sent': datetime.now().isoformat(),
+            'timestamp_hatched': now if hatchers else None,
+            'is_multi': is_multi,
+            'max_hatches': 50 if is_multi else 1,
+            'hatched_count': len(hatchers),
+            'hatched_by_list': list(hatchers)
+        }
+        if is_multi:
+            multi_eggs[egg_key] = {'hatched_by_list': list(hatchers), 'hatched_count': len(hatchers)}
+        elif hatchers:
+            hatched_eggs.add(egg_key)
+    return eggs_detail, hatched_eggs, multi_eggs
+
+
+def build_store(count):
+    store = EggStore()
+    for i, (egg_key, sender_id, is_multi, hatchers) in enumerate(synthetic_eggs(count)):
+        store.create(egg_key, is_multi=is_multi, max_hatches=50 if is_multi else 1, ts_sent=1700000000 + i)
+        for user_id in hatchers:
+            store.hatch(egg_key, user_id, 1700000000 + i)
+    return store
+
+
+def measure(build, count):
+    # Ключи яиц есть в обоих вариантах, поэтому считаются в обоих замерах
+    tracemalloc.start()
+    result = build(count)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current
+
+
+def measure_store(count):
+    """(весь EggStore, из них индексы)"""
+    tracemalloc.start()
+    store = build_store(count)
+    total, _ = tracemalloc.get_traced_memory()
+    store._by_egg_id = {}
+    store._by_sender = {}
+    store._by_hatcher = {}
+    records, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del store
+    return total, total - records
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    legacy = measure(build_legacy, count)
+    store, indexes = measure_store(count)
+    records = store - indexes
+    print(f"eggs: {count}")
+    print(f"legacy dicts:       {legacy / count:8.1f} bytes/egg ({legacy / 1024 / 1024:.1f} MB)")
+    print(f"EggStore records:   {records / count:8.1f} bytes/egg ({records / 1024 / 1024:.1f} MB)")
+    print(f"EggStore indexes:   {indexes / count:8.1f} bytes/egg ({indexes / 1024 / 1024:.1f} MB)")
+    print(f"EggStore total:     {store / count:8.1f} bytes/egg ({store / 1024 / 1024:.1f} MB)")
+    print(f"ratio (records):    {legacy / records:8.2f}x")
+    print(f"ratio (total):      {legacy / store:8.2f}x")
+
+
+if __name__ == '__main__':
+    main()
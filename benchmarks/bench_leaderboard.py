@@ -0,0 +1,67 @@
+"""
+Таблица лидеров: построение, начисление поинтов, место в рейтинге и страница
+против сортировки всех пользователей на каждый запрос
+
+Запуск: python benchmarks/bench_leaderboard.py [кол-во пользователей ...]
+По умолчанию 100 000 и 1 000 000 пользователей
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from user_store import UserStore  # noqa: E402
+
+OPERATIONS = 100000
+SORT_REPEATS = 3
+
+
+def build_store(user_count):
+    store = UserStore()
+    for i in range(user_count):
+        store.record(100000000 + i).points = random.randrange(0, 100000)
+    return store
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100000, 1000000]
+    print(f"{'users':>10} {'build':>9} {'add_points':>11} {'rank':>9} {'page':>9} {'full sort':>10}")
+    for user_count in sizes:
+        store = build_store(user_count)
+        user_ids = [100000000 + random.randrange(user_count) for _ in range(OPERATIONS)]
+
+        started = time.perf_counter()
+        store.build_leaderboard()
+        build_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for user_id in user_ids:
+            store.add_points(user_id, 2)
+        update_time = (time.perf_counter() - started) / OPERATIONS
+
+        started = time.perf_counter()
+        for user_id in user_ids:
+            store.points_rank(user_id)
+        rank_time = (time.perf_counter() - started) / OPERATIONS
+
+        started = time.perf_counter()
+        for user_id in user_ids[:10000]:
+            store.leaderboard(100, user_id % user_count)
+        page_time = (time.perf_counter() - started) / 10000
+
+        # Прежний способ: сортировка всех пользователей на каждый запрос
+        started = time.perf_counter()
+        for _ in range(SORT_REPEATS):
+            sorted(((record.points, user_id) for user_id, record in store.items()), reverse=True)[:100]
+        sort_time = (time.perf_counter() - started) / SORT_REPEATS
+
+        print(f"{user_count:>10} {build_time:8.2f}s {update_time * 1e6:9.2f}us {rank_time * 1e6:7.2f}us "
+              f"{page_time * 1e6:7.2f}us {sort_time * 1e3:8.0f}ms")
+        del store
+
+
+if __name__ == '__main__':
+    main()
@@ -8,16 +8,29 @@ from telegram import (
     Update,
     WebAppInfo
 )
-from telegram.ext import Application, CommandHandler, InlineQueryHandler, CallbackQueryHandler, ContextTypes, ChatMemberHandler, MessageHandler, filters
+from telegram.ext import Application, CommandHandler, InlineQueryHandler, ChosenInlineResultHandler, CallbackQueryHandler, ContextTypes, ChatMemberHandler, MessageHandler, filters
 from telegram.constants import ChatMemberStatus
 from telegram.constants import ParseMode
 import uuid
+import re
 from aiohttp import web
 import json
 import os
-from datetime import datetime, date
+import atexit
+import itertools
+import threading
+import time
+from collections import deque
+from datetime import date
 import aiohttp
-from eggchain_api import setup_eggchain_routes, set_bot_instance
+from eggchain_api import setup_eggchain_routes, set_bot_instance, set_egg_archive, set_egg_store, set_user_store, set_data_versions, cached_response, cache_and_respond
+from http_cache import DataVersions
+from activity import ActivityMetrics
+from persistence import PhaseTimer, WriteBehindSaver
+from retention import EggArchive, classify_egg, KEEP
+from storage import open_storage, default_state
+from egg_store import EggStore
+from user_store import UserStore, EMPTY_USER, flags_to_tasks
 
 # Настройка логирования
 # Создаем форматтер
@@ -67,243 +80,286 @@ TON_WALLET = "UQCHdlQ2TLpa6Kpu5Pu8HeJd1xe3EL1Kx2wFekeuOnSpFcP0"  # TON коше
 MINI_APP_URL = "https://hatchapp-xi.vercel.app"  # URL mini app
 REFERRAL_PERCENTAGE = 0.25  # 25% от поинтов реферала
 
-# Функция для загрузки данных из файла
-def load_data():
-    """Загружает данные из файла"""
-    logger.info(f"Loading data from: {DATA_FILE}")
-    logger.info(f"Current working directory: {os.getcwd()}")
-    logger.info(f"File exists: {os.path.exists(DATA_FILE)}")
-    if os.path.exists(DATA_FILE):
-        file_size = os.path.getsize(DATA_FILE)
-        logger.info(f"Data file size: {file_size} bytes")
-    if os.path.exists(DATA_FILE):
-        file_size = os.path.getsize(DATA_FILE)
-        logger.info(f"Data file size: {file_size} bytes")
-    
-    if os.path.exists(DATA_FILE):
-        try:
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                
-                # Логируем загруженные данные для отладки
-                egg_points_count = len(data.get('egg_points', {}))
-                referrers_count = len(data.get('referrers', {}))
-                logger.info(f"Loaded data: {egg_points_count} users with points, {referrers_count} referrers")
-                
-                # Конвертируем ключи словарей в int (JSON сохраняет ключи как строки)
-                referrers_raw = data.get('referrers', {})
-                referrers_converted = {}
-                for key, value in referrers_raw.items():
-                    try:
-                        referrers_converted[int(key)] = int(value)
-                    except (ValueError, TypeError):
-                        logger.warning(f"Invalid referrer entry: {key} -> {value}, skipping")
-                
-                egg_points_raw = data.get('egg_points', {})
-                egg_points_converted = {}
-                for key, value in egg_points_raw.items():
-                    try:
-                        egg_points_converted[int(key)] = int(value)
-                    except (ValueError, TypeError):
-                        logger.warning(f"Invalid egg_points entry: {key} -> {value}, skipping")
-                
-                eggs_hatched_by_user_raw = data.get('eggs_hatched_by_user', {})
-                eggs_hatched_by_user_converted = {}
-                for key, value in eggs_hatched_by_user_raw.items():
-                    try:
-                        eggs_hatched_by_user_converted[int(key)] = int(value)
-                    except (ValueError, TypeError):
-                        logger.warning(f"Invalid eggs_hatched_by_user entry: {key} -> {value}, skipping")
-                
-                user_eggs_hatched_by_others_raw = data.get('user_eggs_hatched_by_others', {})
-                user_eggs_hatched_by_others_converted = {}
-                for key, value in user_eggs_hatched_by_others_raw.items():
-                    try:
-                        user_eggs_hatched_by_others_converted[int(key)] = int(value)
-                    except (ValueError, TypeError):
-                        logger.warning(f"Invalid user_eggs_hatched_by_others entry: {key} -> {value}, skipping")
-                
-                eggs_sent_by_user_raw = data.get('eggs_sent_by_user', {})
-                eggs_sent_by_user_converted = {}
-                for key, value in eggs_sent_by_user_raw.items():
-                    try:
-                        eggs_sent_by_user_converted[int(key)] = int(value)
-                    except (ValueError, TypeError):
-                        logger.warning(f"Invalid eggs_sent_by_user entry: {key} -> {value}, skipping")
-                
-                referral_earnings_raw = data.get('referral_earnings', {})
-                referral_earnings_converted = {}
-                for key, value in referral_earnings_raw.items():
-                    try:
-                        referral_earnings_converted[int(key)] = int(value)
-                    except (ValueError, TypeError):
-                        logger.warning(f"Invalid referral_earnings entry: {key} -> {value}, skipping")
-                
-                return {
-                    'hatched_eggs': set(data.get('hatched_eggs', [])),
-                    'eggs_hatched_by_user': eggs_hatched_by_user_converted,
-                    'user_eggs_hatched_by_others': user_eggs_hatched_by_others_converted,
-                    'eggs_sent_by_user': eggs_sent_by_user_converted,
-                    'daily_eggs_sent': data.get('daily_eggs_sent', {}),  # {user_id: {'date': '2024-01-01', 'count': 5}}
-                    'egg_points': egg_points_converted,
-                    'completed_tasks': data.get('completed_tasks', {}),
-                    'referrers': referrers_converted,  # {user_id: referrer_id} - кто привел пользователя
-                    'referral_earnings': referral_earnings_converted,  # {referrer_id: total_earned} - сколько заработал рефовод
-                    'ton_payments': data.get('ton_payments', {}),  # {user_id: [{'date': '2024-01-01', 'amount': 0.1, 'tx_hash': '...'}]}
-                    'eggs_detail': data.get('eggs_detail', {}),  # {egg_key: {sender_id, egg_id, hatched_by, timestamp_sent, timestamp_hatched, is_multi, max_hatches, hatched_count, hatched_by_list}}
-                    'multi_eggs': data.get('multi_eggs', {})  # {egg_key: {hatched_by_list: [user_id1, user_id2, ...], hatched_count: int}}
-                }
-        except Exception as e:
-            logger.error(f"Error loading data from {DATA_FILE}: {e}", exc_info=True)
-            return get_default_data()
-    else:
-        logger.warning(f"Data file {DATA_FILE} does not exist, using default data")
-    return get_default_data()
+# Таблица лидеров /api/leaderboard
+LEADERBOARD_PAGE_SIZE = int(os.environ.get('LEADERBOARD_PAGE_SIZE', 100))
+LEADERBOARD_MAX_PAGE_SIZE = int(os.environ.get('LEADERBOARD_MAX_PAGE_SIZE', 1000))
+
+# Уровней рефералов в /api/stats (рефералы рефералов и т.д.)
+DOWNLINE_LEVELS = int(os.environ.get('DOWNLINE_LEVELS', 3))
+
+# Статистика многих пользователей POST /api/stats/batch
+STATS_BATCH_MAX = int(os.environ.get('STATS_BATCH_MAX', 5000))  # Максимум user_ids в одном запросе
+STATS_BATCH_CHUNK = int(os.environ.get('STATS_BATCH_CHUNK', 500))  # Пользователей в одной части ответа
+
+# Фоновое сохранение данных
+SAVE_FLUSH_INTERVAL = float(os.environ.get('SAVE_FLUSH_INTERVAL', 2))  # Пауза в изменениях перед записью (сек)
+SAVE_MAX_STALENESS = float(os.environ.get('SAVE_MAX_STALENESS', 10))  # Максимальное время несохраненных изменений (сек)
 
-# Функция для получения данных по умолчанию
-def get_default_data():
-    """Возвращает данные по умолчанию"""
+# Журнал изменений и его компактизация в снимок DATA_FILE
+# Снимок переписывает все данные, поэтому пишется в основном по размеру журнала,
+# а по времени - редко, только чтобы журнал не рос годами при малой нагрузке
+JOURNAL_MAX_BYTES = int(os.environ.get('JOURNAL_MAX_BYTES', 8 * 1024 * 1024))  # Размер журнала, после которого пишется снимок
+SNAPSHOT_INTERVAL = float(os.environ.get('SNAPSHOT_INTERVAL', 6 * 3600))  # Максимальный возраст снимка при изменениях (сек)
+# Формат снимка: json (компактный), orjson (если установлен) или binary
+SNAPSHOT_FORMAT = os.environ.get('SNAPSHOT_FORMAT', 'json').lower()
+# Бинарный снимок при штатной остановке - следующий запуск читает его вместо JSON
+WARM_SNAPSHOT = os.environ.get('WARM_SNAPSHOT', '1') != '0'
+
+# Хранилище данных: json (снимок + журнал), sharded (снимок по шардам + журнал) или sqlite
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'json').lower()
+SQLITE_FILE = os.path.join(os.getcwd(), os.environ.get('SQLITE_FILE', 'bot_data.db'))
+SHARD_DIR = os.path.join(os.getcwd(), os.environ.get('SHARD_DIR', 'bot_data_shards'))
+SHARD_BUCKETS = int(os.environ.get('SHARD_BUCKETS', 16))  # На сколько групп по user_id делится каждая коллекция
+
+# Хранение старых яиц: невылупленные удаляются через TTL, давно вылупленные уходят в архив
+EGG_PENDING_TTL_DAYS = float(os.environ.get('EGG_PENDING_TTL_DAYS', 7))  # 0 - не удалять
+EGG_ARCHIVE_AFTER_DAYS = float(os.environ.get('EGG_ARCHIVE_AFTER_DAYS', 30))  # 0 - не архивировать
+RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL', 3600))  # Как часто запускается очистка (сек)
+ARCHIVE_DIR = os.path.join(os.getcwd(), os.environ.get('ARCHIVE_DIR', 'egg_archive'))
+
+# Метрики активности (/api/metrics/activity) - сохраняются фоновым сохранением и при остановке
+ACTIVITY_FILE = os.path.join(os.getcwd(), os.environ.get('ACTIVITY_FILE', 'activity.json'))
+ACTIVITY_SAVE_INTERVAL = float(os.environ.get('ACTIVITY_SAVE_INTERVAL', 60))  # Не чаще, чем раз в столько секунд
+ACTIVITY_DAYS = int(os.environ.get('ACTIVITY_DAYS', 90))  # Сколько дней хранится по дням
+ACTIVITY_HOURS = int(os.environ.get('ACTIVITY_HOURS', 48))  # Сколько часов хранится по часам
+
+storage = open_storage(
+    STORAGE_BACKEND,
+    DATA_FILE,
+    SQLITE_FILE,
+    snapshot_interval=SNAPSHOT_INTERVAL,
+    journal_max_bytes=JOURNAL_MAX_BYTES,
+    warm_snapshot=WARM_SNAPSHOT,
+    snapshot_format=SNAPSHOT_FORMAT,
+    shard_dir=SHARD_DIR,
+    shard_buckets=SHARD_BUCKETS
+)
+
+# Функция для загрузки данных
+def load_data(timer=None):
+    """Загружает данные из выбранного хранилища"""
+    try:
+        return storage.load(timer)
+    except Exception as e:
+        logger.error(f"Error loading data from {storage.name} storage: {e}", exc_info=True)
+        return default_state()
+
+# Функция для снимка данных перед записью
+def snapshot_data():
+    """Копирует коллекции, чтобы поток сохранения не читал словари во время их изменения"""
+    # dict()/list() копируют за одну операцию под GIL, вложенные словари копируем отдельно
+    # Яйца пишутся в файл в прежнем формате eggs_detail / hatched_eggs / multi_eggs
+    eggs_detail, hatched_eggs, multi_eggs = egg_store.export_legacy()
     return {
-        'hatched_eggs': set(),
-        'eggs_hatched_by_user': {},
-        'user_eggs_hatched_by_others': {},
-        'eggs_sent_by_user': {},
-        'daily_eggs_sent': {},
-        'egg_points': {},
-        'completed_tasks': {},
-        'referrers': {},
-        'referral_earnings': {},
-        'ton_payments': {},
-        'eggs_detail': {},
-        'multi_eggs': {}
+        'hatched_eggs': hatched_eggs,
+        'users': user_store.to_table(),
+        'ton_payments': {k: [dict(p) for p in list(v)] for k, v in dict(ton_payments).items()},
+        'eggs_detail': eggs_detail,
+        'multi_eggs': multi_eggs
     }
 
-# Функция для сохранения данных в файл
-def save_data():
-    """Сохраняет данные в файл"""
-    try:
-        data = {
-            'hatched_eggs': list(hatched_eggs),
-            'eggs_hatched_by_user': eggs_hatched_by_user,
-            'user_eggs_hatched_by_others': user_eggs_hatched_by_others,
-            'eggs_sent_by_user': eggs_sent_by_user,
-            'daily_eggs_sent': daily_eggs_sent,
-            'egg_points': egg_points,
-            'completed_tasks': completed_tasks,
-            'referrers': referrers,
-            'referral_earnings': referral_earnings,
-            'ton_payments': ton_payments,
-            'eggs_detail': eggs_detail,
-            'multi_eggs': multi_eggs
-        }
-        
-        # Логируем что сохраняем
-        egg_points_count = len(egg_points)
-        referrers_count = len(referrers)
-        logger.info(f"Saving data to {DATA_FILE}: {egg_points_count} users with points, {referrers_count} referrers")
-        
-        # Сохраняем во временный файл сначала, потом переименовываем (атомарная операция)
-        temp_file = DATA_FILE + '.tmp'
-        with open(temp_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        
-        # Атомарно заменяем старый файл новым
-        if os.path.exists(DATA_FILE):
-            os.replace(temp_file, DATA_FILE)
+def _live_collections():
+    """Возвращает живые коллекции по имени"""
+    return {
+        'eggs': egg_store,
+        'users': user_store,
+        'ton_payments': ton_payments
+    }
+
+def _journal_value(collection, key):
+    """Текущее значение элемента коллекции для записи в журнал (None - элемента нет)"""
+    if isinstance(collection, EggStore):
+        return collection.to_dict(key)
+    if isinstance(collection, UserStore):
+        return collection.to_row(key)
+    if isinstance(collection, set):
+        return 1 if key in collection else None
+    value = collection.get(key)
+    if isinstance(value, dict):
+        return {k: list(v) if isinstance(v, list) else v for k, v in dict(value).items()}
+    if isinstance(value, list):
+        return [dict(v) if isinstance(v, dict) else v for v in list(value)]
+    return value
+
+# Мутации, ожидающие записи в хранилище: (seq, op, timestamp, [(collection, key), ...], [cleared collections])
+pending_mutations = deque()
+mutation_lock = threading.Lock()
+persist_lock = threading.Lock()
+persistence_closed = False
+activity_saved_at = 0.0  # time.monotonic() последнего сохранения метрик активности
+
+# Версии данных для ETag ответов API
+data_versions = DataVersions()
+
+def record_mutation(op, *keys, cleared=()):
+    """Регистрирует изменение: keys - затронутые пары (коллекция, ключ)"""
+    with mutation_lock:
+        pending_mutations.append((next(mutation_seq), op, int(time.time()), keys, tuple(cleared)))
+    data_versions.bump(keys, cleared)
+    saver.mark_dirty()
+
+def _write_records(records, force_snapshot):
+    """Пишет снимок или записи журнала для records (под persist_lock)"""
+    if storage.wants_snapshot(force_snapshot):
+        # Снимок уже содержит все изменения из records - журнал можно очистить
+        if storage.sharded:
+            # Переписываются только шарды, затронутые изменениями
+            for seq, op, ts, keys, cleared in records:
+                storage.mark_dirty(keys, cleared)
+            storage.write_shards(_live_collections(), snapshot_seq)
         else:
-            os.rename(temp_file, DATA_FILE)
+            storage.write_snapshot(snapshot_data(), snapshot_seq)
+    else:
+        collections = _live_collections()
+        entries = []
+        for seq, op, ts, keys, cleared in records:
+            entry = {'n': seq, 'op': op, 't': ts}
+            if cleared:
+                entry['c'] = list(cleared)
+            if keys:
+                entry['s'] = [[name, key, _journal_value(collections[name], key)] for name, key in keys]
+            entries.append(entry)
+        storage.write_entries(entries)
+
+def flush_mutations(force_snapshot=False):
+    """Передает накопленные мутации в хранилище (вызывается из потока сохранения)"""
+    global snapshot_seq
+    with persist_lock:
+        records = []
+        while pending_mutations:
+            records.append(pending_mutations.popleft())
+        previous_seq = snapshot_seq
+        if records:
+            snapshot_seq = max(snapshot_seq, records[-1][0])
         
-        # Проверяем, что файл действительно сохранился
-        if os.path.exists(DATA_FILE):
-            file_size = os.path.getsize(DATA_FILE)
-            logger.info(f"Data saved successfully to {DATA_FILE} (size: {file_size} bytes)")
-        else:
-            logger.error(f"CRITICAL: Data file {DATA_FILE} was not created after save!")
-            
+        try:
+            _write_records(records, force_snapshot)
+        except Exception:
+            # Запись не удалась - мутации возвращаются в начало очереди и уйдут следующим сбросом
+            with mutation_lock:
+                pending_mutations.extendleft(reversed(records))
+            snapshot_seq = previous_seq
+            raise
+    
+    # Метрики активности пишутся отдельно от данных: снимки редки, а у sqlite их нет
+    if time.monotonic() - activity_saved_at >= ACTIVITY_SAVE_INTERVAL:
+        save_activity()
+
+def save_activity():
+    """Записывает метрики активности (ошибка не мешает сохранению состояния)"""
+    global activity_saved_at
+    activity_saved_at = time.monotonic()
+    try:
+        activity.save(ACTIVITY_FILE)
     except Exception as e:
-        logger.error(f"Error saving data to {DATA_FILE}: {e}", exc_info=True)
-        # Пытаемся удалить временный файл если он остался
-        temp_file = DATA_FILE + '.tmp'
-        if os.path.exists(temp_file):
-            try:
-                os.remove(temp_file)
-            except:
-                pass
-
-# Загружаем данные при старте
-data = load_data()
-hatched_eggs = data['hatched_eggs']
-eggs_hatched_by_user = data['eggs_hatched_by_user']
-user_eggs_hatched_by_others = data['user_eggs_hatched_by_others']
-eggs_sent_by_user = data.get('eggs_sent_by_user', {})
-daily_eggs_sent = data.get('daily_eggs_sent', {})
-egg_points = data['egg_points']
-completed_tasks = data['completed_tasks']
-referrers = data.get('referrers', {})  # {user_id: referrer_id}
-referral_earnings = data.get('referral_earnings', {})  # {referrer_id: total_earned}
-ton_payments = data.get('ton_payments', {})  # {user_id: [{'date': '2024-01-01', 'amount': 0.1, 'tx_hash': '...'}]}
-eggs_detail = data.get('eggs_detail', {})  # {egg_key: {sender_id, egg_id, hatched_by, timestamp_sent, timestamp_hatched, is_multi, max_hatches, hatched_count, hatched_by_list}}
-multi_eggs = data.get('multi_eggs', {})  # {egg_key: {hatched_by_list: [user_id1, user_id2, ...], hatched_count: int}}
-
-# Логируем загруженные данные при старте
-logger.info(f"Bot started with data: {len(egg_points)} users with points, {len(referrers)} referrers, {len(eggs_detail)} eggs in detail")
-if len(egg_points) > 0:
-    sample_user = list(egg_points.keys())[0]
-    logger.info(f"Sample user {sample_user} has {egg_points[sample_user]} points")
-if len(referrers) > 0:
-    sample_ref = list(referrers.items())[0]
-    logger.info(f"Sample referral: user {sample_ref[0]} referred by {sample_ref[1]}")
+        logger.error(f"Failed to save activity metrics: {e}", exc_info=True)
+
+def shutdown_persistence():
+    """Останавливает фоновое сохранение и записывает финальный снимок"""
+    global persistence_closed
+    if persistence_closed:
+        return
+    persistence_closed = True
+    saver.close()
+    flush_mutations(force_snapshot=True)
+    save_activity()
+    try:
+        storage.write_warm_snapshot({
+            'eggs': egg_store.to_columns(),
+            'users': user_store.to_table(),
+            'ton_payments': dict(ton_payments)
+        }, snapshot_seq)
+    except Exception as e:
+        logger.error(f"Failed to write warm snapshot: {e}", exc_info=True)
+    storage.close()
+
+# Фоновое сохранение: обработчики только регистрируют мутации
+saver = WriteBehindSaver(
+    flush_mutations,
+    flush_interval=SAVE_FLUSH_INTERVAL,
+    max_staleness=SAVE_MAX_STALENESS
+)
+
+# Состояние бота - загружается в фазе запуска init_state()
+egg_store = None  # {egg_key: EggRecord} - все яйца, см. egg_store.py
+user_store = None  # {user_id: UserRecord} - счетчики, поинты, реферер, задания, см. user_store.py
+ton_payments = None  # {user_id: [{'date': '2024-01-01', 'amount': 0.1, 'tx_hash': '...'}]}
+snapshot_seq = 0  # Номер последней мутации, вошедшей в журнал или снимок
+mutation_seq = None
+egg_archive = None
+activity = ActivityMetrics(ACTIVITY_DAYS, ACTIVITY_HOURS)  # Счетчики активности, см. activity.py
+
+def init_state():
+    """Фаза запуска: загружает состояние и пишет в лог время каждого этапа"""
+    global egg_store, user_store, ton_payments, snapshot_seq, mutation_seq, egg_archive, activity
+    timer = PhaseTimer('Startup')
+    data = load_data(timer)
+    egg_store = data['eggs']
+    user_store = data['users']
+    ton_payments = data['ton_payments']
+    snapshot_seq = data['journal_seq']
+    mutation_seq = itertools.count(snapshot_seq + 1)
+    with timer.phase('archive'):
+        egg_archive = EggArchive(ARCHIVE_DIR)
+    with timer.phase('leaderboard'):
+        user_store.build_leaderboard()
+    with timer.phase('downline'):
+        user_store.build_downline(DOWNLINE_LEVELS)
+    with timer.phase('activity'):
+        activity = ActivityMetrics.from_file(ACTIVITY_FILE, ACTIVITY_DAYS, ACTIVITY_HOURS)
+    timer.report()
+    
+    # Логируем загруженные данные при старте
+    logger.info(f"Bot started with data: {len(user_store)} users, {len(egg_store)} eggs")
 
 # Функция для проверки и обновления ежедневного лимита
-def check_daily_limit(user_id):
-    """Проверяет, может ли пользователь отправить яйцо сегодня"""
+def _current_day(record):
+    """Если начался новый день, сбрасывает счетчик (оплаченные яйца сохраняются)"""
     today = date.today().isoformat()
-    user_data = daily_eggs_sent.get(user_id, {})
-
-    # Если это новый день или первый раз, сбрасываем счетчик (но сохраняем оплаченные яйца для нового дня)
-    if user_data.get('date') != today:
-        # Сохраняем paid_eggs при инициализации нового дня
-        old_paid_eggs = daily_eggs_sent.get(user_id, {}).get('paid_eggs', 0)
-        daily_eggs_sent[user_id] = {'date': today, 'count': 0, 'paid_eggs': old_paid_eggs}
-        user_data = daily_eggs_sent[user_id]
+    if record.daily_date != today:
+        record.daily_date = today
+        record.daily_count = 0
+        return False
+    return True
 
-    daily_count = user_data.get('count', 0)
-    paid_eggs = user_data.get('paid_eggs', 0)
-    total_limit = FREE_EGGS_PER_DAY + paid_eggs
+def check_daily_limit(user_id):
+    """Проверяет, может ли пользователь отправить яйцо сегодня"""
+    record = user_store.record(user_id)
+    _current_day(record)
+    total_limit = FREE_EGGS_PER_DAY + record.paid_eggs
 
     # Проверяем лимит
-    if daily_count < total_limit:
-        return (True, daily_count, total_limit)
+    if record.daily_count < total_limit:
+        return (True, record.daily_count, total_limit)
     else:
-        return (False, daily_count, total_limit)
+        return (False, record.daily_count, total_limit)
 
 def increment_daily_count(user_id):
     """Увеличивает счетчик отправленных яиц за сегодня"""
-    today = date.today().isoformat()
-
-    user_data = daily_eggs_sent.get(user_id, {})
-    if user_data.get('date') != today:
-        # Сохраняем paid_eggs при инициализации нового дня
-        old_paid_eggs = daily_eggs_sent.get(user_id, {}).get('paid_eggs', 0)
-        daily_eggs_sent[user_id] = {'date': today, 'count': 0, 'paid_eggs': old_paid_eggs}
-    else:
-        daily_eggs_sent[user_id]['count'] = user_data.get('count', 0) + 1
+    record = user_store.record(user_id)
+    if _current_day(record):
+        record.daily_count += 1
 
 def add_paid_eggs(user_id, amount):
     """Добавляет оплаченные яйца к лимиту пользователя"""
-    today = date.today().isoformat()
-    
-    user_data = daily_eggs_sent.get(user_id, {})
-    if user_data.get('date') != today:
-        old_paid_eggs = user_data.get('paid_eggs', 0)
-        daily_eggs_sent[user_id] = {'date': today, 'count': 0, 'paid_eggs': old_paid_eggs + amount}
-    else:
-        daily_eggs_sent[user_id]['paid_eggs'] = user_data.get('paid_eggs', 0) + amount
+    record = user_store.record(user_id)
+    _current_day(record)
+    record.paid_eggs += amount
+
+# Справочник username -> user_id для Eggchain Explorer
+def remember_username(user):
+    """Запоминает username автора обновления (переименования тоже отслеживаются)"""
+    if user is None or user.is_bot:
+        return
+    changed = user_store.set_username(user.id, user.username)
+    if changed:
+        record_mutation('username', *[('users', user_id) for user_id in changed])
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     user_id = update.message.from_user.id
+    remember_username(update.message.from_user)
     logger.info(f"=== START COMMAND RECEIVED === User ID: {user_id}, Args: {context.args}")
     
     # Обрабатываем параметр startapp из ссылки https://t.me/bot?startapp=referrer_id
@@ -316,38 +372,33 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Устанавливаем реферала только если:
             # 1. У пользователя еще нет реферала
             # 2. Реферал не является самим пользователем
-            if user_id not in referrers and referrer_id != user_id:
+            existing_referrer = user_store.get(user_id, EMPTY_USER).referrer
+            if existing_referrer is None and referrer_id != user_id:
                 # Убеждаемся, что оба ID - int
                 user_id_int = int(user_id)
                 referrer_id_int = int(referrer_id)
                 
-                referrers[user_id_int] = referrer_id_int
-                logger.info(f"User {user_id_int} became referral of {referrer_id_int} via startapp link (total referrers now: {len(referrers)})")
+                user_store.set_referrer(user_id_int, referrer_id_int)
+                logger.info(f"User {user_id_int} became referral of {referrer_id_int} via startapp link")
                 
                 # Подсчитываем количество рефералов для реферала, чтобы убедиться, что счетчик обновится
-                referrer_referrals_count = sum(1 for ref_user_id, ref_referrer_id in referrers.items() if int(ref_referrer_id) == referrer_id_int)
+                referrer_referrals_count = user_store.referral_count(referrer_id_int)
                 logger.info(f"Referrer {referrer_id_int} now has {referrer_referrals_count} referrals (verified in memory)")
                 
                 # Сохраняем данные
-                save_data()
-                
-                # Проверяем, что данные сохранились в памяти
-                logger.info(f"After save: referrers dict has {len(referrers)} entries")
-                logger.info(f"Verification: referrers.get({user_id_int}) = {referrers.get(user_id_int)}")
-                
-                # Проверяем подсчет еще раз после сохранения
-                referrer_referrals_count_after = sum(1 for ref_user_id, ref_referrer_id in referrers.items() if int(ref_referrer_id) == referrer_id_int)
-                logger.info(f"Referrer {referrer_id_int} referrals count after save: {referrer_referrals_count_after}")
-            elif user_id in referrers:
-                logger.info(f"User {user_id} already has referrer {referrers[user_id]}, ignoring startapp={referrer_id}")
+                record_mutation('referral_set', ('users', user_id_int))
+                data_versions.touch_users([referrer_id_int])  # Изменилось число рефералов
+            elif existing_referrer is not None:
+                logger.info(f"User {user_id} already has referrer {existing_referrer}, ignoring startapp={referrer_id}")
             else:
                 logger.info(f"User {user_id} tried to set themselves as referrer via startapp, ignoring")
         except ValueError:
             logger.warning(f"Invalid referrer_id in startapp parameter: {context.args[0]}")
     
     # Получаем статистику пользователя
-    hatched_count = eggs_hatched_by_user.get(user_id, 0)
-    my_eggs_hatched = user_eggs_hatched_by_others.get(user_id, 0)
+    user = user_store.get(user_id, EMPTY_USER)
+    hatched_count = user.eggs_hatched
+    my_eggs_hatched = user.hatched_by_others
     
     # Создаем кнопку для открытия mini app
     # В команде /start нет реферальной ссылки, так как пользователь сам открывает бота
@@ -376,17 +427,15 @@ async def reset_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     
     # Полностью обнуляем все счетчики
-    egg_points.clear()  # Все поинты
-    eggs_sent_by_user.clear()  # Счетчики отправленных яиц
-    daily_eggs_sent.clear()  # Ежедневные счетчики (сбрасывает бесплатные яйца)
-    eggs_hatched_by_user.clear()  # Сколько яиц вылупил каждый пользователь (hatched_by_me)
-    user_eggs_hatched_by_others.clear()  # Сколько яиц пользователя вылупили другие (my_eggs_hatched)
-    hatched_eggs.clear()  # Список всех вылупленных яиц
-    referral_earnings.clear()  # Реферальные заработки
-    completed_tasks.clear()  # Выполненные задания
-    
-    # Сохраняем изменения
-    save_data()
+    # Поинты, счетчики, ежедневные лимиты, реферальные заработки и задания (рефереры сохраняются)
+    user_store.reset_counters()
+    egg_store.clear()  # Все яйца (вылупленные и нет)
+    
+    # Сохраняем изменения (сброс по отдельным полям пользователей)
+    record_mutation('reset', cleared=(
+        'egg_points', 'eggs_sent_by_user', 'daily_eggs_sent', 'eggs_hatched_by_user',
+        'user_eggs_hatched_by_others', 'eggs', 'referral_earnings', 'completed_tasks'
+    ))
     
     logger.info(f"User {user_id} reset ALL counters and free eggs")
     
@@ -407,80 +456,35 @@ async def reset_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик inline запросов"""
-    query = update.inline_query.query.lower().strip()
-    
-    logger.info(f"Inline query received: '{query}' (original: '{update.inline_query.query}')")
-    
-    # Парсим запрос: "egg" или "egg N" где N от 2 до 1000
-    is_multi = False
-    max_hatches = 1
-    
+def parse_egg_query(query):
+    """Разбирает inline запрос: возвращает (is_multi, max_hatches) или None, если это не запрос яйца"""
     # Проверяем, содержит ли запрос "egg"
     if "egg" not in query:
-        logger.info(f"Query '{query}' doesn't contain 'egg', returning empty results")
-        await update.inline_query.answer([], cache_time=1)
-        return
+        return None
     
     # Пытаемся извлечь число после "egg"
     # Форматы: "egg", "egg 50", "egg50", "egg 350", и т.д.
-    import re
     egg_match = re.search(r'egg\s*(\d+)', query)
     if egg_match:
         hatch_count = int(egg_match.group(1))
         # Multi egg от 2 до 30 вылуплений
         if 2 <= hatch_count <= 30:
-            is_multi = True
-            max_hatches = hatch_count
-            logger.info(f"Multi egg requested with {max_hatches} hatches")
-        elif hatch_count == 1:
-            # Явно указано 1 - обычное яйцо
-            is_multi = False
-            max_hatches = 1
-        else:
+            return True, hatch_count
+        if hatch_count != 1:
             # Число вне диапазона - используем обычное яйцо
             logger.warning(f"Hatch count {hatch_count} is out of range (2-30), using regular egg")
-            is_multi = False
-            max_hatches = 1
-    else:
-        # Просто "egg" без числа - обычное яйцо
-        is_multi = False
-        max_hatches = 1
-    
-    # Получаем ID отправителя
-    sender_id = update.inline_query.from_user.id
-    
-    # Создаем уникальный ID для этого яйца
-    # Используем короткий формат: первые 16 символов UUID без дефисов
-    # Это достаточно для уникальности и помещается в лимит Telegram (64 байта)
-    egg_id = str(uuid.uuid4()).replace("-", "")[:16]
-    
-    # Сохраняем детальную информацию о яйце для Eggchain Explorer
-    egg_key = f"{sender_id}_{egg_id}"
-    eggs_detail[egg_key] = {
-        'sender_id': sender_id,
-        'egg_id': egg_id,
-        'hatched_by': None,
-        'timestamp_sent': datetime.now().isoformat(),
-        'timestamp_hatched': None,
-        'is_multi': is_multi,
-        'max_hatches': max_hatches,
-        'hatched_count': 0,
-        'hatched_by_list': []
-    }
-    
-    # Если это multi egg, инициализируем структуру для отслеживания вылуплений
+    # Просто "egg" без числа или явно указано 1 - обычное яйцо
+    return False, 1
+
+
+def build_egg_result(sender_id, egg_id, is_multi, max_hatches):
+    """Собирает inline результат для яйца - без изменения состояния бота"""
+    # Формат callback_data: hatch_{sender_id}|{egg_id} или multi_{sender_id}|{egg_id}|{max_hatches} для multi egg
+    # (нажатие может прийти раньше chosen_inline_result - размер multi egg берется из кнопки)
     if is_multi:
-        multi_eggs[egg_key] = {
-            'hatched_by_list': [],
-            'hatched_count': 0
-        }
-    
-    # Сохраняем информацию об отправителе яйца
-    # Формат callback_data: hatch_{sender_id}|{egg_id} или multi_{sender_id}|{egg_id} для multi egg
-    prefix = "multi" if is_multi else "hatch"
-    callback_data = f"{prefix}_{sender_id}|{egg_id}"
+        callback_data = f"multi_{sender_id}|{egg_id}|{max_hatches}"
+    else:
+        callback_data = f"hatch_{sender_id}|{egg_id}"
     
     # Проверяем длину callback_data (максимум 64 байта для Telegram)
     callback_data_bytes = len(callback_data.encode('utf-8'))
@@ -494,7 +498,6 @@ async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.warning(f"Callback data too long, shortened egg_id to {egg_id} (length: {len(egg_id)})")
         else:
             # Если даже с минимальным egg_id не помещается, используем только sender_id и timestamp
-            import time
             egg_id = str(int(time.time()))[-8:]  # Последние 8 цифр timestamp
             callback_data = f"hatch_{sender_id}|{egg_id}"
             logger.warning(f"Callback data still too long, using timestamp-based egg_id: {egg_id}")
@@ -505,67 +508,112 @@ async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton(button_text, callback_data=callback_data)]
     ])
     
-    # Безлимитный режим - всегда разрешаем отправку яиц
-    # Проверяем ежедневный лимит только для статистики (не блокируем)
-    can_send_free, daily_count, total_limit = check_daily_limit(sender_id)
-    
-    # Создаем результат с эмодзи яйца (безлимит)
     if is_multi:
         title = f"🥚 Send Multi Egg ({max_hatches}x)"
         description = f"Multi egg - up to {max_hatches} users can hatch it!"
     else:
         title = "🥚 Send Egg"
         description = "Click to send an egg to the chat"
-    results = [
-        InlineQueryResultArticle(
-            id=egg_id,
-            title=title,
-            description=description,
-            input_message_content=InputTextMessageContent(
-                message_text="🥚",  # Всегда одно эмодзи яйца
-                parse_mode=ParseMode.HTML
-            ),
-            reply_markup=keyboard
-        )
-    ]
+    # id результата совпадает с egg_id - по нему яйцо регистрируется в chosen_inline_result
+    return InlineQueryResultArticle(
+        id=egg_id,
+        title=title,
+        description=description,
+        input_message_content=InputTextMessageContent(
+            message_text="🥚",  # Всегда одно эмодзи яйца
+            parse_mode=ParseMode.HTML
+        ),
+        reply_markup=keyboard
+    )
+
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик inline запросов - только показывает яйцо (сохраняется лишь username)"""
+    remember_username(update.inline_query.from_user)
+    query = update.inline_query.query.lower().strip()
+    
+    logger.info(f"Inline query received: '{query}' (original: '{update.inline_query.query}')")
+    
+    # Парсим запрос: "egg" или "egg N" где N от 2 до 30
+    parsed = parse_egg_query(query)
+    if parsed is None:
+        logger.info(f"Query '{query}' doesn't contain 'egg', returning empty results")
+        await update.inline_query.answer([], cache_time=1)
+        return
+    is_multi, max_hatches = parsed
+    
+    # Получаем ID отправителя
+    sender_id = update.inline_query.from_user.id
+    
+    # Создаем уникальный ID для этого яйца
+    # Используем короткий формат: первые 16 символов UUID без дефисов
+    # Это достаточно для уникальности и помещается в лимит Telegram (64 байта)
+    # Яйцо регистрируется только когда пользователь действительно отправит его (chosen_inline_result)
+    egg_id = str(uuid.uuid4()).replace("-", "")[:16]
+    
+    results = [build_egg_result(sender_id, egg_id, is_multi, max_hatches)]
     
     await update.inline_query.answer(results, cache_time=1)
-    logger.info(f"Results sent: {len(results)} result(s), callback_data length: {len(callback_data.encode('utf-8'))}, can_send: {can_send_free}, daily_count: {daily_count}, total_limit: {total_limit}")
+    logger.info(f"Results sent: {len(results)} result(s), is_multi: {is_multi}, max_hatches: {max_hatches}")
+
+
+async def chosen_inline_result(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик выбора inline результата - яйцо действительно отправлено в чат"""
+    chosen = update.chosen_inline_result
+    sender_id = chosen.from_user.id
+    remember_username(chosen.from_user)
+    egg_id = chosen.result_id
+    
+    parsed = parse_egg_query(chosen.query.lower().strip())
+    if parsed is None:
+        logger.warning(f"Chosen inline result {egg_id} for non-egg query '{chosen.query}', ignoring")
+        return
+    is_multi, max_hatches = parsed
+    
+    # Сохраняем детальную информацию о яйце для Eggchain Explorer
+    egg_key = f"{sender_id}_{egg_id}"
+    if egg_key in egg_store:
+        # Яйцо уже успели вылупить раньше, чем пришло обновление о выборе.
+        # Старая кнопка без размера в callback_data создала multi egg с размером по умолчанию
+        # (время отправки остается временем первого нажатия - более раннего момента бот не знает)
+        if is_multi and egg_store.set_max_hatches(egg_key, max_hatches):
+            logger.info(f"Egg {egg_key} capacity corrected to {max_hatches}")
+        logger.info(f"Egg {egg_key} already registered, counting send only")
+    else:
+        egg_store.create(egg_key, is_multi=is_multi, max_hatches=max_hatches, ts_sent=int(time.time()))
+    
+    # Увеличиваем общий счетчик отправленных яиц
+    sender = user_store.record(sender_id)
+    sender.eggs_sent += 1
+    activity.record_sent(sender_id, is_multi, max_hatches)
+    
+    # Увеличиваем ежедневный счетчик
+    increment_daily_count(sender_id)
+    
+    record_mutation('egg_sent', ('eggs', egg_key), ('users', sender_id))
+    logger.info(f"Egg {egg_key} sent by {sender_id} (is_multi: {is_multi}, max_hatches: {max_hatches}, total sent: {sender.eggs_sent})")
     
-    # Увеличиваем счетчики когда яйцо отправлено через inline query
-    # В Telegram inline query, яйцо считается отправленным когда пользователь выбирает его из результатов
-    if "egg" in query or query == "":
-        # Увеличиваем общий счетчик отправленных яиц
-        eggs_sent_by_user[sender_id] = eggs_sent_by_user.get(sender_id, 0) + 1
+    # Проверяем задание "Send 100 egg"
+    if sender.eggs_sent >= 100 and not sender.has_task('send_100_eggs'):
+        # Начисляем 500 Egg
+        user_store.add_points(sender_id, 500)
         
-        # Увеличиваем ежедневный счетчик
-        increment_daily_count(sender_id)
+        # Отмечаем задание как выполненное
+        sender.complete_task('send_100_eggs')
         
-        # Проверяем задание "Send 100 egg"
-        if eggs_sent_by_user[sender_id] >= 100 and not completed_tasks.get(sender_id, {}).get('send_100_eggs', False):
-            # Начисляем 500 Egg
-            egg_points[sender_id] = egg_points.get(sender_id, 0) + 500
-            
-            # Отмечаем задание как выполненное
-            if sender_id not in completed_tasks:
-                completed_tasks[sender_id] = {}
-            completed_tasks[sender_id]['send_100_eggs'] = True
-            
-            # Сохраняем данные
-            save_data()
-            
-            logger.info(f"User {sender_id} completed 'Send 100 egg' task, earned 500 Egg points")
-            
-            # Уведомляем пользователя
-            try:
-                await context.bot.send_message(
-                    chat_id=sender_id,
-                    text="🎉 Congratulations! You earned 500 Egg points for sending 100 eggs!"
-                )
-            except Exception as e:
-                logger.error(f"Failed to send notification to user {sender_id}: {e}")
+        # Сохраняем данные
+        record_mutation('task_completed', ('users', sender_id))
+        
+        logger.info(f"User {sender_id} completed 'Send 100 egg' task, earned 500 Egg points")
         
-        save_data()
+        # Уведомляем пользователя
+        try:
+            await context.bot.send_message(
+                chat_id=sender_id,
+                text="🎉 Congratulations! You earned 500 Egg points for sending 100 eggs!"
+            )
+        except Exception as e:
+            logger.error(f"Failed to send notification to user {sender_id}: {e}")
 
 
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -576,6 +624,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Получаем ID пользователя, который нажал на кнопку
     clicker_id = query.from_user.id
+    remember_username(query.from_user)
     
     # Извлекаем данные из callback_data
     # Формат: hatch_{sender_id}|{egg_id}
@@ -584,6 +633,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     sender_id = None
     egg_id = None
     is_multi = False
+    button_max_hatches = None  # Размер multi egg из кнопки (в старых кнопках его нет)
     
     # Проверяем формат callback_data: hatch_ или multi_
     if query.data.startswith("multi_"):
@@ -604,6 +654,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 sender_id = int(parts[0])
                 egg_id = parts[1]
+                if is_multi and len(parts) >= 3:
+                    button_max_hatches = int(parts[2])
                 logger.info(f"Parsed new format: sender_id={sender_id}, egg_id={egg_id}")
             except ValueError:
                 await query.answer("❌ Ошибка: неверный формат данных", show_alert=True)
@@ -638,21 +690,35 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Это предотвращает коллизии при укорачивании UUID
     egg_key = f"{sender_id}_{egg_id}"
     
-    # Получаем информацию о яйце из eggs_detail
-    egg_info = eggs_detail.get(egg_key, {})
-    if not egg_info:
-        # Если информации нет, определяем тип по префиксу callback_data
-        # Для multi используем значение из callback или дефолт 50
-        default_max = 50 if is_multi else 1
-        egg_info = {'is_multi': is_multi, 'max_hatches': default_max}
+    # Получаем информацию о яйце из хранилища
+    egg_record = egg_store.get(egg_key)
+    if egg_record is None and await asyncio.get_running_loop().run_in_executor(None, egg_archive.contains, egg_key):
+        # Невылупленное яйцо (или multi egg со свободными местами) возвращается из архива
+        # со своим размером и временем отправки, вылупленное повторно вылупить нельзя
+        archived_info = await asyncio.get_running_loop().run_in_executor(None, egg_archive.restore, egg_key)
+        egg_record = egg_store.get(egg_key)  # Яйцо мог уже вернуть параллельный клик
+        if egg_record is None:
+            if archived_info is None:
+                await query.answer("🐣 This egg has already hatched!", show_alert=True)
+                logger.info(f"Egg {egg_key} is archived, already hatched")
+                return
+            egg_record = egg_store.import_dict(egg_key, archived_info)
+            record_mutation('egg_restored', ('eggs', egg_key))
+            logger.info(f"Egg {egg_key} restored from archive")
     
     # Определяем, является ли яйцо multi egg и максимальное количество вылуплений
-    is_multi_egg = egg_info.get('is_multi', is_multi)
-    max_hatches = egg_info.get('max_hatches', 1)
+    if egg_record is not None:
+        is_multi_egg = egg_record.is_multi
+        max_hatches = egg_record.max_hatches
+    else:
+        # Если информации нет, определяем тип и размер по callback_data
+        # Для multi из старых кнопок без размера используем дефолт 50
+        is_multi_egg = is_multi
+        max_hatches = (button_max_hatches or 50) if is_multi else 1
     
-    # Если это multi egg, но max_hatches не установлен, используем значение из egg_info или дефолт
+    # Если это multi egg, но max_hatches не установлен, используем дефолт
     if is_multi_egg and max_hatches == 1:
-        max_hatches = egg_info.get('max_hatches', 50)  # Дефолт для старых multi eggs
+        max_hatches = 50  # Дефолт для старых multi eggs
     
     logger.info(f"Egg type check: is_multi={is_multi}, is_multi_egg={is_multi_egg}, max_hatches={max_hatches}, egg_key={egg_key}")
     
@@ -666,136 +732,86 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Для multi egg проверяем лимит и дубликаты
     if is_multi_egg:
         # Проверяем, не вылуплял ли уже этот пользователь это яйцо
-        multi_egg_data = multi_eggs.get(egg_key, {'hatched_by_list': [], 'hatched_count': 0})
-        if clicker_id in multi_egg_data['hatched_by_list']:
+        if clicker_id in egg_store.hatchers(egg_key):
             await query.answer("🐣 You have already hatched this multi egg!", show_alert=True)
             logger.info(f"User {clicker_id} already hatched multi egg {egg_key}")
             return
         
         # Проверяем лимит вылуплений
-        if multi_egg_data['hatched_count'] >= max_hatches:
+        if egg_record is not None and egg_record.hatched_count >= max_hatches:
             await query.answer(f"🐣 This multi egg has reached its limit of {max_hatches} hatches!", show_alert=True)
             logger.info(f"Multi egg {egg_key} reached limit of {max_hatches} hatches")
             return
-        
-        # Добавляем пользователя в список вылупивших
-        multi_egg_data['hatched_by_list'].append(clicker_id)
-        multi_egg_data['hatched_count'] += 1
-        multi_eggs[egg_key] = multi_egg_data
-        
-        # Обновляем eggs_detail
-        if egg_key not in eggs_detail:
-            eggs_detail[egg_key] = {
-                'sender_id': sender_id,
-                'egg_id': egg_id,
-                'hatched_by': None,  # Для multi egg храним список в multi_eggs
-                'timestamp_sent': datetime.now().isoformat(),
-                'timestamp_hatched': datetime.now().isoformat(),
-                'is_multi': True,
-                'max_hatches': max_hatches,
-                'hatched_count': multi_egg_data['hatched_count'],
-                'hatched_by_list': multi_egg_data['hatched_by_list'].copy()
-            }
-        else:
-            eggs_detail[egg_key]['hatched_count'] = multi_egg_data['hatched_count']
-            eggs_detail[egg_key]['hatched_by_list'] = multi_egg_data['hatched_by_list'].copy()
-            if eggs_detail[egg_key]['hatched_count'] == 1:
-                eggs_detail[egg_key]['timestamp_hatched'] = datetime.now().isoformat()
     else:
         # Обычное яйцо - проверяем, не было ли уже вылуплено
-        if egg_key in hatched_eggs:
+        if egg_store.is_hatched(egg_key):
             await query.answer("🐣 This egg has already hatched!", show_alert=True)
             logger.info(f"Egg {egg_key} already hatched")
             return
-        
-        # Помечаем яйцо как вылупленное
-        hatched_eggs.add(egg_key)
-        
-        # Обновляем детальную информацию о яйце для Eggchain Explorer
-        if egg_key not in eggs_detail:
-            eggs_detail[egg_key] = {
-                'sender_id': sender_id,
-                'egg_id': egg_id,
-                'hatched_by': clicker_id,
-                'timestamp_sent': datetime.now().isoformat(),
-                'timestamp_hatched': datetime.now().isoformat(),
-                'is_multi': False,
-                'max_hatches': 1,
-                'hatched_count': 1,
-                'hatched_by_list': [clicker_id]
-            }
-        else:
-            eggs_detail[egg_key]['hatched_by'] = clicker_id
-            eggs_detail[egg_key]['timestamp_hatched'] = datetime.now().isoformat()
-            eggs_detail[egg_key]['hatched_count'] = 1
-            eggs_detail[egg_key]['hatched_by_list'] = [clicker_id]
+    
+    # Отмечаем вылупление (яйцо без записи регистрируем задним числом)
+    now_ts = int(time.time())
+    if egg_record is None:
+        egg_store.create(egg_key, is_multi=is_multi_egg, max_hatches=max_hatches, ts_sent=now_ts)
+    egg_record = egg_store.hatch(egg_key, clicker_id, now_ts)
+    activity.record_hatch(clicker_id, is_multi_egg, now_ts)
+    
+    clicker = user_store.record(clicker_id)
+    sender = user_store.record(sender_id)
     
     # РЕФЕРАЛЬНАЯ СИСТЕМА: Если clicker_id еще не имеет реферала, устанавливаем sender_id как его реферала
     # Когда кто-то открывает яйцо, он становится рефералом того, кто отправил яйцо
-    if clicker_id not in referrers and sender_id != clicker_id:
-        # Убеждаемся, что оба ID - int
-        clicker_id_int = int(clicker_id)
-        sender_id_int = int(sender_id)
-        
-        referrers[clicker_id_int] = sender_id_int
-        logger.info(f"User {clicker_id_int} became referral of {sender_id_int} via egg hatching (total referrers now: {len(referrers)})")
-        
-        # Проверяем подсчет рефералов для отправителя
-        sender_referrals_count = sum(1 for ref_user_id, ref_referrer_id in referrers.items() if int(ref_referrer_id) == sender_id_int)
-        logger.info(f"Sender {sender_id_int} now has {sender_referrals_count} referrals")
+    if clicker.referrer is None and sender_id != clicker_id:
+        user_store.set_referrer(clicker_id, int(sender_id))
+        logger.info(f"User {clicker_id} became referral of {sender_id} via egg hatching")
     
     # Обновляем статистику
     # Увеличиваем счетчик для того, кто вылупил
-    eggs_hatched_by_user[clicker_id] = eggs_hatched_by_user.get(clicker_id, 0) + 1
+    clicker.eggs_hatched += 1
     # Увеличиваем счетчик для отправителя (его яйцо вылупили)
-    user_eggs_hatched_by_others[sender_id] = user_eggs_hatched_by_others.get(sender_id, 0) + 1
+    sender.hatched_by_others += 1
     
     # Начисляем поинты Egg
     # +1 очко тому, кто вылупил чужое яйцо
     clicker_points = 1
-    old_clicker_points = egg_points.get(clicker_id, 0)
-    egg_points[clicker_id] = old_clicker_points + clicker_points
-    logger.info(f"User {clicker_id} earned {clicker_points} points (total: {egg_points[clicker_id]})")
+    user_store.add_points(clicker_id, clicker_points)
+    logger.info(f"User {clicker_id} earned {clicker_points} points (total: {clicker.points})")
     
     # +2 очка отправителю, чье яйцо вылупили
     sender_points = 2
-    old_sender_points = egg_points.get(sender_id, 0)
-    egg_points[sender_id] = old_sender_points + sender_points
-    logger.info(f"User {sender_id} earned {sender_points} points (total: {egg_points[sender_id]})")
+    user_store.add_points(sender_id, sender_points)
+    logger.info(f"User {sender_id} earned {sender_points} points (total: {sender.points})")
     
     # РЕФЕРАЛЬНАЯ СИСТЕМА: Рефовод получает 25% от поинтов реферала
     # Когда реферал зарабатывает поинты, его рефовод получает 25% от этих поинтов
     
     # Проверяем, есть ли у clicker_id реферал (может быть установлен выше или уже был)
-    clicker_referrer = referrers.get(clicker_id)
+    clicker_referrer = clicker.referrer
     if clicker_referrer and clicker_referrer != clicker_id:
         # Реферал clicker_id получает 25% от поинтов clicker_id
         referral_bonus = int(clicker_points * REFERRAL_PERCENTAGE)
         if referral_bonus > 0:
-            referral_earnings[clicker_referrer] = referral_earnings.get(clicker_referrer, 0) + referral_bonus
-            egg_points[clicker_referrer] = egg_points.get(clicker_referrer, 0) + referral_bonus
+            referrer = user_store.add_points(clicker_referrer, referral_bonus)
+            referrer.referral_earnings += referral_bonus
             logger.info(f"Referrer {clicker_referrer} earned {referral_bonus} points (25% of {clicker_points}) from referral {clicker_id}")
     
     # Проверяем, есть ли у sender_id реферал
-    sender_referrer = referrers.get(sender_id)
+    sender_referrer = sender.referrer
     if sender_referrer and sender_referrer != sender_id:
         # Реферал sender_id получает 25% от поинтов sender_id
         referral_bonus = int(sender_points * REFERRAL_PERCENTAGE)
         if referral_bonus > 0:
-            referral_earnings[sender_referrer] = referral_earnings.get(sender_referrer, 0) + referral_bonus
-            egg_points[sender_referrer] = egg_points.get(sender_referrer, 0) + referral_bonus
+            referrer = user_store.add_points(sender_referrer, referral_bonus)
+            referrer.referral_earnings += referral_bonus
             logger.info(f"Referrer {sender_referrer} earned {referral_bonus} points (25% of {sender_points}) from referral {sender_id}")
     
     # Проверяем задание "Hatch 100 egg"
-    hatched_count = eggs_hatched_by_user.get(clicker_id, 0)
-    if hatched_count >= 333 and not completed_tasks.get(clicker_id, {}).get('hatch_333_eggs', False):
+    if clicker.eggs_hatched >= 333 and not clicker.has_task('hatch_333_eggs'):
         # Начисляем 100 Egg
-        egg_points[clicker_id] = egg_points.get(clicker_id, 0) + 100
+        user_store.add_points(clicker_id, 100)
         
         # Отмечаем задание как выполненное
-        if clicker_id not in completed_tasks:
-            completed_tasks[clicker_id] = {}
-        completed_tasks[clicker_id]['hatch_333_eggs'] = True
+        clicker.complete_task('hatch_333_eggs')
         
         logger.info(f"User {clicker_id} completed 'Hatch 333 egg' task, earned 100 Egg points")
         
@@ -809,16 +825,16 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.error(f"Failed to send notification to user {clicker_id}: {e}")
     
     # Сохраняем данные после обновления
-    logger.info(f"Before save: {len(egg_points)} users with points, {len(referrers)} referrers")
-    save_data()
-    logger.info(f"After save: {len(egg_points)} users with points, {len(referrers)} referrers")
+    hatch_keys = [('eggs', egg_key), ('users', clicker_id), ('users', sender_id)]
+    for referrer in (clicker_referrer, sender_referrer):
+        if referrer:
+            hatch_keys.append(('users', referrer))
+    record_mutation('egg_hatched', *hatch_keys)
     
     # Для multi egg показываем прогресс во всплывающем уведомлении и отправляем ЛС
     if is_multi_egg:
-        # Получаем актуальные данные после обновления (уже обновлены выше в строках 571-574)
-        # ВАЖНО: данные уже обновлены, поэтому hatched_count уже увеличен на 1
-        multi_egg_data = multi_eggs.get(egg_key, {'hatched_count': 0, 'hatched_by_list': []})
-        hatched_count = multi_egg_data['hatched_count']
+        # ВАЖНО: данные уже обновлены выше, поэтому hatched_count уже увеличен на 1
+        hatched_count = egg_record.hatched_count
         remaining = max_hatches - hatched_count
         
         logger.info(f"Multi egg {egg_key}: hatched_count={hatched_count}, max_hatches={max_hatches}, remaining={remaining}, clicker_id={clicker_id}")
@@ -983,6 +999,68 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     await query.answer("🐣 Egg hatched!", show_alert=False)
 
 
+async def sweep_eggs():
+    """Переносит в архив просроченные невылупленные яйца и давно вылупленные яйца"""
+    now = int(time.time())
+    pending_ttl = EGG_PENDING_TTL_DAYS * 86400 if EGG_PENDING_TTL_DAYS > 0 else None
+    archive_after = EGG_ARCHIVE_AFTER_DAYS * 86400 if EGG_ARCHIVE_AFTER_DAYS > 0 else None
+    if not pending_ttl and not archive_after:
+        return
+    
+    # Сканируем частями, чтобы не блокировать обработку обновлений
+    to_archive = []
+    items = egg_store.items()
+    for start in range(0, len(items), 10000):
+        for egg_key, record in items[start:start + 10000]:
+            if classify_egg(record, now, pending_ttl, archive_after) != KEEP:
+                to_archive.append((egg_key, record))
+        await asyncio.sleep(0)
+    
+    expired = 0
+    archived = 0
+    for start in range(0, len(to_archive), 1000):
+        chunk = to_archive[start:start + 1000]
+        # В архив пишутся записи в формате eggs_detail, запись идет в отдельном потоке
+        snapshot = [(egg_key, egg_store.to_dict(egg_key, record)) for egg_key, record in chunk]
+        await asyncio.get_running_loop().run_in_executor(None, egg_archive.archive, snapshot)
+        removed = []
+        changed = []
+        for (egg_key, record), (_, archived_info) in zip(chunk, snapshot):
+            # Яйца, которые изменились, пока шла запись архива, остаются в памяти
+            if (egg_store.get(egg_key) is not record or record.hatched_count != archived_info['hatched_count']
+                    or record.max_hatches != archived_info['max_hatches']):
+                changed.append((egg_key, archived_info))
+                continue
+            egg_store.remove(egg_key)
+            removed.append(egg_key)
+            if record.is_hatched:
+                archived += 1
+            else:
+                expired += 1
+        if changed:
+            await asyncio.get_running_loop().run_in_executor(None, egg_archive.remove, changed)
+        if removed:
+            record_mutation('eggs_archived', *[('eggs', key) for key in removed])
+    
+    if expired or archived:
+        logger.info(f"Egg retention: archived {expired} expired pending egg(s) and {archived} hatched egg(s), {len(egg_store)} active egg(s) left")
+
+
+async def retention_loop():
+    """Периодически запускает очистку яиц"""
+    while True:
+        try:
+            await sweep_eggs()
+        except Exception as e:
+            logger.error(f"Egg retention sweep failed: {e}", exc_info=True)
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+
+async def post_init(application):
+    """Запускает фоновые задачи бота после инициализации"""
+    application.create_task(retention_loop())
+
+
 async def chat_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик изменений статуса участников канала"""
     if update.chat_member is None:
@@ -991,6 +1069,9 @@ async def chat_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     chat = update.chat_member.chat
     user = update.chat_member.from_user
     new_status = update.chat_member.new_chat_member.status
+    remember_username(user)
+    if update.chat_member.new_chat_member.user.id != user.id:
+        remember_username(update.chat_member.new_chat_member.user)
     
     # Проверяем, что это канал Hatch Egg
     if chat.username and chat.username.lower() == "hatch_egg":
@@ -999,24 +1080,15 @@ async def chat_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         # Если пользователь подписался (стал MEMBER или не LEFT/KICKED)
         if new_status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
             # Проверяем, не получал ли уже награду
-            if not completed_tasks.get(user_id, {}).get('subscribed_to_hatch_egg', False):
+            if not user_store.get(user_id, EMPTY_USER).has_task('subscribed_to_hatch_egg'):
                 # Начисляем 20 Eggs (available eggs to send)
-                today = date.today().isoformat()
-                user_data = daily_eggs_sent.get(user_id, {})
-                if user_data.get('date') != today:
-                    # Сохраняем paid_eggs при инициализации нового дня
-                    old_paid_eggs = daily_eggs_sent.get(user_id, {}).get('paid_eggs', 0)
-                    daily_eggs_sent[user_id] = {'date': today, 'count': 0, 'paid_eggs': old_paid_eggs}
-                    user_data = daily_eggs_sent[user_id]
-                user_data['paid_eggs'] = user_data.get('paid_eggs', 0) + 20
+                add_paid_eggs(user_id, 20)
                 
                 # Отмечаем задание как выполненное
-                if user_id not in completed_tasks:
-                    completed_tasks[user_id] = {}
-                completed_tasks[user_id]['subscribed_to_hatch_egg'] = True
+                user_store.record(user_id).complete_task('subscribed_to_hatch_egg')
                 
                 # Сохраняем данные после обновления
-                save_data()
+                record_mutation('task_completed', ('users', user_id))
                 
                 logger.info(f"User {user_id} subscribed to Hatch Egg, earned 20 Eggs")
                 
@@ -1052,84 +1124,162 @@ async def stats_api(request):
             headers={'Access-Control-Allow-Origin': '*'}
         )
     
-    hatched_count = eggs_hatched_by_user.get(user_id, 0)
-    my_eggs_hatched = user_eggs_hatched_by_others.get(user_id, 0)
-    sent_count = eggs_sent_by_user.get(user_id, 0)
-    points = egg_points.get(user_id, 0)
-    tasks = completed_tasks.get(user_id, {})
-    referral_earned = referral_earnings.get(user_id, 0)
-    referrer_id = referrers.get(user_id)
-    
-    # Count referrals (users who have this user as referrer)
-    # Убеждаемся, что user_id - это int для правильного сравнения
-    user_id_int = int(user_id)
-    logger.info(f"=== COUNTING REFERRALS === For user_id: {user_id_int}, referrers dict size: {len(referrers)}")
-    
-    # Подсчитываем рефералов - ищем всех пользователей, у которых referrer_id == user_id
-    referrals_list = []
-    logger.info(f"Referrers dict items (first 5): {list(referrers.items())[:5]}")
-    
-    for ref_user_id, ref_referrer_id in referrers.items():
-        # Убеждаемся, что оба значения - int
-        try:
-            ref_user_id_int = int(ref_user_id)
-            ref_referrer_id_int = int(ref_referrer_id)
-            logger.debug(f"Checking: ref_user_id={ref_user_id_int} (type: {type(ref_user_id)}), ref_referrer_id={ref_referrer_id_int} (type: {type(ref_referrer_id)}), target={user_id_int}")
-            
-            if ref_referrer_id_int == user_id_int:
-                referrals_list.append(ref_user_id_int)
-                logger.info(f"FOUND REFERRAL: {ref_user_id_int} -> {ref_referrer_id_int} (matches target {user_id_int})")
-        except (ValueError, TypeError) as e:
-            logger.warning(f"Invalid referrer entry in dict: {ref_user_id} (type: {type(ref_user_id)}) -> {ref_referrer_id} (type: {type(ref_referrer_id)}), error: {e}")
-            continue
-    
-    referrals_count = len(referrals_list)
-    
-    # Логируем для отладки
-    logger.info(f"=== REFERRALS COUNT RESULT === User {user_id_int}: referrals_count={referrals_count}, referrals_list={referrals_list}")
-    if referrals_count > 0:
-        # Показываем примеры рефералов
-        logger.info(f"Sample referrals for user {user_id_int}: {referrals_list[:5]}")
-    else:
-        # Если рефералов нет, показываем все записи для отладки
-        logger.warning(f"NO REFERRALS FOUND for user {user_id_int}. Showing all referrers dict entries:")
-        for idx, (ref_user_id, ref_referrer_id) in enumerate(list(referrers.items())[:20]):
-            logger.warning(f"  [{idx}] {ref_user_id} (type: {type(ref_user_id)}) -> {ref_referrer_id} (type: {type(ref_referrer_id)})")
+    # ETag считается до чтения данных: изменение во время сборки ответа даст новый ETag
+    # Место в рейтинге и рефералы по уровням зависят и от чужих данных, поэтому входят в ETag
+    today = date.today().isoformat()
+    rank = user_store.points_rank(user_id)
+    downline = user_store.downline(user_id)
+    etag = data_versions.etag(data_versions.user(user_id), today, rank, format(hash(downline) & 0xffffffffffffffff, 'x'))
+    # Ответ без изменений - 304 или готовые байты из кэша ответов без пересчета
+    cache_key = ('stats', user_id)
+    cached = cached_response(request, cache_key, etag, headers={'Access-Control-Allow-Origin': '*'})
+    if cached is not None:
+        return cached
+    
+    stats = user_stats(user_id, today, rank, downline)
+    logger.info(f"Stats API: user {user_id} has {stats['referrals_count']} referrals")
+    return cache_and_respond(request, cache_key, etag, stats, headers={'Access-Control-Allow-Origin': '*'})
+
+
+def user_stats(user_id, today, rank, downline):
+    """Поля ответа /api/stats пользователя - только из индексов, без обхода данных"""
+    # Все счетчики пользователя - одна запись
+    user = user_store.get(user_id, EMPTY_USER)
+    hatched_count = user.eggs_hatched
     
     # Calculate available eggs (10 free per day + paid eggs - sent today)
     # Paid eggs сохраняются между днями, сбрасывается только daily_sent
-    today = date.today().isoformat()
-    user_data = daily_eggs_sent.get(user_id, {})
-    if user_data.get('date') != today:
-        # New day, reset only daily_sent, keep paid_eggs
-        daily_sent = 0
-        paid_eggs = user_data.get('paid_eggs', 0)  # Сохраняем купленные яйца
-    else:
-        daily_sent = user_data.get('count', 0)
-        paid_eggs = user_data.get('paid_eggs', 0)
+    daily_sent = user.daily_count if user.daily_date == today else 0
+    paid_eggs = user.paid_eggs  # Сохраняем купленные яйца
     
     available_eggs = FREE_EGGS_PER_DAY + paid_eggs - daily_sent
     if available_eggs < 0:
         available_eggs = 0
     
-    return web.json_response(
+    return {
+        'hatched_by_me': hatched_count,
+        'my_eggs_hatched': user.hatched_by_others,
+        'eggs_sent': user.eggs_sent,
+        'egg_points': user.points,
+        'rank': rank,  # Место по поинтам (null - поинтов нет)
+        'hatch_points': hatched_count,  # Hatch points = вылупленные яйца
+        'available_eggs': available_eggs,  # Available eggs to send today
+        'tasks': flags_to_tasks(user.tasks),
+        'referral_earned': user.referral_earnings,
+        'referral_earnings': user.referral_earnings,  # Alias for compatibility
+        'referrals_count': user_store.referral_count(user_id),  # Count referrals (users who have this user as referrer)
+        'downline_counts': downline[0],  # Рефералов на уровнях 1..DOWNLINE_LEVELS
+        'downline_points': downline[1],  # Поинтов, набранных рефералами каждого уровня
+        'has_referrer': user.referrer is not None
+    }
+
+
+async def batch_stats_api(request):
+    """API endpoint статистики многих пользователей: POST {"user_ids": [...]}, ответ пишется частями"""
+    cors = {'Access-Control-Allow-Origin': '*'}
+    # Handle CORS preflight
+    if request.method == 'OPTIONS':
+        return web.Response(
+            status=200,
+            headers={
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, Accept',
+                'Access-Control-Max-Age': '3600'
+            }
+        )
+    
+    try:
+        body = await request.json()
+        user_ids = body.get('user_ids') if isinstance(body, dict) else body
+        if not isinstance(user_ids, list):
+            raise ValueError
+        # Повторы отдаются один раз, порядок запроса сохраняется
+        user_ids = list(dict.fromkeys(int(user_id) for user_id in user_ids))
+    except (ValueError, TypeError):
+        return web.json_response({'error': 'user_ids list required'}, status=400, headers=cors)
+    if len(user_ids) > STATS_BATCH_MAX:
+        return web.json_response({'error': f'at most {STATS_BATCH_MAX} user_ids allowed'}, status=400, headers=cors)
+    
+    response = web.StreamResponse(headers=cors)
+    response.content_type = 'application/json'
+    response.enable_compression()
+    await response.prepare(request)
+    
+    # Один день на весь ответ; части по STATS_BATCH_CHUNK пользователей отдают цикл событий другим запросам
+    today = date.today().isoformat()
+    await response.write(b'{"stats":{')
+    for start in range(0, len(user_ids), STATS_BATCH_CHUNK):
+        chunk = []
+        for user_id in user_ids[start:start + STATS_BATCH_CHUNK]:
+            stats = user_stats(user_id, today, user_store.points_rank(user_id), user_store.downline(user_id))
+            chunk.append(f'"{user_id}":' + json.dumps(stats, ensure_ascii=False, separators=(',', ':')))
+        await response.write(((',' if start else '') + ','.join(chunk)).encode('utf-8'))
+    await response.write(b'}}')
+    await response.write_eof()
+    logger.info(f"Batch stats API: {len(user_ids)} users")
+    return response
+
+
+async def leaderboard_api(request):
+    """API endpoint таблицы лидеров по поинтам: ?limit=&offset="""
+    try:
+        limit = min(int(request.query.get('limit') or LEADERBOARD_PAGE_SIZE), LEADERBOARD_MAX_PAGE_SIZE)
+        offset = int(request.query.get('offset') or 0)
+        if limit < 1 or offset < 0:
+            raise ValueError
+    except ValueError:
+        return web.json_response(
+            {'error': 'invalid limit or offset'},
+            status=400,
+            headers={'Access-Control-Allow-Origin': '*'}
+        )
+    
+    # Рейтинг меняется при любом начислении - ETag по общей версии данных
+    etag = data_versions.etag(data_versions.version, limit, offset)
+    cache_key = ('leaderboard', limit, offset)
+    cached = cached_response(request, cache_key, etag, headers={'Access-Control-Allow-Origin': '*'})
+    if cached is not None:
+        return cached
+    
+    leaders = []
+    for position, (user_id, points) in enumerate(user_store.leaderboard(limit, offset), offset + 1):
+        leaders.append({
+            'rank': position,
+            'user_id': user_id,
+            'username': user_store.get(user_id, EMPTY_USER).username,
+            'points': points
+        })
+    return cache_and_respond(
+        request, cache_key, etag,
         {
-            'hatched_by_me': hatched_count,
-            'my_eggs_hatched': my_eggs_hatched,
-            'eggs_sent': sent_count,
-            'egg_points': points,
-            'hatch_points': hatched_count,  # Hatch points = вылупленные яйца
-            'available_eggs': available_eggs,  # Available eggs to send today
-            'tasks': tasks,
-            'referral_earned': referral_earned,
-            'referral_earnings': referral_earned,  # Alias for compatibility
-            'referrals_count': referrals_count,
-            'has_referrer': referrer_id is not None
+            'total': user_store.ranked_count(),
+            'offset': offset,
+            'leaders': leaders
         },
         headers={'Access-Control-Allow-Origin': '*'}
     )
 
 
+async def activity_metrics_api(request):
+    """API endpoint метрик активности: ?days=&hours= (последние дни и часы)"""
+    try:
+        days = int(request.query.get('days') or 30)
+        hours = int(request.query.get('hours') or 24)
+        if days < 0 or hours < 0:
+            raise ValueError
+    except ValueError:
+        return web.json_response(
+            {'error': 'invalid days or hours'},
+            status=400,
+            headers={'Access-Control-Allow-Origin': '*'}
+        )
+    return web.json_response(
+        activity.report(days, hours),
+        headers={'Access-Control-Allow-Origin': '*'}
+    )
+
+
 # Глобальная переменная для хранения application (для проверки подписок)
 bot_application = None
 
@@ -1167,7 +1317,7 @@ async def check_subscription_api(request):
     
     # Проверяем подписку через Telegram API
     try:
-        subscribed = completed_tasks.get(user_id, {}).get('subscribed_to_hatch_egg', False)
+        subscribed = user_store.get(user_id, EMPTY_USER).has_task('subscribed_to_hatch_egg')
         
         # Если еще не отмечено как выполненное, проверяем через API
         if not subscribed and bot_application:
@@ -1180,22 +1330,13 @@ async def check_subscription_api(request):
                 # Проверяем, что пользователь подписан
                 if chat_member.status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
                     # Начисляем 20 Eggs (available eggs to send)
-                    today = date.today().isoformat()
-                    user_data = daily_eggs_sent.get(user_id, {})
-                    if user_data.get('date') != today:
-                        # Сохраняем paid_eggs при инициализации нового дня
-                        old_paid_eggs = daily_eggs_sent.get(user_id, {}).get('paid_eggs', 0)
-                        daily_eggs_sent[user_id] = {'date': today, 'count': 0, 'paid_eggs': old_paid_eggs}
-                        user_data = daily_eggs_sent[user_id]
-                    user_data['paid_eggs'] = user_data.get('paid_eggs', 0) + 20
+                    add_paid_eggs(user_id, 20)
                     
                     # Отмечаем задание как выполненное
-                    if user_id not in completed_tasks:
-                        completed_tasks[user_id] = {}
-                    completed_tasks[user_id]['subscribed_to_hatch_egg'] = True
+                    user_store.record(user_id).complete_task('subscribed_to_hatch_egg')
                     
                     # Сохраняем данные после обновления
-                    save_data()
+                    record_mutation('task_completed', ('users', user_id))
                     
                     subscribed = True
                     logger.info(f"User {user_id} is subscribed to Hatch Egg, earned 20 Eggs")
@@ -1303,7 +1444,7 @@ async def verify_ton_payment_api(request):
     
     # Добавляем оплаченные яйца к лимиту пользователя
     add_paid_eggs(user_id, eggs_to_add)
-    save_data()
+    record_mutation('ton_payment', ('ton_payments', user_id), ('users', user_id))
     
     logger.info(f"TON payment verified: user_id={user_id}, amount={amount}, eggs={eggs_to_add}, tx_hash={tx_hash}")
     
@@ -1363,8 +1504,8 @@ async def set_referral_api(request):
     # Устанавливаем реферала только если:
     # 1. У пользователя еще нет реферала
     # 2. Реферал не является самим пользователем
-    if user_id in referrers:
-        existing_referrer = referrers[user_id]
+    existing_referrer = user_store.get(user_id, EMPTY_USER).referrer
+    if existing_referrer is not None:
         logger.info(f"User {user_id} already has referrer {existing_referrer}, ignoring request to set {referrer_id}")
         return web.json_response(
             {
@@ -1387,14 +1528,15 @@ async def set_referral_api(request):
         )
     
     # Устанавливаем реферала
-    referrers[user_id] = referrer_id
-    logger.info(f"User {user_id} became referral of {referrer_id} via API (total referrers now: {len(referrers)})")
+    user_store.set_referrer(user_id, referrer_id)
+    logger.info(f"User {user_id} became referral of {referrer_id} via API")
     
     # Сохраняем данные
-    save_data()
+    record_mutation('referral_set', ('users', user_id))
+    data_versions.touch_users([referrer_id])  # Изменилось число рефералов
     
     # Подсчитываем количество рефералов для реферала
-    referrer_referrals_count = sum(1 for ref_user_id, ref_referrer_id in referrers.items() if int(ref_referrer_id) == referrer_id)
+    referrer_referrals_count = user_store.referral_count(referrer_id)
     logger.info(f"Referrer {referrer_id} now has {referrer_referrals_count} referrals")
     
     return web.json_response(
@@ -1413,20 +1555,11 @@ async def reset_data_api(request):
     
     try:
         # Полностью обнуляем все счетчики
-        egg_points.clear()
-        eggs_sent_by_user.clear()
-        daily_eggs_sent.clear()
-        eggs_hatched_by_user.clear()
-        user_eggs_hatched_by_others.clear()
-        hatched_eggs.clear()
-        referral_earnings.clear()
-        completed_tasks.clear()
-        referrers.clear()  # Сбрасываем рефералов
-        eggs_detail.clear()
-        multi_eggs.clear()
+        user_store.clear()  # Все счетчики, поинты, задания и рефералы
+        egg_store.clear()
         
         # Сохраняем изменения
-        save_data()
+        record_mutation('reset', cleared=('users', 'eggs'))
         
         logger.warning("All data has been reset via API")
         
@@ -1535,18 +1668,30 @@ def main():
     import asyncio
     global bot_application
     
+    # Загружаем состояние до подключения к Telegram
+    init_state()
+    
     # Создаем приложение
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
     bot_application = application
     
     # Передаем бота в eggchain_api для получения информации о пользователях
     set_bot_instance(application.bot)
+    # Архив старых яиц для поиска в Eggchain Explorer
+    set_egg_archive(egg_archive)
+    # Explorer читает яйца из памяти бота, а не из файла снимка
+    set_egg_store(egg_store)
+    # Справочник username для /api/user/username/{username}
+    set_user_store(user_store)
+    set_data_versions(data_versions)
     
     # Регистрируем обработчики
     application.add_handler(CommandHandler("start", start))
     # Команда reset_all отключена для защиты данных пользователей
     # application.add_handler(CommandHandler("reset_all", reset_all))
     application.add_handler(InlineQueryHandler(inline_query))
+    # Яйца регистрируются при выборе результата (нужен /setinlinefeedback в @BotFather)
+    application.add_handler(ChosenInlineResultHandler(chosen_inline_result))
     application.add_handler(CallbackQueryHandler(button_callback))
     application.add_handler(ChatMemberHandler(chat_member_handler, ChatMemberHandler.CHAT_MEMBER))
     
@@ -1559,6 +1704,10 @@ def main():
             
             app = web.Application()
             app.router.add_get('/api/stats', stats_api)
+            app.router.add_post('/api/stats/batch', batch_stats_api)
+            app.router.add_options('/api/stats/batch', batch_stats_api)
+            app.router.add_get('/api/leaderboard', leaderboard_api)
+            app.router.add_get('/api/metrics/activity', activity_metrics_api)
             app.router.add_post('/api/stats/check_subscription', check_subscription_api)
             app.router.add_options('/api/stats/check_subscription', check_subscription_api)
             app.router.add_post('/api/ton/verify_payment', verify_ton_payment_api)
@@ -1590,9 +1739,17 @@ def main():
     api_thread = threading.Thread(target=run_api_server, daemon=True)
     api_thread.start()
     
+    # Запускаем фоновое сохранение данных
+    saver.start()
+    atexit.register(shutdown_persistence)
+    
     # Запускаем бота
     logger.info("Бот запущен!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    try:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    finally:
+        # Гарантированно сохраняем данные при остановке
+        shutdown_persistence()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,120 @@
+"""
+Многоуровневые показатели рефералов
+Поле referrer образует лес указателей на родителя (возможны и циклы: двое вылупили
+яйца друг друга). Для каждого пользователя хранится, сколько рефералов у него на
+уровнях 1..k и сколько поинтов они набрали. Пользователь на уровне d у своего
+d-го предка по первому вхождению (как при обходе дерева с посещенными вершинами),
+сам себе не реферал. Смена реферера обновляет не больше k предков за O(k^2),
+начисление поинтов - за O(k), без обхода дерева
+"""
+
+
+class DownlineIndex:
+    """user_id -> [рефералов на уровнях 1..k] + [поинтов на уровнях 1..k]"""
+
+    def __init__(self, levels, parent, points):
+        # parent(user_id) -> реферер или None, points(user_id) -> поинты пользователя
+        self.levels = max(1, levels)
+        self._parent = parent
+        self._points = points
+        self._nodes = {}
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def build(self, user_ids):
+        """Считает показатели с нуля: каждый пользователь добавляется к своим k предкам"""
+        k = self.levels
+        nodes = self._nodes
+        parents = {}
+        for user_id in user_ids:
+            parent = self._parent(user_id)
+            if parent is not None:
+                parents[user_id] = parent
+        for user_id, parent in parents.items():
+            points = self._points(user_id)
+            chain = []  # До k предков - проверка повторов по списку быстрее множества
+            while parent is not None and len(chain) < k and parent != user_id and parent not in chain:
+                node = nodes.get(parent)
+                if node is None:
+                    node = nodes[parent] = [0] * (2 * k)
+                level = len(chain)
+                node[level] += 1
+                node[k + level] += points
+                chain.append(parent)
+                parent = parents.get(parent)
+
+    def get(self, user_id):
+        """(рефералов по уровням, поинтов по уровням) - кортежи длины k"""
+        node = self._nodes.get(user_id)
+        if node is None:
+            return (0,) * self.levels, (0,) * self.levels
+        return tuple(node[:self.levels]), tuple(node[self.levels:])
+
+    def points_changed(self, user_id, delta):
+        """Поинты user_id изменились на delta"""
+        if not delta:
+            return
+        chain, _ = self._ancestors(user_id)
+        for level, ancestor in enumerate(chain):
+            self._node(ancestor)[self.levels + level] += delta
+
+    def link(self, user_id):
+        """Пользователю назначен реферер (вызывается после изменения)"""
+        self._relink(user_id, 1)
+
+    def unlink(self, user_id):
+        """Реферер пользователя будет снят (вызывается до изменения)"""
+        self._relink(user_id, -1)
+
+    def _node(self, user_id):
+        node = self._nodes.get(user_id)
+        if node is None:
+            node = self._nodes[user_id] = [0] * (2 * self.levels)
+        return node
+
+    def _ancestors(self, user_id):
+        """Предки по первому вхождению (не больше k) и сколько их до возврата к
+        user_id по циклу (None - цикл не замыкается в пределах k уровней)"""
+        chain = []
+        seen = set()
+        node = self._parent(user_id)
+        while node is not None and len(chain) < self.levels:
+            if node == user_id:
+                return chain, len(chain)
+            if node in seen:
+                break
+            seen.add(node)
+            chain.append(node)
+            node = self._parent(node)
+        return chain, None
+
+    def _relink(self, user_id, sign):
+        # Дерево user_id без связи с реферером переносится к каждому предку целиком:
+        # его уровень depth становится уровнем depth + расстояние до предка
+        k = self.levels
+        chain, cycle = self._ancestors(user_id)
+        if not chain:
+            return
+        own = self._nodes.get(user_id) or [0] * (2 * k)
+        counts = [1] + own[:k]
+        points = [self._points(user_id)] + own[k:]
+        for distance, ancestor in enumerate(chain, 1):
+            node = self._node(ancestor)
+            # Предок на цикле сам лежит в дереве user_id на глубине back: его собственное
+            # поддерево уже засчитано ему ближе, чем через user_id
+            back = cycle - distance + 1 if cycle is not None else None
+            # Показатели предка без связи user_id -> реферер (при снятии восстанавливаются по уровням)
+            before_counts = [1] + node[:k]
+            before_points = [self._points(ancestor)] + node[k:]
+            for level in range(distance, k + 1):
+                depth = level - distance
+                count, total = counts[depth], points[depth]
+                if back is not None and depth >= back:
+                    count -= before_counts[depth - back]
+                    total -= before_points[depth - back]
+                node[level - 1] += sign * count
+                node[k + level - 1] += sign * total
+                if sign < 0:
+                    before_counts[level] = node[level - 1]
+                    before_points[level] = node[k + level - 1]
@@ -0,0 +1,704 @@
+"""
+Компактное хранилище яиц в памяти
+Вместо словаря из 9 ключей на каждое яйцо - объект с __slots__, время в секундах
+epoch, флаги multi/hatched в одном int. sender_id и egg_id не хранятся отдельно,
+а берутся из ключа яйца ({sender_id}_{egg_id}). Списки вылупивших multi egg
+лежат в отдельной таблице и не дублируются. Индекс egg_id -> egg_key позволяет найти
+яйцо по короткому id без перебора, индексы по отправителю и вылупившему - яйца
+пользователя, упорядоченные по (время, egg_key). Индексы не копируют строки: egg_id
+ищется по хэшу, а время и ключ яйца пользователя лежат в параллельных массивах
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+
+FLAG_MULTI = 1
+FLAG_HATCHED = 2  # Обычное яйцо вылуплено (раньше - членство в hatched_eggs)
+
+# До скольких яиц пользователя индекс хранит кортеж ключей (время берется из записей),
+# дальше - параллельные массивы времени и ключей
+SMALL_USER_EGGS = 8
+
+
+def to_epoch(value):
+    """ISO строка -> секунды epoch (0 - нет значения)"""
+    if not value:
+        return 0
+    if isinstance(value, (int, float)):
+        return int(value)
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except (TypeError, ValueError):
+        return 0
+
+
+def to_iso(ts):
+    """Секунды epoch -> ISO строка (как раньше хранилось в eggs_detail)"""
+    return datetime.fromtimestamp(ts).isoformat() if ts else None
+
+
+def split_egg_key(egg_key):
+    """{sender_id}_{egg_id} -> (sender_id, egg_id)"""
+    sender_part, sep, egg_id = egg_key.partition('_')
+    try:
+        sender_id = int(sender_part)
+    except ValueError:
+        return None, egg_key
+    return sender_id, egg_id if sep else egg_key
+
+
+class EggRecord:
+    """Запись об одном яйце"""
+
+    __slots__ = ('hatched_by', 'ts_sent', 'ts_hatched', 'flags', 'max_hatches', 'hatched_count')
+
+    def __init__(self, hatched_by=None, ts_sent=0, ts_hatched=0, flags=0, max_hatches=1, hatched_count=0):
+        self.hatched_by = hatched_by
+        self.ts_sent = ts_sent
+        self.ts_hatched = ts_hatched
+        self.flags = flags
+        self.max_hatches = max_hatches
+        self.hatched_count = hatched_count
+
+    @property
+    def is_multi(self):
+        return bool(self.flags & FLAG_MULTI)
+
+    @property
+    def is_hatched(self):
+        """Вылуплено ли яйцо хотя бы раз"""
+        return bool(self.flags & FLAG_HATCHED) or self.hatched_count > 0
+
+
+class EggStore:
+    """Все яйца бота: egg_key -> EggRecord"""
+
+    def __init__(self):
+        self._records = {}
+        self._hatchers = {}  # egg_key -> [user_id, ...] только для multi egg
+        self._hatch_times = {}  # egg_key -> array('q') времен вылупления каждым из _hatchers
+        self._by_egg_id = _EggIdIndex()  # egg_id -> egg_key без копии egg_id
+        # user_id -> яйца по (время отправки / вылупления этим пользователем, egg_key):
+        # egg_key для одного яйца, кортеж ключей для нескольких, _UserEggs для многих
+        self._by_sender = {}
+        self._by_hatcher = {}
+        # Массовая загрузка: записи индексов добавляются в конец, порядок наводит sort_indexes()
+        self._bulk = False
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, egg_key):
+        return egg_key in self._records
+
+    def __iter__(self):
+        return iter(list(self._records))
+
+    def get(self, egg_key):
+        return self._records.get(egg_key)
+
+    def find(self, egg_id):
+        """Ключ яйца по полному ключу {sender_id}_{egg_id} или по короткому egg_id (None - нет)"""
+        if egg_id in self._records:
+            return egg_id
+        egg_key = self._by_egg_id.get(egg_id)
+        return egg_key if egg_key in self._records else None
+
+    def sent_count(self, user_id):
+        return _index_len(self._by_sender, user_id)
+
+    def hatched_count(self, user_id):
+        return _index_len(self._by_hatcher, user_id)
+
+    def sent_page(self, user_id, limit, cursor=None):
+        """Страница отправленных яиц от новых к старым: ([(время, ключ)], курсор следующей страницы)"""
+        return _index_page(self._by_sender, user_id, limit, cursor, self._sent_time)
+
+    def hatched_page(self, user_id, limit, cursor=None):
+        """Страница вылупленных яиц от новых к старым: ([(время, ключ)], курсор следующей страницы)"""
+        return _index_page(self._by_hatcher, user_id, limit, cursor, lambda key: self._hatch_time(key, user_id))
+
+    def _sent_time(self, egg_key):
+        record = self._records.get(egg_key)
+        return record.ts_sent if record is not None else 0
+
+    def _hatch_time(self, egg_key, user_id):
+        """Когда user_id вылупил яйцо (0 - яйца уже нет: его читали из другого потока)"""
+        record = self._records.get(egg_key)
+        if record is None:
+            return 0
+        if record.flags & FLAG_MULTI:
+            hatchers = self._hatchers.get(egg_key, ())
+            times = self._hatch_times.get(egg_key)
+            if times is not None and len(times) == len(hatchers) and user_id in hatchers:
+                return times[hatchers.index(user_id)]
+        return record.ts_hatched
+
+    def _index(self, egg_key):
+        """Добавляет яйцо в индексы egg_id, отправителя и вылупивших (после записи record)"""
+        record = self._records[egg_key]
+        sender_id, egg_id = split_egg_key(egg_key)
+        self._by_egg_id.set(egg_id, egg_key)
+        if sender_id is not None:
+            _index_add(self._by_sender, sender_id, record.ts_sent, egg_key, self._sent_time, self._bulk)
+        for user_id, ts in zip(self.hatchers(egg_key), self.hatch_times(egg_key)):
+            self._index_hatcher(user_id, ts, egg_key)
+
+    def _index_hatcher(self, user_id, ts, egg_key):
+        _index_add(self._by_hatcher, user_id, ts, egg_key, lambda key: self._hatch_time(key, user_id), self._bulk)
+
+    def _unindex(self, egg_key):
+        """Убирает яйцо из всех индексов (до изменения или удаления записи)"""
+        record = self._records[egg_key]
+        sender_id, egg_id = split_egg_key(egg_key)
+        # Короткий id мог перейти к другому яйцу с таким же egg_id
+        self._by_egg_id.discard(egg_id, egg_key)
+        _index_discard(self._by_sender, sender_id, record.ts_sent, egg_key, self._bulk)
+        for user_id, ts in zip(self.hatchers(egg_key), self.hatch_times(egg_key)):
+            _index_discard(self._by_hatcher, user_id, ts, egg_key, self._bulk)
+
+    def bulk_load(self):
+        """Начало массовой загрузки: до sort_indexes() индексы пользователей не упорядочены"""
+        self._bulk = True
+
+    def sort_indexes(self):
+        """Упорядочивает яйца пользователей по (время, egg_key) после массовой загрузки"""
+        for user_id, entries in self._by_sender.items():
+            if not isinstance(entries, str):
+                self._by_sender[user_id] = _sort_entries(entries, self._sent_time)
+        for user_id, entries in self._by_hatcher.items():
+            if not isinstance(entries, str):
+                self._by_hatcher[user_id] = _sort_entries(entries, lambda key: self._hatch_time(key, user_id))
+        self._bulk = False
+
+    def items(self):
+        """Копия списка (egg_key, EggRecord) - безопасно итерировать из другого потока"""
+        return list(self._records.items())
+
+    def hatchers(self, egg_key):
+        """Кто вылупил яйцо: список для multi egg, [hatched_by] для обычного"""
+        record = self._records.get(egg_key)
+        if record is None:
+            return []
+        if record.flags & FLAG_MULTI:
+            return list(self._hatchers.get(egg_key, ()))
+        return [record.hatched_by] if record.hatched_by is not None else []
+
+    def hatch_times(self, egg_key):
+        """Когда вылупил каждый из hatchers(): для multi egg без сохраненных времен
+        (данные до их появления) - время первого вылупления"""
+        record = self._records.get(egg_key)
+        if record is None:
+            return []
+        if record.flags & FLAG_MULTI:
+            hatchers = self._hatchers.get(egg_key, ())
+            times = self._hatch_times.get(egg_key)
+            if times is not None and len(times) == len(hatchers):
+                return list(times)
+            return [record.ts_hatched] * len(hatchers)
+        return [record.ts_hatched] if record.hatched_by is not None else []
+
+    def is_hatched(self, egg_key):
+        """Вылуплено ли обычное яйцо (проверка повторного вылупления)"""
+        record = self._records.get(egg_key)
+        return record is not None and bool(record.flags & FLAG_HATCHED)
+
+    def create(self, egg_key, is_multi=False, max_hatches=1, ts_sent=0):
+        """Регистрирует новое яйцо"""
+        if egg_key in self._records:
+            # Повторная регистрация заменяет яйцо целиком
+            self.remove(egg_key)
+        record = EggRecord(ts_sent=ts_sent, flags=FLAG_MULTI if is_multi else 0, max_hatches=max_hatches)
+        self._records[egg_key] = record
+        self._index(egg_key)
+        return record
+
+    def set_max_hatches(self, egg_key, max_hatches):
+        """Исправляет размер multi egg. Возвращает True, если он изменился"""
+        record = self._records.get(egg_key)
+        if record is None or not record.flags & FLAG_MULTI or record.max_hatches == max_hatches:
+            return False
+        record.max_hatches = max_hatches
+        return True
+
+    def hatch(self, egg_key, user_id, ts):
+        """Отмечает вылупление яйца пользователем"""
+        record = self._records[egg_key]
+        if record.flags & FLAG_MULTI:
+            times = array('q', self.hatch_times(egg_key))
+            times.append(ts)
+            self._hatchers.setdefault(egg_key, []).append(user_id)
+            self._hatch_times[egg_key] = times
+            record.hatched_count += 1
+            if record.hatched_count == 1:
+                record.ts_hatched = ts
+        else:
+            if record.hatched_by is not None:
+                _index_discard(self._by_hatcher, record.hatched_by, record.ts_hatched, egg_key)
+            record.flags |= FLAG_HATCHED
+            record.hatched_by = user_id
+            record.ts_hatched = ts
+            record.hatched_count = 1
+        self._index_hatcher(user_id, ts, egg_key)
+        return record
+
+    def __setitem__(self, egg_key, info):
+        # Применение записи журнала: info - запись формата to_dict()
+        self.import_dict(egg_key, info)
+
+    def pop(self, egg_key, default=None):
+        record = self.remove(egg_key)
+        return default if record is None else record
+
+    def remove(self, egg_key):
+        if egg_key in self._records:
+            self._unindex(egg_key)
+        self._hatchers.pop(egg_key, None)
+        self._hatch_times.pop(egg_key, None)
+        return self._records.pop(egg_key, None)
+
+    def clear(self):
+        self._records.clear()
+        self._hatchers.clear()
+        self._hatch_times.clear()
+        self._by_egg_id = _EggIdIndex()
+        self._by_sender.clear()
+        self._by_hatcher.clear()
+
+    # --- Преобразование в формат eggs_detail (журнал, снимок, API, архив) ---
+
+    def to_dict(self, egg_key, record=None):
+        """Запись яйца в прежнем формате eggs_detail (+ признак 'hatched') или None"""
+        if record is None:
+            record = self._records.get(egg_key)
+            if record is None:
+                return None
+        sender_id, egg_id = split_egg_key(egg_key)
+        return {
+            'sender_id': sender_id,
+            'egg_id': egg_id,
+            'hatched_by': record.hatched_by,
+            'timestamp_sent': to_iso(record.ts_sent),
+            'timestamp_hatched': to_iso(record.ts_hatched),
+            'is_multi': bool(record.flags & FLAG_MULTI),
+            'max_hatches': record.max_hatches,
+            'hatched_count': record.hatched_count,
+            'hatched_by_list': self.hatchers(egg_key),
+            'hatched_at_list': [to_iso(ts) for ts in self.hatch_times(egg_key)] if record.flags & FLAG_MULTI else [],
+            'hatched': bool(record.flags & FLAG_HATCHED)
+        }
+
+    def import_dict(self, egg_key, info, hatched=None):
+        """Добавляет яйцо из записи формата eggs_detail"""
+        if egg_key in self._records:
+            self._unindex(egg_key)
+        flags = FLAG_MULTI if info.get('is_multi') else 0
+        if hatched if hatched is not None else info.get('hatched'):
+            flags |= FLAG_HATCHED
+        record = EggRecord(
+            hatched_by=info.get('hatched_by'),
+            ts_sent=to_epoch(info.get('timestamp_sent')),
+            ts_hatched=to_epoch(info.get('timestamp_hatched')),
+            flags=flags,
+            max_hatches=info.get('max_hatches', 1) or 1,
+            hatched_count=info.get('hatched_count', 0) or 0
+        )
+        self._records[egg_key] = record
+        hatchers = list(info.get('hatched_by_list') or []) if flags & FLAG_MULTI else None
+        times = [to_epoch(value) for value in info.get('hatched_at_list') or []]
+        if hatchers:
+            self._hatchers[egg_key] = hatchers
+        else:
+            self._hatchers.pop(egg_key, None)
+        if hatchers and len(times) == len(hatchers):
+            self._hatch_times[egg_key] = array('q', times)
+        else:
+            self._hatch_times.pop(egg_key, None)
+        self._index(egg_key)
+        return record
+
+    def set_hatched(self, egg_key, hatched):
+        """Устанавливает признак вылупления (для яиц, известных только по hatched_eggs)"""
+        record = self._records.get(egg_key)
+        if record is None:
+            if not hatched:
+                return
+            record = self._records[egg_key] = EggRecord(hatched_count=1)
+            self._index(egg_key)
+        if hatched:
+            record.flags |= FLAG_HATCHED
+        else:
+            record.flags &= ~FLAG_HATCHED
+
+    @classmethod
+    def from_legacy(cls, eggs_detail, hatched_eggs=(), multi_eggs=None):
+        """Строит хранилище из прежних коллекций eggs_detail / hatched_eggs / multi_eggs"""
+        store = cls()
+        store.bulk_load()
+        hatched_eggs = set(hatched_eggs)
+        for egg_key, info in eggs_detail.items():
+            if multi_eggs and egg_key in multi_eggs and not info.get('hatched_by_list'):
+                info = dict(info, hatched_by_list=multi_eggs[egg_key].get('hatched_by_list', []))
+            store.import_dict(egg_key, info, hatched=egg_key in hatched_eggs)
+        for egg_key in hatched_eggs:
+            if egg_key not in store._records:
+                store.set_hatched(egg_key, True)
+        store.sort_indexes()
+        return store
+
+    # --- Столбцы для бинарного снимка (быстрый перезапуск) ---
+
+    def to_columns(self, keys=None):
+        """Хранилище по столбцам: списки одинаковой длины + таблица вылупивших.
+        keys - только эти яйца (шард хранилища)"""
+        if keys is None:
+            items = self.items()
+        else:
+            items = [(egg_key, self._records[egg_key]) for egg_key in keys if egg_key in self._records]
+        hatchers = {}
+        hatch_times = {}
+        for egg_key, record in items:
+            users = self._hatchers.get(egg_key) if record.flags & FLAG_MULTI else None
+            if users:
+                hatchers[egg_key] = list(users)
+                hatch_times[egg_key] = list(self.hatch_times(egg_key))
+        return {
+            'keys': [egg_key for egg_key, _ in items],
+            'hatched_by': [r.hatched_by for _, r in items],
+            'ts_sent': [r.ts_sent for _, r in items],
+            'ts_hatched': [r.ts_hatched for _, r in items],
+            'flags': [r.flags for _, r in items],
+            'max_hatches': [r.max_hatches for _, r in items],
+            'hatched_count': [r.hatched_count for _, r in items],
+            'hatchers': hatchers,
+            'hatch_times': hatch_times
+        }
+
+    @classmethod
+    def from_columns(cls, columns):
+        store = cls()
+        store.load_columns(columns)
+        store.sort_indexes()
+        return store
+
+    def load_columns(self, columns):
+        """Добавляет яйца из столбцов to_columns() (шарды загружаются по очереди,
+        после загрузки всех нужен sort_indexes())"""
+        self._bulk = True
+        self._records.update(zip(columns['keys'], map(
+            EggRecord, columns['hatched_by'], columns['ts_sent'], columns['ts_hatched'],
+            columns['flags'], columns['max_hatches'], columns['hatched_count']
+        )))
+        self._hatchers.update(columns['hatchers'])
+        # Снимки до сохранения времен вылупления их не содержат
+        for egg_key, times in columns.get('hatch_times', {}).items():
+            self._hatch_times[egg_key] = array('q', times)
+        for egg_key in columns['keys']:
+            self._index(egg_key)
+
+    def export_legacy(self):
+        """Возвращает (eggs_detail, hatched_eggs, multi_eggs) в прежнем формате файла"""
+        eggs_detail = {}
+        hatched_eggs = []
+        multi_eggs = {}
+        for egg_key, record in self.items():
+            info = self.to_dict(egg_key, record)
+            if info.pop('hatched'):
+                hatched_eggs.append(egg_key)
+            eggs_detail[egg_key] = info
+            if record.flags & FLAG_MULTI:
+                multi_eggs[egg_key] = {
+                    'hatched_by_list': list(info['hatched_by_list']),
+                    'hatched_count': record.hatched_count
+                }
+        return eggs_detail, hatched_eggs, multi_eggs
+
+
+class _IdTable:
+    """Часть _EggIdIndex: открытая адресация, хэши в array('q'), ключи яиц в списке"""
+
+    __slots__ = ('hashes', 'keys', 'used', 'filled')
+
+    def __init__(self, capacity=8):
+        self.hashes = array('q', bytes(8 * capacity))  # 0 - пусто, -1 - удалено (hash() не бывает -1)
+        self.keys = [None] * capacity
+        self.used = 0  # Живые записи
+        self.filled = 0  # Живые и удаленные
+
+    def find(self, h, egg_id):
+        """Номер ячейки яйца с egg_id или (-1, первая свободная ячейка)"""
+        hashes, keys = self.hashes, self.keys
+        mask = len(keys) - 1
+        perturb = h & 0xFFFFFFFFFFFFFFFF
+        i = perturb & mask
+        free = -1
+        while True:
+            slot = hashes[i]
+            if slot == 0:
+                return -1, (i if free < 0 else free)
+            if slot == h and split_egg_key(keys[i])[1] == egg_id:
+                return i, free
+            if slot == -1 and free < 0:
+                free = i
+            perturb >>= 5
+            i = (i * 5 + perturb + 1) & mask
+
+    def insert(self, h, egg_key, i):
+        if self.hashes[i] == 0:
+            self.filled += 1
+        self.hashes[i] = h
+        self.keys[i] = egg_key
+        self.used += 1
+
+    def resized(self):
+        """Новая таблица, заполненная не больше чем наполовину, без удаленных записей"""
+        capacity = 8
+        while capacity < self.used * 2:
+            capacity <<= 1
+        table = _IdTable(capacity)
+        mask = capacity - 1
+        for h, egg_key in zip(self.hashes, self.keys):
+            if egg_key is None:
+                continue
+            perturb = h & 0xFFFFFFFFFFFFFFFF
+            i = perturb & mask
+            while table.hashes[i]:
+                perturb >>= 5
+                i = (i * 5 + perturb + 1) & mask
+            table.insert(h, egg_key, i)
+        return table
+
+
+class _EggIdIndex:
+    """egg_id -> egg_key без копии egg_id: ячейка хранит hash(egg_id) и ссылку на ключ яйца,
+    совпадение проверяется по egg_id внутри ключа. Разбит на 256 таблиц, чтобы
+    расширение одной таблицы не останавливало бота на миллионах яиц"""
+
+    __slots__ = ('tables',)
+
+    def __init__(self):
+        self.tables = [_IdTable() for _ in range(256)]
+
+    def __len__(self):
+        return sum(table.used for table in self.tables)
+
+    @staticmethod
+    def _hash(egg_id):
+        h = hash(egg_id)
+        return h if h else 1
+
+    def get(self, egg_id):
+        h = self._hash(egg_id)
+        table = self.tables[h & 255]
+        i, _ = table.find(h, egg_id)
+        return table.keys[i] if i >= 0 else None
+
+    def set(self, egg_id, egg_key):
+        """Яйцо с тем же egg_id (у другого отправителя) вытесняет прежнее"""
+        h = self._hash(egg_id)
+        table = self.tables[h & 255]
+        i, free = table.find(h, egg_id)
+        if i >= 0:
+            table.keys[i] = egg_key
+            return
+        table.insert(h, egg_key, free)
+        if table.filled * 3 > len(table.keys) * 2:
+            self.tables[h & 255] = table.resized()
+
+    def discard(self, egg_id, egg_key):
+        h = self._hash(egg_id)
+        table = self.tables[h & 255]
+        i, _ = table.find(h, egg_id)
+        if i >= 0 and table.keys[i] == egg_key:
+            table.hashes[i] = -1
+            table.keys[i] = None
+            table.used -= 1
+
+
+class _UserEggs:
+    """Яйца пользователя (больше SMALL_USER_EGGS): время и egg_key в параллельных массивах,
+    упорядоченных по (время, egg_key) - 16 байт на яйцо вместо кортежа"""
+
+    __slots__ = ('times', 'keys')
+
+    def __init__(self, entries=()):
+        entries = sorted(set(entries))
+        self.times = array('q', [ts for ts, _ in entries])
+        self.keys = [egg_key for _, egg_key in entries]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def position(self, ts, egg_key):
+        """Позиция первой записи не меньше (ts, egg_key)"""
+        lo = bisect_left(self.times, ts)
+        return bisect_left(self.keys, egg_key, lo, bisect_right(self.times, ts, lo))
+
+    def add(self, ts, egg_key, bulk=False):
+        times, keys = self.times, self.keys
+        if bulk or times[-1] < ts or times[-1] == ts and keys[-1] < egg_key:
+            # Новые яйца почти всегда самые поздние - добавление в конец
+            times.append(ts)
+            keys.append(egg_key)
+            return
+        i = self.position(ts, egg_key)
+        if i < len(keys) and keys[i] == egg_key and times[i] == ts:
+            return
+        times.insert(i, ts)
+        keys.insert(i, egg_key)
+
+    def discard(self, ts, egg_key, bulk=False):
+        times, keys = self.times, self.keys
+        if bulk:
+            # До sort_indexes() массивы не упорядочены
+            i = next((i for i, key in enumerate(keys) if key == egg_key and times[i] == ts), len(keys))
+        else:
+            i = self.position(ts, egg_key)
+        if i == len(keys) or keys[i] != egg_key or times[i] != ts:
+            return
+        del times[i]
+        del keys[i]
+
+    def sort(self):
+        self.__init__(zip(self.times, self.keys))
+
+    def page(self, limit, cursor=None):
+        end = len(self.keys) if cursor is None else self.position(*cursor)
+        start = max(0, end - limit)
+        page = list(zip(self.times[start:end], self.keys[start:end]))
+        page.reverse()
+        return page, ((self.times[start], self.keys[start]) if start > 0 else None)
+
+
+def _sort_entries(entries, time_of):
+    """Упорядочивает яйца пользователя после массовой загрузки"""
+    if isinstance(entries, _UserEggs):
+        entries.sort()
+        return entries
+    return tuple(sorted(entries, key=lambda key: (time_of(key), key)))
+
+
+def _index_add(index, user_id, ts, egg_key, time_of, bulk=False):
+    """time_of(egg_key) - время яйца пользователя, которое хранится без времени"""
+    entries = index.get(user_id)
+    if entries is None:
+        index[user_id] = egg_key
+        return
+    if isinstance(entries, _UserEggs):
+        entries.add(ts, egg_key, bulk)
+        return
+    keys = (entries,) if isinstance(entries, str) else entries
+    if egg_key in keys:
+        return
+    if len(keys) >= SMALL_USER_EGGS:
+        index[user_id] = _UserEggs([(time_of(key), key) for key in keys] + [(ts, egg_key)])
+    elif bulk:
+        # Порядок наведет sort_indexes()
+        index[user_id] = keys + (egg_key,)
+    else:
+        entries = sorted([(time_of(key), key) for key in keys] + [(ts, egg_key)])
+        index[user_id] = tuple(key for _, key in entries)
+
+
+def _index_discard(index, user_id, ts, egg_key, bulk=False):
+    entries = index.get(user_id)
+    if entries is None:
+        return
+    if isinstance(entries, str):
+        if entries == egg_key:
+            del index[user_id]
+        return
+    if isinstance(entries, _UserEggs):
+        entries.discard(ts, egg_key, bulk)
+        keys = entries.keys
+        if len(keys) > 1:
+            return
+    elif egg_key in entries:
+        keys = tuple(key for key in entries if key != egg_key)
+    else:
+        return
+    index[user_id] = keys[0] if len(keys) == 1 else tuple(keys)
+
+
+def _index_len(index, user_id):
+    entries = index.get(user_id)
+    if entries is None:
+        return 0
+    return 1 if isinstance(entries, str) else len(entries)
+
+
+def _index_page(index, user_id, limit, cursor, time_of):
+    entries = index.get(user_id)
+    if entries is None:
+        return [], None
+    if isinstance(entries, _UserEggs):
+        return entries.page(limit, cursor)
+    keys = (entries,) if isinstance(entries, str) else entries
+    return page_entries([(time_of(key), key) for key in keys], limit, cursor)
+
+
+def page_entries(entries, limit, cursor=None):
+    """Страница отсортированного списка (время, egg_key) от новых к старым.
+    Курсор - последняя выданная запись: следующая страница начинается с записей
+    меньше нее, поэтому удаление старых яиц и новые яйца ее не сдвигают"""
+    end = len(entries) if cursor is None else bisect_left(entries, cursor)
+    start = max(0, end - limit)
+    page = entries[start:end]
+    page.reverse()
+    return page, (entries[start] if start > 0 else None)
+
+
+class _LegacyEggDetail:
+    """Применяет записи журнала коллекции eggs_detail к EggStore"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __setitem__(self, egg_key, info):
+        self.store.import_dict(egg_key, info, hatched=self.store.is_hatched(egg_key))
+
+    def pop(self, egg_key, default=None):
+        return self.store.remove(egg_key) or default
+
+    def clear(self):
+        self.store.clear()
+
+
+class _LegacyHatchedEggs:
+    """Применяет записи журнала коллекции hatched_eggs к EggStore"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def add(self, egg_key):
+        self.store.set_hatched(egg_key, True)
+
+    def discard(self, egg_key):
+        self.store.set_hatched(egg_key, False)
+
+    def clear(self):
+        for egg_key, record in self.store.items():
+            record.flags &= ~FLAG_HATCHED
+
+
+class _Ignored:
+    """multi_eggs восстанавливается из hatched_by_list в eggs_detail"""
+
+    def __setitem__(self, key, value):
+        pass
+
+    def pop(self, key, default=None):
+        return default
+
+    def clear(self):
+        pass
+
+
+def legacy_collections(store):
+    """Коллекции прежнего формата поверх EggStore - для журналов, записанных до EggStore"""
+    return {
+        'eggs_detail': _LegacyEggDetail(store),
+        'hatched_eggs': _LegacyHatchedEggs(store),
+        'multi_eggs': _Ignored()
+    }
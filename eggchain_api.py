@@ -1,62 +1,387 @@
 """
 API endpoints для Eggchain Explorer
-Работает с JSON файлом bot_data.json
+Читает яйца из живого хранилища бота (или из файла снимка, если запущен отдельно)
 """
 
 from aiohttp import web
-import json
+import asyncio
 import os
+import time
 from datetime import datetime
+from avatar_cache import AvatarCache
+from egg_store import EggStore
+from http_cache import ResponseCache, not_modified
+from profile_cache import ProfileCache
+from storage import read_json_eggs, read_shard_eggs, read_sqlite_eggs
 
 # Глобальная переменная для доступа к боту (будет установлена из bot.py)
 bot_instance = None
 
+# Архив старых яиц (будет установлен из bot.py)
+egg_archive = None
+
+# Живое хранилище яиц бота (будет установлено из bot.py)
+egg_store = None
+
+# Пользователи бота со справочником username -> user_id (будут установлены из bot.py)
+user_store = None
+
+# Версии данных для ETag (будут установлены из bot.py)
+data_versions = None
+
+# Хранилище, прочитанное с диска, если API работает без бота: (версия файлов, EggStore)
+_file_state = None
+
 def set_bot_instance(bot):
     """Устанавливает экземпляр бота для получения информации о пользователях"""
     global bot_instance
     bot_instance = bot
 
-async def get_user_info(user_id):
-    """Получает информацию о пользователе из Telegram"""
-    if not bot_instance:
-        return None, None, None
-    
-    try:
+def set_egg_archive(archive):
+    """Устанавливает архив старых яиц для поиска яиц, которых уже нет в eggs_detail"""
+    global egg_archive
+    egg_archive = archive
+
+def set_egg_store(store):
+    """Устанавливает живое хранилище яиц - запросы читают его без чтения файла"""
+    global egg_store
+    egg_store = store
+
+def set_user_store(store):
+    """Устанавливает хранилище пользователей для поиска по username"""
+    global user_store
+    user_store = store
+
+def set_data_versions(versions):
+    """Устанавливает версии данных, по которым строятся ETag ответов"""
+    global data_versions
+    data_versions = versions
+
+# Аватары отдаются через /api/avatar/{user_id}, а не ссылкой на файл Telegram
+# (такая ссылка содержит токен бота и действует около часа)
+AVATAR_DIR = os.getenv('AVATAR_DIR', 'avatar_cache')
+AVATAR_CACHE_MB = int(os.getenv('AVATAR_CACHE_MB', 100))
+AVATAR_REFRESH_TTL = int(os.getenv('AVATAR_REFRESH_TTL', 86400))  # Через сколько секунд проверять новое фото
+AVATAR_NEGATIVE_TTL = int(os.getenv('AVATAR_NEGATIVE_TTL', 60))  # Через сколько секунд повторять запрос, если фото нет
+PUBLIC_API_URL = os.getenv('PUBLIC_API_URL', '').rstrip('/')  # Внешний адрес API для ссылок на аватары (пусто - адрес запроса)
+
+async def fetch_avatar_photo(user_id):
+    """Самый маленький размер текущего фото профиля: (file_id, file_unique_id) или None"""
+    photos = await bot_instance.get_user_profile_photos(user_id, limit=1)
+    if not photos or photos.total_count == 0:
+        return None
+    photo = photos.photos[0][0]
+    return photo.file_id, photo.file_unique_id
+
+async def download_avatar(file_id):
+    file = await bot_instance.get_file(file_id)
+    return bytes(await file.download_as_bytearray())
+
+avatar_cache = AvatarCache(
+    AVATAR_DIR,
+    fetch_avatar_photo,
+    download_avatar,
+    max_bytes=AVATAR_CACHE_MB * 1024 * 1024,
+    refresh_ttl=AVATAR_REFRESH_TTL,
+    negative_ttl=AVATAR_NEGATIVE_TTL
+)
+
+def avatar_url(user_id, file_unique_id):
+    # Путь без адреса сервера - кэш профилей общий для запросов с разных адресов
+    # v меняется вместе с фото - браузер может кэшировать ссылку бессрочно
+    return f"/api/avatar/{user_id}?v={file_unique_id}"
+
+def public_base_url(request):
+    """Внешний адрес API для абсолютных ссылок: PUBLIC_API_URL или адрес запроса (с учетом прокси)"""
+    if PUBLIC_API_URL:
+        return PUBLIC_API_URL
+    if request is None:
+        return ''
+    host = request.headers.get('X-Forwarded-Host', request.host).split(',')[0].strip()
+    scheme = request.headers.get('X-Forwarded-Proto', request.scheme).split(',')[0].strip()
+    return f"{scheme}://{host}"
+
+# Параллельное получение профилей в одном ответе API
+PROFILE_CONCURRENCY = int(os.getenv('PROFILE_CONCURRENCY', 16))  # Одновременных запросов к Telegram
+PROFILE_DEADLINE = float(os.getenv('PROFILE_DEADLINE', 3))  # Сколько секунд ответ ждет профили
+NO_PROFILE = (None, None, None)
+_profile_semaphore = None
+
+async def fetch_user_info(user_id):
+    """Загружает профиль пользователя из Telegram (ошибка get_chat пробрасывается для кэша).
+    Загрузку запускает кэш профилей, поэтому ограничение PROFILE_CONCURRENCY действует и на
+    загрузки, которые продолжаются после PROFILE_DEADLINE"""
+    global _profile_semaphore
+    if _profile_semaphore is None:
+        # Общий для всех запросов API - ограничивает нагрузку на Telegram
+        _profile_semaphore = asyncio.Semaphore(max(1, PROFILE_CONCURRENCY))
+    async with _profile_semaphore:
         user = await bot_instance.get_chat(user_id)
         username = user.username if hasattr(user, 'username') and user.username else None
-        first_name = user.first_name if hasattr(user, 'first_name') else None
         
-        # Получаем фото профиля
+        # Получаем фото профиля (сам файл скачивается только при запросе /api/avatar)
         avatar_file_id = None
-        avatar_url = None
+        avatar_link = None
         try:
-            photos = await bot_instance.get_user_profile_photos(user_id, limit=1)
-            if photos and photos.total_count > 0:
-                avatar_file_id = photos.photos[0][0].file_id
-                # Получаем URL файла
-                file = await bot_instance.get_file(avatar_file_id)
-                # Формируем полный URL для доступа к файлу
-                avatar_url = f"https://api.telegram.org/file/bot{bot_instance.token}/{file.file_path}"
+            photo = await fetch_avatar_photo(user_id)
+            if photo:
+                avatar_file_id, file_unique_id = photo
+                avatar_cache.remember(user_id, avatar_file_id, file_unique_id)
+                avatar_link = avatar_url(user_id, file_unique_id)
         except:
             pass
-        
-        return username, avatar_file_id, avatar_url
-    except Exception as e:
+    
+    return username, avatar_file_id, avatar_link
+
+# Кэш профилей: один пользователь не запрашивается у Telegram повторно в течение TTL
+profile_cache = ProfileCache(
+    fetch_user_info,
+    max_size=int(os.getenv('PROFILE_CACHE_SIZE', 10000)),
+    ttl=float(os.getenv('PROFILE_CACHE_TTL', 3600)),
+    negative_ttl=float(os.getenv('PROFILE_CACHE_NEGATIVE_TTL', 60)),
+    default=(None, None, None)
+)
+
+async def get_user_info(user_id):
+    """Получает информацию о пользователе из Telegram (через кэш профилей)"""
+    if not bot_instance:
         return None, None, None
+    return await profile_cache.get(user_id)
+
+async def resolve_profiles(user_ids, request=None):
+    """Профили нескольких пользователей параллельно: ({user_id: (username, avatar_file_id, avatar_url)}, все ли получены).
+    Ссылки на аватары - абсолютные по адресу запроса request.
+    Не успевшие к PROFILE_DEADLINE не попадают в результат (загрузка продолжается в кэш)"""
+    user_ids = {user_id for user_id in user_ids if user_id}
+    if not user_ids or not bot_instance:
+        return {}, True
+    
+    async def resolve(user_id):
+        return user_id, await get_user_info(user_id)
+    
+    tasks = [asyncio.ensure_future(resolve(user_id)) for user_id in user_ids]
+    done, pending = await asyncio.wait(tasks, timeout=PROFILE_DEADLINE)
+    for task in pending:
+        task.cancel()
+    base_url = public_base_url(request)
+    profiles = {}
+    for task in done:
+        if task.exception() is None:
+            user_id, (username, avatar_file_id, avatar_link) = task.result()
+            profiles[user_id] = (username, avatar_file_id, base_url + avatar_link if avatar_link else None)
+    return profiles, not pending
+
+async def get_profile_cache_stats(request):
+    """
+    GET /api/profile_cache/stats
+    Счетчики кэша профилей (попадания, промахи, объединенные запросы)
+    """
+    if request.method == 'OPTIONS':
+        response = web.Response()
+        return add_cors_headers(response)
+    response = web.json_response(profile_cache.stats())
+    return add_cors_headers(response)
+
+# Кэш закодированных ответов Explorer и /api/stats, действителен пока не изменился ETag
+response_cache = ResponseCache(
+    max_size=int(os.getenv('RESPONSE_CACHE_SIZE', 10000)),
+    gzip_min_size=int(os.getenv('RESPONSE_GZIP_MIN_SIZE', 1024))
+)
+
+def cached_response(request, cache_key, etag, headers=None):
+    """304 или готовый ответ из кэша для версии etag (None - ответ нужно собрать)"""
+    response = not_modified(request, etag, headers)
+    if response is None:
+        entry = response_cache.get(cache_key, etag)
+        if entry is None:
+            return None
+        response = response_cache.respond(request, entry, headers)
+    return response
+
+def cache_and_respond(request, cache_key, etag, payload, complete=True, headers=None):
+    """Кодирует ответ один раз и сохраняет в кэш. Ответ с не полученными профилями
+    не кэшируется и отдается без ETag, чтобы клиент запросил его снова"""
+    if not complete:
+        return web.json_response(payload, headers=headers)
+    entry = response_cache.put(cache_key, etag, payload)
+    return response_cache.respond(request, entry, headers)
+
+async def get_avatar(request):
+    """
+    GET /api/avatar/{user_id}
+    Фото профиля пользователя из дискового кэша (скачивается у Telegram один раз)
+    """
+    if request.method == 'OPTIONS':
+        response = web.Response()
+        return add_cors_headers(response)
+    
+    try:
+        user_id = int(request.match_info.get('user_id'))
+    except (TypeError, ValueError):
+        response = web.json_response({'error': 'Invalid user ID'}, status=400)
+        return add_cors_headers(response)
+    
+    # Файл читается сразу: отложенная отдача файла может не найти его после вытеснения
+    avatar = await avatar_cache.read(user_id) if bot_instance else None
+    if avatar is None:
+        response = web.json_response({'error': 'Avatar not found'}, status=404)
+        return add_cors_headers(response)
+    file_unique_id, body = avatar
+    
+    if request.query.get('v') == file_unique_id:
+        # Ссылка с версией фото не меняет содержимое
+        cache_control = 'public, max-age=31536000, immutable'
+    else:
+        cache_control = f"public, max-age={AVATAR_REFRESH_TTL}"
+    response = web.Response(body=body, content_type='image/jpeg', headers={
+        'Cache-Control': cache_control
+    })
+    return add_cors_headers(response)
+
+async def get_avatar_cache_stats(request):
+    """
+    GET /api/avatar_cache/stats
+    Счетчики дискового кэша аватаров
+    """
+    if request.method == 'OPTIONS':
+        response = web.Response()
+        return add_cors_headers(response)
+    response = web.json_response(avatar_cache.stats())
+    return add_cors_headers(response)
+
+async def get_response_cache_stats(request):
+    """
+    GET /api/response_cache/stats
+    Счетчики кэша готовых ответов
+    """
+    if request.method == 'OPTIONS':
+        response = web.Response()
+        return add_cors_headers(response)
+    response = web.json_response(response_cache.stats())
+    return add_cors_headers(response)
 
 # Путь к файлу данных (должен совпадать с bot.py)
 DATA_FILE = os.getenv('DATA_FILE', 'bot_data.json')
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json').lower()
+SQLITE_FILE = os.getenv('SQLITE_FILE', 'bot_data.db')
+SHARD_DIR = os.getenv('SHARD_DIR', 'bot_data_shards')
+
+# Постраничная выдача яиц пользователя
+API_PAGE_SIZE = int(os.getenv('API_PAGE_SIZE', 50))
+API_MAX_PAGE_SIZE = int(os.getenv('API_MAX_PAGE_SIZE', 500))
+
+def parse_page(request, cursor_param='cursor'):
+    """limit и курсор страницы из query-параметров (ValueError - неверные значения).
+    Курсор {время}_{egg_key} - последнее яйцо предыдущей страницы"""
+    limit = int(request.query.get('limit') or API_PAGE_SIZE)
+    cursor = request.query.get(cursor_param)
+    if cursor:
+        ts, _, egg_key = cursor.partition('_')
+        cursor = (int(ts), egg_key)
+        if not egg_key:
+            raise ValueError(f"invalid {cursor_param}")
+    else:
+        cursor = None
+    if limit < 1:
+        raise ValueError("invalid limit")
+    return min(limit, API_MAX_PAGE_SIZE), cursor
+
+def format_cursor(cursor):
+    return f"{cursor[0]}_{cursor[1]}" if cursor is not None else None
+
+def merge_pages(limit, *pages):
+    """Объединяет страницы ([(время, egg_key)], курсор) нескольких источников в одну от новых к старым"""
+    entries = sorted({entry for page, _ in pages for entry in page}, reverse=True)
+    has_more = len(entries) > limit or any(next_cursor is not None for _, next_cursor in pages)
+    entries = entries[:limit]
+    return entries, (entries[-1] if has_more and entries else None)
+
+async def user_egg_page(store, kind, user_id, limit, cursor):
+    """Страница отправленных ('sent') или вылупленных ('hatched') яиц пользователя из памяти
+    и архива: (записи eggs_detail от новых к старым, курсор следующей страницы, всего яиц)"""
+    if kind == 'sent':
+        page = store.sent_page(user_id, limit, cursor)
+        total = store.sent_count(user_id)
+    else:
+        page = store.hatched_page(user_id, limit, cursor)
+        total = store.hatched_count(user_id)
+    archived_infos = {}
+    if egg_archive is not None:
+        archived_page, archived_total, archived_infos = await asyncio.get_running_loop().run_in_executor(
+            None, egg_archive.user_page, kind, user_id, limit, cursor
+        )
+        page = merge_pages(limit, page, archived_page)
+        total += archived_total
+    entries, next_cursor = page
+    infos = []
+    for _, egg_key in entries:
+        # Яйцо, которое прямо сейчас переносится в архив, берется из памяти
+        info = store.to_dict(egg_key) or archived_infos.get(egg_key)
+        if info is not None:
+            infos.append(info)
+    return infos, next_cursor, total
+
+def data_etag(scope, key, request=None):
+    """ETag ответа о пользователе ('user') или яйце ('egg') - вычисляется до чтения данных.
+    Профили Telegram не версионируются, поэтому ETag меняется и раз в TTL кэша профилей;
+    адрес API в ссылках на аватары тоже входит в ETag"""
+    profile_epoch = int(time.time() // max(profile_cache.ttl, 60))
+    base_url = '%x' % (hash(public_base_url(request)) & 0xffffffff)
+    if data_versions is None:
+        # API без бота: любая запись файлов данных меняет ETag
+        return '"%x"' % (hash((_files_version(), scope, key, profile_epoch, base_url)) & 0xffffffffffffffff)
+    version = data_versions.user(key) if scope == 'user' else data_versions.egg(key)
+    return data_versions.etag(version, profile_epoch, base_url)
 
 def load_data():
-    """Загружает данные из JSON файла"""
+    """Загружает данные из файла снимка (или из базы SQLite / шардов, если бот использует их)"""
+    if STORAGE_BACKEND == 'sqlite' and os.path.exists(SQLITE_FILE):
+        try:
+            return read_sqlite_eggs(SQLITE_FILE)
+        except Exception as e:
+            return {}
+    if STORAGE_BACKEND == 'sharded' and os.path.exists(SHARD_DIR):
+        try:
+            return read_shard_eggs(SHARD_DIR)
+        except Exception as e:
+            return {}
     if os.path.exists(DATA_FILE):
         try:
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            # Формат снимка (json / binary) определяется автоматически, журнал догоняет снимок
+            return read_json_eggs(DATA_FILE)
         except Exception as e:
             return {}
     return {}
 
+def _files_version():
+    """Время изменения и размер файлов данных и журнала - меняются при каждой записи бота"""
+    if STORAGE_BACKEND == 'sqlite':
+        paths = [SQLITE_FILE, SQLITE_FILE + '-wal']
+    elif STORAGE_BACKEND == 'sharded':
+        paths = [os.path.join(SHARD_DIR, 'manifest.json'), os.path.join(SHARD_DIR, 'journal')]
+    else:
+        paths = [DATA_FILE, DATA_FILE + '.journal']
+    version = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            version.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+def get_egg_store():
+    """Хранилище яиц для чтения: живое состояние бота, а без бота - снимок с диска
+    с журналом, которые перечитываются только после изменения файлов"""
+    global _file_state
+    if egg_store is not None:
+        return egg_store
+    version = _files_version()
+    if _file_state is None or _file_state[0] != version:
+        data = load_data()
+        _file_state = (version, EggStore.from_legacy(data.get('eggs_detail', {}), data.get('hatched_eggs', [])))
+    return _file_state[1]
+
 def add_cors_headers(response):
     """Добавляет CORS заголовки к ответу"""
     response.headers['Access-Control-Allow-Origin'] = '*'
@@ -82,66 +407,31 @@ async def get_egg_by_id(request):
         return add_cors_headers(response)
     
     try:
-        data = load_data()
-        
-        # Получаем детальную информацию о яйцах
-        eggs_detail = data.get('eggs_detail', {})  # {egg_key: {sender_id, egg_id, hatched_by, timestamp_sent, timestamp_hatched}}
-        hatched_eggs = set(data.get('hatched_eggs', []))
-        
-        # Ищем яйцо в eggs_detail
-        egg_info = None
-        egg_key = None
-        
-        # Сначала пробуем найти по полному ключу (sender_id_egg_id)
-        if egg_id_param in eggs_detail:
-            egg_key = egg_id_param
-            egg_info = eggs_detail[egg_key]
-        else:
-            # Ищем по частичному совпадению (только egg_id)
-            for key, info in eggs_detail.items():
-                if info.get('egg_id') == egg_id_param:
-                    egg_key = key
-                    egg_info = info
-                    break
-        
-        # Если не нашли в детальной информации, пробуем восстановить из hatched_eggs
-        if not egg_info:
-            # Ищем в hatched_eggs по формату sender_id_egg_id
-            if egg_id_param in hatched_eggs:
-                parts = egg_id_param.split('_', 1)
-                if len(parts) == 2:
-                    sender_id = int(parts[0])
-                    egg_id = parts[1]
-                    egg_info = {
-                        'sender_id': sender_id,
-                        'egg_id': egg_id,
-                        'hatched_by': None,  # Не знаем, кто вылупил
-                        'timestamp_sent': None,
-                        'timestamp_hatched': None
-                    }
-                    egg_key = egg_id_param
-            else:
-                # Пробуем найти по egg_id в hatched_eggs
-                for egg_key_candidate in hatched_eggs:
-                    if egg_key_candidate.endswith(f'_{egg_id_param}'):
-                        parts = egg_key_candidate.split('_', 1)
-                        if len(parts) == 2:
-                            sender_id = int(parts[0])
-                            egg_id = parts[1]
-                            egg_info = {
-                                'sender_id': sender_id,
-                                'egg_id': egg_id,
-                                'hatched_by': None,
-                                'timestamp_sent': None,
-                                'timestamp_hatched': None
-                            }
-                            egg_key = egg_key_candidate
-                            break
+        store = get_egg_store()
+        
+        # По полному ключу (sender_id_egg_id) или по egg_id через индекс
+        egg_key = store.find(egg_id_param)
+        etag = data_etag('egg', egg_key, request) if egg_key else None
+        egg_info = store.to_dict(egg_key) if egg_key else None
+        
+        # Старые и просроченные яйца ищем в архиве по компактному индексу
+        is_archived = False
+        if not egg_info and egg_archive is not None:
+            archived = await asyncio.get_running_loop().run_in_executor(None, egg_archive.lookup, egg_id_param)
+            if archived:
+                egg_key, egg_info = archived
+                etag = data_etag('egg', egg_key, request)
+                is_archived = True
         
         if not egg_info:
             response = web.json_response({'error': 'Egg not found'}, status=404)
             return add_cors_headers(response)
         
+        cache_key = ('egg', egg_key)
+        cached = cached_response(request, cache_key, etag)
+        if cached is not None:
+            return add_cors_headers(cached)
+        
         sender_id = egg_info.get('sender_id')
         egg_id = egg_info.get('egg_id', egg_id_param)
         hatched_by = egg_info.get('hatched_by')
@@ -149,16 +439,17 @@ async def get_egg_by_id(request):
         timestamp_hatched = egg_info.get('timestamp_hatched')
         
         # Проверяем, вылуплено ли яйцо
-        is_hatched = egg_key in hatched_eggs if egg_key else False
+        is_hatched = egg_info.get('hatched', False) or (is_archived and bool(egg_info.get('hatched_count')))
         
         # Если вылуплено, но hatched_by не указан, пытаемся найти из других источников
         if is_hatched and not hatched_by:
             # Можно попробовать найти из других данных, но для простоты оставляем None
             pass
         
-        # Получаем информацию о пользователях
-        sender_username, sender_avatar_file, sender_avatar_url = await get_user_info(sender_id) if sender_id else (None, None, None)
-        hatched_by_username, hatched_by_avatar_file, hatched_by_avatar_url = await get_user_info(hatched_by) if hatched_by else (None, None, None)
+        # Получаем информацию о пользователях (параллельно)
+        profiles, complete = await resolve_profiles([sender_id, hatched_by], request)
+        sender_username, sender_avatar_file, sender_avatar_url = profiles.get(sender_id, NO_PROFILE)
+        hatched_by_username, hatched_by_avatar_file, hatched_by_avatar_url = profiles.get(hatched_by, NO_PROFILE)
         
         result = {
             'egg_id': egg_id,
@@ -174,7 +465,7 @@ async def get_egg_by_id(request):
             'status': 'hatched' if is_hatched else 'pending'
         }
         
-        response = web.json_response(result)
+        response = cache_and_respond(request, cache_key, etag, result, complete)
         return add_cors_headers(response)
         
     except Exception as e:
@@ -183,8 +474,8 @@ async def get_egg_by_id(request):
 
 async def get_user_eggs(request):
     """
-    GET /api/user/{user_id}/eggs
-    Возвращает список всех яиц, отправленных пользователем
+    GET /api/user/{user_id}/eggs?limit=&cursor=
+    Возвращает страницу яиц, отправленных пользователем (новые сначала)
     """
     # Обработка OPTIONS запроса для CORS
     if request.method == 'OPTIONS':
@@ -204,56 +495,49 @@ async def get_user_eggs(request):
         return add_cors_headers(response)
     
     try:
-        data = load_data()
+        limit, cursor = parse_page(request)
+    except ValueError:
+        response = web.json_response({'error': 'Invalid limit or cursor'}, status=400)
+        return add_cors_headers(response)
+    
+    try:
+        etag = data_etag('user', user_id, request)
+        cache_key = ('user_eggs', user_id, limit, cursor)
+        cached = cached_response(request, cache_key, etag)
+        if cached is not None:
+            return add_cors_headers(cached)
         
-        # Получаем детальную информацию о яйцах
-        eggs_detail = data.get('eggs_detail', {})
-        hatched_eggs = set(data.get('hatched_eggs', []))
+        store = get_egg_store()
         
-        # Находим все яйца, отправленные этим пользователем
-        user_eggs = []
-        for egg_key, egg_info in eggs_detail.items():
-            if egg_info.get('sender_id') == user_id:
-                egg_id = egg_info.get('egg_id', egg_key.split('_', 1)[1] if '_' in egg_key else egg_key)
-                is_hatched = egg_key in hatched_eggs
-                hatched_by = egg_info.get('hatched_by')
-                
-                # Получаем информацию о том, кто вылупил
-                hatched_by_username, hatched_by_avatar_file, hatched_by_avatar_url = await get_user_info(hatched_by) if hatched_by else (None, None, None)
-                
-                user_eggs.append({
-                    'egg_id': egg_id,
-                    'sender_id': user_id,
-                    'recipient_id': None,
-                    'hatched_by': hatched_by,
-                    'hatched_by_username': hatched_by_username,
-                    'hatched_by_avatar': hatched_by_avatar_url,
-                    'timestamp_sent': egg_info.get('timestamp_sent'),
-                    'timestamp_hatched': egg_info.get('timestamp_hatched'),
-                    'status': 'hatched' if is_hatched else 'pending'
-                })
+        # Страница яиц из индекса по отправителю и архива (новые сначала)
+        egg_infos, next_cursor, total = await user_egg_page(store, 'sent', user_id, limit, cursor)
         
-        # Также проверяем hatched_eggs для яиц, которых нет в eggs_detail
-        for egg_key in hatched_eggs:
-            if egg_key.startswith(f'{user_id}_'):
-                # Проверяем, нет ли уже этого яйца в списке
-                egg_id = egg_key.split('_', 1)[1] if '_' in egg_key else egg_key
-                if not any(e['egg_id'] == egg_id for e in user_eggs):
-                    user_eggs.append({
-                        'egg_id': egg_id,
-                        'sender_id': user_id,
-                        'recipient_id': None,
-                        'hatched_by': None,
-                        'hatched_by_username': None,
-                        'timestamp_sent': None,
-                        'timestamp_hatched': None,
-                        'status': 'hatched'
-                    })
+        # Профили всех вылупивших - параллельно, один раз на пользователя
+        profiles, complete = await resolve_profiles((info.get('hatched_by') for info in egg_infos), request)
         
-        # Сортируем по timestamp_sent (новые сначала)
-        user_eggs.sort(key=lambda x: x.get('timestamp_sent') or '', reverse=True)
+        user_eggs = []
+        for egg_info in egg_infos:
+            hatched_by = egg_info.get('hatched_by')
+            hatched_by_username, hatched_by_avatar_file, hatched_by_avatar_url = profiles.get(hatched_by, NO_PROFILE)
+            
+            user_eggs.append({
+                'egg_id': egg_info['egg_id'],
+                'sender_id': user_id,
+                'recipient_id': None,
+                'hatched_by': hatched_by,
+                'hatched_by_username': hatched_by_username,
+                'hatched_by_avatar': hatched_by_avatar_url,
+                'timestamp_sent': egg_info.get('timestamp_sent'),
+                'timestamp_hatched': egg_info.get('timestamp_hatched'),
+                'status': 'hatched' if egg_info['hatched'] else 'pending'
+            })
         
-        response = web.json_response({'eggs': user_eggs})
+        result = {
+            'eggs': user_eggs,
+            'total': total,
+            'next_cursor': format_cursor(next_cursor)
+        }
+        response = cache_and_respond(request, cache_key, etag, result, complete)
         return add_cors_headers(response)
         
     except Exception as e:
@@ -262,8 +546,8 @@ async def get_user_eggs(request):
 
 async def get_user_by_username(request):
     """
-    GET /api/user/username/{username}
-    Возвращает информацию о пользователе и его яйцах по username
+    GET /api/user/username/{username}?limit=&sent_cursor=&hatched_cursor=
+    Возвращает информацию о пользователе и страницы его яиц по username
     """
     if request.method == 'OPTIONS':
         response = web.Response()
@@ -278,87 +562,77 @@ async def get_user_by_username(request):
     username = username.lstrip('@')
     
     try:
-        if not bot_instance:
-            response = web.json_response({'error': 'Bot instance not available'}, status=500)
+        limit, sent_cursor = parse_page(request, 'sent_cursor')
+        _, hatched_cursor = parse_page(request, 'hatched_cursor')
+    except ValueError:
+        response = web.json_response({'error': 'Invalid limit or cursor'}, status=400)
+        return add_cors_headers(response)
+    
+    try:
+        if user_store is None:
+            response = web.json_response({'error': 'User directory not available'}, status=500)
             return add_cors_headers(response)
         
-        # Пробуем найти пользователя через поиск в чатах
-        # Но в Bot API нет прямого поиска по username, поэтому нужно использовать другой подход
-        # Можно попробовать через get_chat, но это работает только если бот знает пользователя
-        
-        # Альтернативный подход: ищем в eggs_detail всех пользователей с таким username
-        data = load_data()
-        eggs_detail = data.get('eggs_detail', {})
-        hatched_eggs = set(data.get('hatched_eggs', []))
-        
-        # Собираем всех уникальных user_id из яиц
-        user_ids_found = set()
-        for egg_info in eggs_detail.values():
-            sender_id = egg_info.get('sender_id')
-            hatched_by = egg_info.get('hatched_by')
-            if sender_id:
-                user_ids_found.add(sender_id)
-            if hatched_by:
-                user_ids_found.add(hatched_by)
-        
-        # Проверяем каждого пользователя на совпадение username
-        target_user_id = None
-        target_username = None
-        target_avatar = None
-        
-        for user_id in user_ids_found:
-            try:
-                user_username, _, user_avatar = await get_user_info(user_id)
-                if user_username and user_username.lower() == username.lower():
-                    target_user_id = user_id
-                    target_username = user_username
-                    target_avatar = user_avatar
-                    break
-            except:
-                continue
-        
+        # Справочник username -> user_id пополняется из обновлений, которые получает бот
+        target_user_id = user_store.find_username(username)
         if not target_user_id:
             response = web.json_response({'error': 'User not found'}, status=404)
             return add_cors_headers(response)
         
+        etag = data_etag('user', target_user_id, request)
+        cache_key = ('username', target_user_id, username, limit, sent_cursor, hatched_cursor)
+        cached = cached_response(request, cache_key, etag)
+        if cached is not None:
+            return add_cors_headers(cached)
+        
+        store = get_egg_store()
+        
+        # Страницы яиц из индексов по отправителю и вылупившему и из архива (новые сначала)
+        sent_infos, next_sent_cursor, total_sent = await user_egg_page(store, 'sent', target_user_id, limit, sent_cursor)
+        hatched_infos, next_hatched_cursor, total_hatched = await user_egg_page(
+            store, 'hatched', target_user_id, limit, hatched_cursor
+        )
+        
+        # Профили самого пользователя и всех связанных с ним - параллельно, один раз на каждого
+        profiles, complete = await resolve_profiles(
+            [target_user_id]
+            + [info.get('hatched_by') for info in sent_infos]
+            + [info.get('sender_id') for info in hatched_infos],
+            request
+        )
+        target_username, _, target_avatar = profiles.get(target_user_id, NO_PROFILE)
+        target_username = target_username or username
+        
         # Получаем все яйца пользователя
         user_eggs_sent = []
         user_eggs_hatched = []
         
-        for egg_key, egg_info in eggs_detail.items():
-            sender_id = egg_info.get('sender_id')
+        for egg_info in sent_infos:
             hatched_by = egg_info.get('hatched_by')
-            egg_id = egg_info.get('egg_id', egg_key.split('_', 1)[1] if '_' in egg_key else egg_key)
-            is_hatched = egg_key in hatched_eggs
-            
-            if sender_id == target_user_id:
-                hatched_by_username, _, hatched_by_avatar = await get_user_info(hatched_by) if hatched_by else (None, None, None)
-                user_eggs_sent.append({
-                    'egg_id': egg_id,
-                    'sender_id': target_user_id,
-                    'hatched_by': hatched_by,
-                    'hatched_by_username': hatched_by_username,
-                    'hatched_by_avatar': hatched_by_avatar,
-                    'timestamp_sent': egg_info.get('timestamp_sent'),
-                    'timestamp_hatched': egg_info.get('timestamp_hatched'),
-                    'status': 'hatched' if is_hatched else 'pending'
-                })
-            
-            if hatched_by == target_user_id:
-                sender_username, _, sender_avatar = await get_user_info(sender_id) if sender_id else (None, None, None)
-                user_eggs_hatched.append({
-                    'egg_id': egg_id,
-                    'sender_id': sender_id,
-                    'sender_username': sender_username,
-                    'sender_avatar': sender_avatar,
-                    'timestamp_sent': egg_info.get('timestamp_sent'),
-                    'timestamp_hatched': egg_info.get('timestamp_hatched'),
-                    'status': 'hatched'
-                })
-        
-        # Сортируем по дате
-        user_eggs_sent.sort(key=lambda x: x.get('timestamp_sent') or '', reverse=True)
-        user_eggs_hatched.sort(key=lambda x: x.get('timestamp_hatched') or '', reverse=True)
+            hatched_by_username, _, hatched_by_avatar = profiles.get(hatched_by, NO_PROFILE)
+            user_eggs_sent.append({
+                'egg_id': egg_info['egg_id'],
+                'sender_id': target_user_id,
+                'hatched_by': hatched_by,
+                'hatched_by_username': hatched_by_username,
+                'hatched_by_avatar': hatched_by_avatar,
+                'timestamp_sent': egg_info.get('timestamp_sent'),
+                'timestamp_hatched': egg_info.get('timestamp_hatched'),
+                'status': 'hatched' if egg_info['hatched'] else 'pending'
+            })
+        
+        for egg_info in hatched_infos:
+            sender_id = egg_info.get('sender_id')
+            sender_username, _, sender_avatar = profiles.get(sender_id, NO_PROFILE)
+            user_eggs_hatched.append({
+                'egg_id': egg_info['egg_id'],
+                'sender_id': sender_id,
+                'sender_username': sender_username,
+                'sender_avatar': sender_avatar,
+                'timestamp_sent': egg_info.get('timestamp_sent'),
+                'timestamp_hatched': egg_info.get('timestamp_hatched'),
+                'status': 'hatched'
+            })
         
         result = {
             'user_id': target_user_id,
@@ -366,11 +640,13 @@ async def get_user_by_username(request):
             'avatar': target_avatar,
             'eggs_sent': user_eggs_sent,
             'eggs_hatched': user_eggs_hatched,
-            'total_sent': len(user_eggs_sent),
-            'total_hatched': len(user_eggs_hatched)
+            'total_sent': total_sent,
+            'total_hatched': total_hatched,
+            'next_sent_cursor': format_cursor(next_sent_cursor),
+            'next_hatched_cursor': format_cursor(next_hatched_cursor)
         }
         
-        response = web.json_response(result)
+        response = cache_and_respond(request, cache_key, etag, result, complete)
         return add_cors_headers(response)
         
     except Exception as e:
@@ -388,3 +664,8 @@ def setup_eggchain_routes(app):
     app.router.add_options('/api/user/{user_id}/eggs', get_user_eggs)
     app.router.add_get('/api/user/username/{username}', get_user_by_username)
     app.router.add_options('/api/user/username/{username}', get_user_by_username)
+    app.router.add_get('/api/profile_cache/stats', get_profile_cache_stats)
+    app.router.add_get('/api/response_cache/stats', get_response_cache_stats)
+    app.router.add_get('/api/avatar/{user_id}', get_avatar)
+    app.router.add_options('/api/avatar/{user_id}', get_avatar)
+    app.router.add_get('/api/avatar_cache/stats', get_avatar_cache_stats)
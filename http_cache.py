@@ -0,0 +1,167 @@
+"""
+Условные запросы к API (ETag / If-None-Match) и кэш готовых ответов
+Каждая мутация бота повышает версию затронутых пользователей и яиц. ETag ответа
+строится из этих версий до сборки ответа - повторный опрос без изменений
+получает 304 без чтения данных, профилей и сериализации, а запрос без ETag -
+уже закодированный (и сжатый) ответ из кэша
+"""
+
+import gzip
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from aiohttp import web
+
+from egg_store import split_egg_key
+
+VERSION_BUCKETS = 65536
+CACHE_CONTROL = 'no-cache'  # Браузер хранит ответ, но каждый раз сверяет ETag
+
+
+class DataVersions:
+    """Монотонные версии данных по пользователям и яйцам.
+    Ключи раскладываются по фиксированному числу корзин: память не растет с числом
+    ключей, а общая корзина дает лишь лишний полный ответ, но не устаревший"""
+
+    def __init__(self, buckets=VERSION_BUCKETS):
+        self.version = 0
+        # Версии начинаются с нуля при каждом запуске - ETag прошлого запуска не совпадет
+        self.epoch = format(time.time_ns(), 'x')
+        self._size = buckets
+        self._users = [0] * buckets
+        self._eggs = [0] * buckets
+        self._cleared = 0  # Версия последней очистки коллекций (сброс данных)
+        self._lock = threading.Lock()
+
+    def bump(self, keys=(), cleared=()):
+        """Отмечает изменение пар (коллекция, ключ) как в record_mutation"""
+        with self._lock:
+            self.version += 1
+            version = self.version
+            if cleared:
+                self._cleared = version
+            for name, key in keys:
+                if name == 'eggs':
+                    self._eggs[hash(key) % self._size] = version
+                    # Список яиц отправителя тоже изменился
+                    sender_id = split_egg_key(key)[0]
+                    if sender_id is not None:
+                        self._users[hash(sender_id) % self._size] = version
+                else:
+                    # users, ton_payments - по user_id
+                    self._users[hash(key) % self._size] = version
+
+    def touch_users(self, user_ids):
+        """Изменились производные данные пользователей (рефералы, вылупленные яйца в архиве)"""
+        self.bump([('users', user_id) for user_id in user_ids])
+
+    def user(self, user_id):
+        return max(self._users[hash(user_id) % self._size], self._cleared)
+
+    def egg(self, egg_key):
+        return max(self._eggs[hash(egg_key) % self._size], self._cleared)
+
+    def etag(self, *parts):
+        return '"' + '-'.join([self.epoch] + [str(part) for part in parts]) + '"'
+
+
+def etag_matches(request, etag):
+    """Совпадает ли If-None-Match запроса с ETag (слабое сравнение)"""
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in header.split(','))
+
+
+def not_modified(request, etag, headers=None):
+    """Ответ 304, если у клиента уже есть актуальная версия (иначе None)"""
+    if not etag_matches(request, etag):
+        return None
+    response = web.Response(status=304, headers=headers)
+    return set_cache_headers(response, etag)
+
+
+def set_cache_headers(response, etag):
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
+
+
+class CachedResponse:
+    """Закодированное тело ответа и ETag версии данных, из которой оно собрано"""
+
+    __slots__ = ('etag', 'body', 'gzipped')
+
+    def __init__(self, etag, body):
+        self.etag = etag
+        self.body = body
+        self.gzipped = None  # Сжимается при первом запросе с Accept-Encoding: gzip
+
+
+class ResponseCache:
+    """LRU кэш JSON ответов по ключу (эндпоинт, пользователь, ...).
+    Запись действительна, пока совпадает ETag: любое изменение данных пользователя
+    или яйца меняет версию, и устаревшая запись пересобирается при следующем чтении"""
+
+    def __init__(self, max_size=10000, gzip_min_size=1024):
+        self.max_size = max(1, max_size)
+        self.gzip_min_size = gzip_min_size  # 0 - не сжимать
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def get(self, key, etag):
+        """Запись для актуальной версии данных (None - нет или устарела)"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.etag != etag:
+            self.stale += 1
+            del self._entries[key]
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, etag, payload):
+        """Кодирует ответ и сохраняет его для версии etag"""
+        entry = CachedResponse(etag, json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def respond(self, request, entry, headers=None):
+        """HTTP ответ из записи кэша (сжатый, если клиент принимает gzip)"""
+        body = entry.body
+        response = web.Response(body=body, content_type='application/json', headers=headers)
+        if self.gzip_min_size and len(body) >= self.gzip_min_size:
+            response.headers['Vary'] = 'Accept-Encoding'
+            if 'gzip' in request.headers.get('Accept-Encoding', ''):
+                if entry.gzipped is None:
+                    entry.gzipped = gzip.compress(body, 6)
+                response.body = entry.gzipped
+                response.headers['Content-Encoding'] = 'gzip'
+        return set_cache_headers(response, entry.etag)
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.stale
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'evictions': self.evictions,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0
+        }
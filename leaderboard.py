@@ -0,0 +1,142 @@
+"""
+Таблица лидеров по поинтам
+Упорядоченный индекс: отсортированные блоки ключей (как в sortedcontainers) и
+дерево Фенвика по размерам блоков. Вставка и удаление - двоичный поиск блока и
+сдвиг внутри блока до LOAD элементов, место в рейтинге и страница по смещению -
+O(log n) по дереву. Ключ - одно целое число, в котором закодированы поинты
+(по убыванию) и user_id (по возрастанию при равных поинтах)
+"""
+
+from bisect import bisect_left, insort
+
+# Telegram user_id занимает до 52 бит, целые Python не ограничены - запас ничего не стоит
+USER_ID_BITS = 64
+USER_ID_MASK = (1 << USER_ID_BITS) - 1
+
+
+def rank_key(user_id, points):
+    """Ключ сортировки: больше поинтов - меньше ключ"""
+    return -points * (1 << USER_ID_BITS) + user_id
+
+
+def split_rank_key(key):
+    """Ключ -> (user_id, points)"""
+    return key & USER_ID_MASK, -(key >> USER_ID_BITS)
+
+
+class RankIndex:
+    """Отсортированное множество целых ключей с поиском по позиции"""
+
+    LOAD = 1000  # Блок делится пополам, когда вырастает вдвое
+
+    def __init__(self, keys=()):
+        keys = sorted(keys)
+        self._lists = [keys[i:i + self.LOAD] for i in range(0, len(keys), self.LOAD)]
+        self._maxes = [block[-1] for block in self._lists]
+        self._len = len(keys)
+        self._build_tree()
+
+    def __len__(self):
+        return self._len
+
+    def _build_tree(self):
+        # Дерево Фенвика по длинам блоков (индексы с 1)
+        tree = [0] * (len(self._lists) + 1)
+        for i, block in enumerate(self._lists, 1):
+            tree[i] += len(block)
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _tree_add(self, index, delta):
+        tree = self._tree
+        index += 1
+        while index < len(tree):
+            tree[index] += delta
+            index += index & -index
+
+    def _prefix(self, index):
+        """Сколько ключей в блоках до index"""
+        total = 0
+        tree = self._tree
+        while index > 0:
+            total += tree[index]
+            index -= index & -index
+        return total
+
+    def _locate(self, position):
+        """Позиция -> (номер блока, позиция в блоке)"""
+        tree = self._tree
+        index = 0
+        step = 1 << (len(tree).bit_length() - 1)
+        while step:
+            next_index = index + step
+            if next_index < len(tree) and tree[next_index] <= position:
+                index = next_index
+                position -= tree[next_index]
+            step >>= 1
+        return index, position
+
+    def add(self, key):
+        if not self._lists:
+            self._lists.append([key])
+            self._maxes.append(key)
+            self._len = 1
+            self._build_tree()
+            return
+        index = bisect_left(self._maxes, key)
+        if index == len(self._maxes):
+            index -= 1
+            self._lists[index].append(key)
+            self._maxes[index] = key
+        else:
+            insort(self._lists[index], key)
+        self._len += 1
+        block = self._lists[index]
+        if len(block) > 2 * self.LOAD:
+            # Делим блок - меняется число блоков, дерево строится заново
+            half = len(block) // 2
+            self._lists[index:index + 1] = [block[:half], block[half:]]
+            self._maxes[index:index + 1] = [block[half - 1], block[-1]]
+            self._build_tree()
+        else:
+            self._tree_add(index, 1)
+
+    def discard(self, key):
+        index = bisect_left(self._maxes, key)
+        if index == len(self._maxes):
+            return
+        block = self._lists[index]
+        position = bisect_left(block, key)
+        if position == len(block) or block[position] != key:
+            return
+        del block[position]
+        self._len -= 1
+        if not block:
+            del self._lists[index]
+            del self._maxes[index]
+            self._build_tree()
+            return
+        self._maxes[index] = block[-1]
+        self._tree_add(index, -1)
+
+    def position(self, key):
+        """Сколько ключей меньше key"""
+        index = bisect_left(self._maxes, key)
+        if index == len(self._maxes):
+            return self._len
+        return self._prefix(index) + bisect_left(self._lists[index], key)
+
+    def slice(self, offset, limit):
+        """Ключи с позиции offset, не больше limit"""
+        if offset >= self._len or limit <= 0:
+            return []
+        index, position = self._locate(offset)
+        result = []
+        while index < len(self._lists) and len(result) < limit:
+            block = self._lists[index]
+            result.extend(block[position:position + limit - len(result)])
+            index += 1
+            position = 0
+        return result
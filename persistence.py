@@ -0,0 +1,235 @@
+"""
+Фоновое сохранение состояния бота (write-behind)
+Обработчики только помечают данные как измененные, запись на диск
+выполняется отдельным потоком и объединяет серию изменений в одну запись.
+Изменения дописываются в журнал, периодический снимок его компактизирует
+"""
+
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindSaver:
+    """Отложенная запись состояния с флагом изменений и ограничением устаревания"""
+
+    def __init__(self, write_fn, flush_interval=2.0, max_staleness=10.0):
+        # write_fn() выполняет фактическую запись и вызывается только из потока сохранения
+        self._write_fn = write_fn
+        self.flush_interval = flush_interval
+        self.max_staleness = max(max_staleness, flush_interval)
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+        self._dirty = False
+        self._dirty_since = None  # Когда данные впервые стали "грязными"
+        self._last_change = None  # Когда было последнее изменение
+
+        self.flush_count = 0
+        self.changes_since_flush = 0
+
+    def start(self):
+        """Запускает поток сохранения"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+        logger.info(f"Write-behind saver started (flush_interval={self.flush_interval}s, max_staleness={self.max_staleness}s)")
+
+    def mark_dirty(self):
+        """Помечает данные как измененные - дешево, можно вызывать из любого обработчика"""
+        now = time.monotonic()
+        with self._lock:
+            if not self._dirty:
+                self._dirty = True
+                self._dirty_since = now
+            self._last_change = now
+            self.changes_since_flush += 1
+        self._wakeup.set()
+
+    @property
+    def dirty(self):
+        return self._dirty
+
+    def flush(self):
+        """Синхронно записывает данные, если они изменились"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return False
+                # Сбрасываем флаг до записи: изменения во время записи попадут в следующий сброс
+                self._dirty = False
+                self._dirty_since = None
+                changes = self.changes_since_flush
+                self.changes_since_flush = 0
+            try:
+                self._write_fn()
+            except Exception as e:
+                logger.error(f"Write-behind flush failed: {e}", exc_info=True)
+                # Возвращаем флаг, чтобы повторить попытку при следующем сбросе
+                with self._lock:
+                    if not self._dirty:
+                        self._dirty = True
+                        self._dirty_since = time.monotonic()
+                    self.changes_since_flush += changes
+                return False
+            self.flush_count += 1
+            logger.debug(f"Write-behind flush #{self.flush_count} coalesced {changes} change(s)")
+            return True
+
+    def close(self):
+        """Останавливает поток и выполняет финальное сохранение"""
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=30)
+        self._thread = None
+        if self.flush():
+            logger.info("Write-behind saver: final flush completed")
+
+    def _next_deadline(self):
+        """Момент, когда нужно выполнить сброс (или None, если данных для записи нет)"""
+        with self._lock:
+            if not self._dirty:
+                return None
+            # Ждем паузы в изменениях, но не дольше max_staleness с первого изменения
+            return min(self._last_change + self.flush_interval, self._dirty_since + self.max_staleness)
+
+    def _run(self):
+        while not self._stopping:
+            deadline = self._next_deadline()
+            if deadline is None:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            timeout = deadline - time.monotonic()
+            if timeout > 0:
+                self._wakeup.wait(timeout)
+                self._wakeup.clear()
+                continue
+            self.flush()
+
+
+class MutationJournal:
+    """Журнал изменений: каждая мутация - одна компактная строка JSON в конце файла"""
+
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self._file = None
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+            # Если прошлый процесс оборвал запись на середине строки, начинаем с новой строки
+            if self._file.tell() > 0:
+                with open(self.path, 'rb') as tail:
+                    tail.seek(-1, os.SEEK_END)
+                    if tail.read(1) != b'\n':
+                        self._file.write('\n')
+        return self._file
+
+    @property
+    def size(self):
+        """Размер журнала в байтах"""
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def append(self, records):
+        """Дописывает записи в конец журнала одной операцией записи"""
+        if not records:
+            return
+        lines = ''.join(json.dumps(r, ensure_ascii=False, separators=(',', ':')) + '\n' for r in records)
+        f = self._open()
+        f.write(lines)
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+    def replay(self, after_seq=0):
+        """Возвращает записи журнала с номером больше after_seq"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Недописанная строка после аварийной остановки
+                    logger.warning(f"Journal {self.path}: skipping corrupted record at line {line_no}")
+                    continue
+                if record.get('n', 0) > after_seq:
+                    yield record
+
+    def reset(self):
+        """Очищает журнал после записи снимка (компактизация)"""
+        self.close()
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class PhaseTimer:
+    """Замер времени этапов (загрузка при запуске и т.п.)"""
+
+    def __init__(self, name):
+        self.name = name
+        self.phases = []
+        self._started = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+
+    def report(self):
+        """Пишет в лог длительность каждого этапа и общее время"""
+        total = time.perf_counter() - self._started
+        parts = ', '.join(f"{name}={seconds * 1000:.0f}ms" for name, seconds in self.phases)
+        logger.info(f"{self.name} timings: {parts}; total={total * 1000:.0f}ms")
+        return total
+
+
+def apply_journal_record(collections, record):
+    """Применяет запись журнала к коллекциям {имя: dict, set или совместимая коллекция}"""
+    for name in record.get('c', ()):
+        target = collections.get(name)
+        if target is not None:
+            target.clear()
+    for name, key, value in record.get('s', ()):
+        target = collections.get(name)
+        if target is None:
+            continue
+        if hasattr(target, 'add'):
+            # Множество (или совместимая с ним коллекция)
+            if value is None:
+                target.discard(key)
+            else:
+                target.add(key)
+        elif value is None:
+            target.pop(key, None)
+        else:
+            target[key] = value
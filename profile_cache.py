@@ -0,0 +1,98 @@
+"""
+Кэш профилей пользователей Telegram для Eggchain Explorer
+LRU с ограничением размера и временем жизни записей, ошибки кэшируются на
+короткое время. Одновременные запросы одного пользователя ждут одну загрузку
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileCache:
+    """LRU кэш с TTL, кэшированием ошибок и объединением одновременных запросов"""
+
+    def __init__(self, fetch, max_size=10000, ttl=3600, negative_ttl=60, default=None):
+        # fetch(user_id) - корутина загрузки профиля, исключение означает ошибку
+        self._fetch = fetch
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.default = default  # Значение при ошибке загрузки
+        self._entries = OrderedDict()  # user_id -> (истекает, значение, успешно ли загружено)
+        self._inflight = {}  # user_id -> задача загрузки
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.failures = 0
+        self.evictions = 0
+
+    async def get(self, user_id):
+        """Профиль из кэша или из загрузки (одна загрузка на всех одновременных запросивших)"""
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            expires_at, value, ok = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(user_id)
+                if ok:
+                    self.hits += 1
+                else:
+                    self.negative_hits += 1
+                return value
+            del self._entries[user_id]
+
+        task = self._inflight.get(user_id)
+        if task is None:
+            self.misses += 1
+            task = self._inflight[user_id] = asyncio.ensure_future(self._load(user_id))
+        else:
+            self.coalesced += 1
+        # shield: отмена одного запросившего (например, по таймауту) не прерывает общую загрузку
+        return await asyncio.shield(task)
+
+    async def _load(self, user_id):
+        try:
+            value = await self._fetch(user_id)
+            self._put(user_id, value, True)
+        except Exception as e:
+            logger.debug(f"Profile fetch failed for {user_id}: {e}")
+            self.failures += 1
+            value = self.default
+            self._put(user_id, value, False)
+        finally:
+            self._inflight.pop(user_id, None)
+        return value
+
+    def _put(self, user_id, value, ok):
+        ttl = self.ttl if ok else self.negative_ttl
+        if ttl <= 0:
+            return
+        self._entries[user_id] = (time.monotonic() + ttl, value, ok)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+
+    def stats(self):
+        """Счетчики попаданий и промахов"""
+        lookups = self.hits + self.negative_hits + self.misses + self.coalesced
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'failures': self.failures,
+            'evictions': self.evictions,
+            'inflight': len(self._inflight),
+            'hit_ratio': round((self.hits + self.negative_hits + self.coalesced) / lookups, 4) if lookups else 0.0
+        }
@@ -5,7 +5,71 @@
 import json
 import os
 
+from serializers import detect_codec, dump_file
+from storage import SqliteStorage
+
 DATA_FILE = "bot_data.json"
+JOURNAL_FILE = DATA_FILE + ".journal"
+WARM_FILE = DATA_FILE + ".warm"
+SHARD_DIR = os.environ.get('SHARD_DIR', 'bot_data_shards')
+SQLITE_FILE = os.environ.get('SQLITE_FILE', 'bot_data.db')
+
+RESET_COLLECTIONS = [
+    'eggs_hatched_by_user', 'user_eggs_hatched_by_others', 'eggs_sent_by_user', 'daily_eggs_sent',
+    'egg_points', 'hatched_eggs', 'completed_tasks', 'referral_earnings'
+]
+
+def reset_users_table(users):
+    """Обнуляет счетчики в таблице пользователей, сохраняя рефереров и username"""
+    columns = users.get('columns', [])
+    kept = [columns.index(column) + 1 for column in ('referrer', 'username') if column in columns]
+    rows = []
+    for row in users.get('rows', []):
+        if all(row[index] is None for index in kept):
+            continue
+        new_row = [row[0]] + [None if column in ('referrer', 'daily_date', 'username') else 0 for column in columns]
+        for index in kept:
+            new_row[index] = row[index]
+        rows.append(new_row)
+    users['rows'] = rows
+
+def append_reset_to_journal(journal_file, last_seq):
+    """Дописывает сброс в журнал бота, чтобы при запуске он не восстановил старые счетчики"""
+    if not os.path.exists(journal_file):
+        return
+    with open(journal_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                last_seq = max(last_seq, json.loads(line).get('n', 0))
+            except ValueError:
+                continue
+    record = {'n': last_seq + 1, 'op': 'reset', 'c': RESET_COLLECTIONS}
+    with open(journal_file, 'a', encoding='utf-8') as f:
+        f.write('\n' + json.dumps(record, separators=(',', ':')) + '\n')
+
+def reset_shards():
+    """Сброс для хранилища sharded: запись сброса в журнал шардов, бот применит ее при запуске"""
+    manifest_file = os.path.join(SHARD_DIR, 'manifest.json')
+    if not os.path.exists(manifest_file):
+        return
+    with open(manifest_file, 'r', encoding='utf-8') as f:
+        last_seq = json.load(f).get('journal_seq', 0)
+    journal_file = os.path.join(SHARD_DIR, 'journal')
+    if not os.path.exists(journal_file):
+        open(journal_file, 'a').close()
+    append_reset_to_journal(journal_file, last_seq)
+    print(f"OK: Reset recorded in {journal_file}")
+
+def reset_sqlite():
+    """Сброс для хранилища sqlite: те же коллекции очищаются в базе одной транзакцией"""
+    if not os.path.exists(SQLITE_FILE):
+        return
+    storage = SqliteStorage(SQLITE_FILE)
+    try:
+        storage.write_entries([{'op': 'reset', 'c': RESET_COLLECTIONS}])
+    finally:
+        storage.close()
+    print(f"OK: Reset applied to {SQLITE_FILE}")
 
 def reset_all_counters():
     """Полностью сбрасывает все счетчики и бесплатные яйца"""
@@ -30,9 +94,11 @@ def reset_all_counters():
         return
     
     try:
-        # Загружаем данные
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        # Загружаем данные (формат снимка определяется автоматически)
+        with open(DATA_FILE, 'rb') as f:
+            raw = f.read()
+        codec = detect_codec(raw)
+        data = codec.decode(raw)
         
         # Полностью обнуляем все счетчики
         data['eggs_hatched_by_user'] = {}  # Сколько яиц вылупил каждый пользователь
@@ -43,10 +109,16 @@ def reset_all_counters():
         data['hatched_eggs'] = []  # Список вылупленных яиц
         data['completed_tasks'] = {}  # Выполненные задания
         data['referral_earnings'] = {}  # Реферальные заработки
+        if 'users' in data:
+            # Новый формат снимка: все счетчики в одной таблице пользователей
+            reset_users_table(data['users'])
         
-        # Сохраняем обратно
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        # Сохраняем обратно в том же формате
+        dump_file(DATA_FILE, data, codec)
+        append_reset_to_journal(JOURNAL_FILE, data.get('journal_seq', 0))
+        # Бинарный снимок быстрого перезапуска содержит старые счетчики
+        if os.path.exists(WARM_FILE):
+            os.remove(WARM_FILE)
         
         print("OK: All counters and free eggs have been reset!")
         print("\nReset:")
@@ -60,6 +132,7 @@ def reset_all_counters():
         print("- All referral earnings")
         print("\nPreserved:")
         print("- Referral system (who referred whom - referrers)")
+        print("- Username directory")
         print("- TON payment history (ton_payments)")
         
     except Exception as e:
@@ -70,4 +143,6 @@ def reset_all_counters():
 if __name__ == '__main__':
     print("Starting reset of all counters and free eggs...")
     reset_all_counters()
+    reset_shards()
+    reset_sqlite()
     print("\nDone!")
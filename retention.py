@@ -0,0 +1,265 @@
+"""
+Хранение старых яиц: перенос невылупленных яиц по TTL и давно вылупленных
+яиц в сжатый архив на диске
+Архив разбит на сегменты по месяцам (eggs-YYYY-MM.jsonl.gz), каждый сегмент -
+последовательность gzip блоков. Индекс SQLite (index.db) хранит для яйца сегмент и смещение
+блока, а для пользователя - строки его отправленных и вылупленных яиц в архиве
+(Eggchain Explorer показывает их вместе с яйцами в памяти)
+"""
+
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import threading
+import zlib
+from datetime import datetime
+
+from egg_store import split_egg_key, to_epoch
+
+logger = logging.getLogger(__name__)
+
+# Сколько яиц кладется в один gzip блок (блок распаковывается целиком при поиске)
+ARCHIVE_CHUNK_SIZE = 500
+# Вид яиц пользователя в таблице user_eggs
+_KINDS = {'sent': 's', 'hatched': 'h'}
+
+# Результаты classify_egg
+KEEP = 0
+EXPIRE = 1
+ARCHIVE = 2
+
+
+def _parse_timestamp(value):
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_egg(record, now, pending_ttl, archive_after):
+    """Решает, что делать с яйцом (EggRecord): KEEP, EXPIRE (невылупленное - в архив)
+    или ARCHIVE (вылупленное - в архив)
+    now - секунды epoch, pending_ttl и archive_after - секунды (None - не ограничено)"""
+    if not record.is_hatched:
+        if pending_ttl and record.ts_sent and now - record.ts_sent > pending_ttl:
+            return EXPIRE
+        return KEEP
+    if record.is_multi and record.hatched_count < record.max_hatches:
+        # Multi egg со свободными местами еще вылупляют - остается в памяти
+        return KEEP
+    if archive_after and record.ts_hatched and now - record.ts_hatched > archive_after:
+        return ARCHIVE
+    return KEEP
+
+
+def is_open(egg_info):
+    """Можно ли еще вылупить яйцо из архива: невылупленное или multi egg со свободными местами"""
+    if egg_info.get('is_multi'):
+        return (egg_info.get('hatched_count') or 0) < (egg_info.get('max_hatches') or 1)
+    return not egg_info.get('hatched')
+
+
+def _user_entries(egg_key, egg_info):
+    """Строки таблицы user_eggs для яйца: [(вид 's' / 'h', user_id, время, egg_key)]"""
+    entries = []
+    sender_id, _ = split_egg_key(egg_key)
+    if sender_id is not None:
+        entries.append(('s', sender_id, to_epoch(egg_info.get('timestamp_sent')), egg_key))
+    if egg_info.get('is_multi'):
+        hatchers = egg_info.get('hatched_by_list') or []
+    else:
+        hatchers = [egg_info['hatched_by']] if egg_info.get('hatched_by') is not None else []
+    # Как в индексе EggStore: время вылупления каждым пользователем, если оно сохранено
+    times = [to_epoch(value) for value in egg_info.get('hatched_at_list') or []]
+    if len(times) != len(hatchers):
+        times = [to_epoch(egg_info.get('timestamp_hatched'))] * len(hatchers)
+    for user_id, ts in zip(hatchers, times):
+        entries.append(('h', int(user_id), ts, egg_key))
+    return entries
+
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS eggs (
+    egg_key TEXT PRIMARY KEY,
+    egg_id TEXT,
+    segment TEXT NOT NULL,
+    block INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_eggs_egg_id ON eggs(egg_id);
+
+CREATE TABLE IF NOT EXISTS user_eggs (
+    kind TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    egg_key TEXT NOT NULL,
+    PRIMARY KEY (kind, user_id, ts, egg_key)
+) WITHOUT ROWID;
+"""
+
+
+class EggArchive:
+    """Сжатый архив яиц с индексом SQLite: egg_key/egg_id -> блок архива и яйца пользователей"""
+
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        os.makedirs(archive_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(archive_dir, 'index.db'), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(ARCHIVE_SCHEMA)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.archive_dir, f"eggs-{segment}.jsonl.gz")
+
+    def archive(self, eggs):
+        """Дописывает яйца [(egg_key, egg_info), ...] в сегменты архива и индекс"""
+        by_segment = {}
+        for egg_key, egg_info in eggs:
+            moment = _parse_timestamp(egg_info.get('timestamp_hatched')) or _parse_timestamp(egg_info.get('timestamp_sent'))
+            segment = moment.strftime('%Y-%m') if moment else 'unknown'
+            by_segment.setdefault(segment, []).append((egg_key, egg_info))
+
+        with self._lock:
+            rows = []
+            for segment, items in by_segment.items():
+                path = self._segment_path(segment)
+                with open(path, 'ab') as f:
+                    for start in range(0, len(items), ARCHIVE_CHUNK_SIZE):
+                        chunk = items[start:start + ARCHIVE_CHUNK_SIZE]
+                        offset = f.tell()
+                        lines = ''.join(
+                            json.dumps(dict(info, egg_key=key), ensure_ascii=False, separators=(',', ':')) + '\n'
+                            for key, info in chunk
+                        )
+                        # Каждый блок - отдельный gzip member, его можно распаковать по смещению
+                        f.write(gzip.compress(lines.encode('utf-8')))
+                        rows.extend((key, info.get('egg_id'), segment, offset) for key, info in chunk)
+                    f.flush()
+                    os.fsync(f.fileno())
+            # Индекс записывается после сброса сегментов на диск, одной транзакцией
+            with self._conn:
+                # INSERT OR REPLACE дает строке новый rowid - по egg_id находится последнее яйцо
+                self._conn.executemany("INSERT OR REPLACE INTO eggs VALUES (?, ?, ?, ?)", rows)
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO user_eggs VALUES (?, ?, ?, ?)",
+                    [entry for egg_key, egg_info in eggs for entry in _user_entries(egg_key, egg_info)]
+                )
+        logger.info(f"Archived {len(eggs)} egg(s) into {len(by_segment)} segment(s) in {self.archive_dir}")
+
+    def contains(self, egg_key):
+        """Есть ли яйцо в архиве"""
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM eggs WHERE egg_key = ?", (egg_key,)).fetchone() is not None
+
+    def lookup(self, egg_id):
+        """Ищет яйцо по egg_key или короткому egg_id, возвращает (egg_key, egg_info) или None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT egg_key FROM eggs WHERE egg_key = ? UNION ALL "
+                "SELECT * FROM (SELECT egg_key FROM eggs WHERE egg_id = ? ORDER BY rowid DESC LIMIT 1)",
+                (egg_id, egg_id)
+            ).fetchone()
+            if row is None:
+                return None
+            egg_key = row[0]
+            info = self._read_infos([egg_key]).get(egg_key)
+        return (egg_key, info) if info is not None else None
+
+    def lookup_many(self, egg_keys):
+        """Записи яиц по egg_key: {egg_key: egg_info} (каждый блок распаковывается один раз)"""
+        with self._lock:
+            return self._read_infos(egg_keys)
+
+    def restore(self, egg_key):
+        """Забирает из архива яйцо, которое еще можно вылупить (is_open): egg_info или None"""
+        with self._lock:
+            info = self._read_infos([egg_key]).get(egg_key)
+            if info is None or not is_open(info):
+                return None
+            with self._conn:
+                self._remove(egg_key, info)
+        logger.info(f"Restored egg {egg_key} from {self.archive_dir}")
+        return info
+
+    def remove(self, eggs):
+        """Убирает яйца [(egg_key, egg_info), ...] из индекса (записи в сегментах остаются)"""
+        with self._lock:
+            with self._conn:
+                for egg_key, egg_info in eggs:
+                    self._remove(egg_key, egg_info)
+
+    def user_page(self, kind, user_id, limit, cursor=None):
+        """Страница архивных яиц пользователя ('sent' / 'hatched') от новых к старым:
+        (([(время, egg_key)], курсор следующей страницы), всего в архиве, {egg_key: egg_info})"""
+        kind = _KINDS[kind]
+        with self._lock:
+            if cursor is None:
+                rows = self._conn.execute(
+                    "SELECT ts, egg_key FROM user_eggs WHERE kind = ? AND user_id = ? "
+                    "ORDER BY ts DESC, egg_key DESC LIMIT ?",
+                    (kind, user_id, limit + 1)
+                ).fetchall()
+            else:
+                rows = self._conn.execute(
+                    "SELECT ts, egg_key FROM user_eggs WHERE kind = ? AND user_id = ? AND (ts, egg_key) < (?, ?) "
+                    "ORDER BY ts DESC, egg_key DESC LIMIT ?",
+                    (kind, user_id, cursor[0], cursor[1], limit + 1)
+                ).fetchall()
+            total = self._conn.execute(
+                "SELECT COUNT(*) FROM user_eggs WHERE kind = ? AND user_id = ?", (kind, user_id)
+            ).fetchone()[0]
+            entries = [tuple(row) for row in rows[:limit]]
+            infos = self._read_infos([egg_key for _, egg_key in entries])
+        # Курсор - последняя выданная запись, как у page_entries
+        next_cursor = entries[-1] if len(rows) > limit else None
+        return (entries, next_cursor), total, infos
+
+    def _remove(self, egg_key, egg_info):
+        """Удаляет яйцо из индекса (под self._lock, внутри транзакции)"""
+        self._conn.execute("DELETE FROM eggs WHERE egg_key = ?", (egg_key,))
+        self._conn.executemany(
+            "DELETE FROM user_eggs WHERE kind = ? AND user_id = ? AND ts = ? AND egg_key = ?",
+            _user_entries(egg_key, egg_info)
+        )
+
+    def _read_infos(self, egg_keys):
+        """Читает записи яиц, группируя их по блокам (под self._lock)"""
+        by_location = {}
+        for egg_key in egg_keys:
+            row = self._conn.execute("SELECT segment, block FROM eggs WHERE egg_key = ?", (egg_key,)).fetchone()
+            if row is not None:
+                by_location.setdefault(tuple(row), set()).add(egg_key)
+        infos = {}
+        for (segment, offset), wanted in by_location.items():
+            block = self._read_block(self._segment_path(segment), offset)
+            for line in block.splitlines():
+                info = json.loads(line)
+                egg_key = info.pop('egg_key', None)
+                if egg_key in wanted:
+                    # Раньше в архив попадали только вылупленные яйца, без признака 'hatched'
+                    info.setdefault('hatched', not info.get('is_multi'))
+                    infos[egg_key] = info
+        return infos
+
+    def _read_block(self, path, offset):
+        """Распаковывает один gzip блок начиная со смещения"""
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        parts = []
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while not decompressor.eof:
+                data = f.read(64 * 1024)
+                if not data:
+                    break
+                parts.append(decompressor.decompress(data))
+        return b''.join(parts).decode('utf-8')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
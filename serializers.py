@@ -0,0 +1,151 @@
+"""
+Форматы файлов снимка состояния
+json   - компактный JSON (без отступов)
+orjson - тот же JSON через orjson, если он установлен
+binary - бинарный формат: секции верхнего уровня (JSON + zlib) с префиксом длины
+При чтении формат определяется по первым байтам файла
+"""
+
+import io
+import json
+import logging
+import os
+import pickle
+import struct
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+BINARY_MAGIC = b'EGGSNAP2'
+# Прежний бинарный формат с секциями pickle - только чтение, для перехода на новый
+LEGACY_BINARY_MAGIC = b'EGGSNAP1'
+
+
+class JsonCodec:
+    """Компактный JSON"""
+
+    name = 'json'
+
+    def encode(self, obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def decode(self, raw):
+        return json.loads(raw)
+
+
+class OrjsonCodec:
+    """JSON через orjson (в разы быстрее стандартного json)"""
+
+    name = 'orjson'
+
+    def encode(self, obj):
+        # OPT_NON_STR_KEYS - ключи user_id (int) пишутся строками, как в json
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    def decode(self, raw):
+        return orjson.loads(raw)
+
+
+class BinaryCodec:
+    """Магия, длина и JSON заголовок со списком секций, затем секции JSON + zlib.
+    Секции - те же данные, что в JSON снимке: читаются на любой платформе и ничего не исполняют.
+    Выигрыш перед json - меньший файл и разбор orjson, если он установлен"""
+
+    name = 'binary'
+
+    def encode(self, obj):
+        blobs = [(name, zlib.compress(_section_codec().encode(value), 1)) for name, value in obj.items()]
+        head = json.dumps({'sections': [[name, len(blob)] for name, blob in blobs]}).encode('utf-8')
+        return b''.join([BINARY_MAGIC, struct.pack('>I', len(head)), head] + [blob for _, blob in blobs])
+
+    def decode(self, raw):
+        raw = memoryview(raw)
+        magic = bytes(raw[:len(BINARY_MAGIC)])
+        if magic not in (BINARY_MAGIC, LEGACY_BINARY_MAGIC):
+            raise ValueError("not a binary snapshot")
+        offset = len(BINARY_MAGIC)
+        (head_len,) = struct.unpack_from('>I', raw, offset)
+        offset += 4
+        header = json.loads(bytes(raw[offset:offset + head_len]))
+        offset += head_len
+        decode_section = _decode_section if magic == BINARY_MAGIC else _decode_legacy_section
+        sections = {}
+        for name, size in header['sections']:
+            sections[name] = decode_section(raw[offset:offset + size])
+            offset += size
+        return sections
+
+
+def _section_codec():
+    return CODECS['orjson'] if orjson is not None else CODECS['json']
+
+
+def _decode_section(blob):
+    return _section_codec().decode(zlib.decompress(blob))
+
+
+class _PrimitiveUnpickler(pickle.Unpickler):
+    """Разбирает только словари, списки, строки и числа: ссылки на классы и функции запрещены"""
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"{module}.{name} is not allowed in a snapshot")
+
+
+def _decode_legacy_section(blob):
+    return _PrimitiveUnpickler(io.BytesIO(zlib.decompress(blob))).load()
+
+
+CODECS = {
+    'json': JsonCodec(),
+    'orjson': OrjsonCodec(),
+    'binary': BinaryCodec()
+}
+
+
+def get_codec(name):
+    """Кодек по имени; orjson без установленного пакета заменяется на json"""
+    if name == 'orjson' and orjson is None:
+        logger.warning("orjson is not installed, using json snapshot format")
+        name = 'json'
+    if name not in CODECS:
+        logger.warning(f"Unknown snapshot format '{name}', using json")
+        name = 'json'
+    return CODECS[name]
+
+
+def detect_codec(raw):
+    """Кодек для чтения по первым байтам данных"""
+    if raw[:len(BINARY_MAGIC)] in (BINARY_MAGIC, LEGACY_BINARY_MAGIC):
+        return CODECS['binary']
+    # JSON файлы любого кодека читаются самым быстрым доступным парсером
+    return CODECS['orjson'] if orjson is not None else CODECS['json']
+
+
+def load_file(path):
+    """Читает файл снимка в любом формате"""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    return detect_codec(raw).decode(raw)
+
+
+def dump_file(path, obj, codec):
+    """Атомарно записывает файл снимка: временный файл, fsync, переименование"""
+    temp_file = path + '.tmp'
+    try:
+        with open(temp_file, 'wb') as f:
+            f.write(codec.encode(obj))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, path)
+    except Exception:
+        if os.path.exists(temp_file):
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
+        raise
@@ -0,0 +1,849 @@
+"""
+Хранилища состояния бота
+json    - снимок bot_data.json + журнал изменений (по умолчанию)
+sharded - снимок разбит на шарды по коллекциям и диапазонам user_id, переписываются только измененные
+sqlite  - база SQLite в режиме WAL со схемой eggs/users из INTEGRATION.md
+Выбирается переменной окружения STORAGE_BACKEND
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from egg_store import EggStore, split_egg_key
+from egg_store import legacy_collections as legacy_egg_collections
+from persistence import MutationJournal, PhaseTimer, apply_journal_record
+from serializers import CODECS, detect_codec, dump_file, get_codec, load_file
+from user_store import LEGACY_FIELDS, USER_FIELDS, UserStore, flags_to_tasks, tasks_to_flags
+from user_store import legacy_collections as legacy_user_collections
+
+logger = logging.getLogger(__name__)
+
+# Коллекции состояния, изменения которых попадают в хранилище
+COLLECTIONS = ('eggs', 'users', 'ton_payments')
+
+
+def default_state():
+    """Возвращает пустое состояние"""
+    return {
+        'eggs': EggStore(),
+        'users': UserStore(),
+        'ton_payments': {},
+        'journal_seq': 0
+    }
+
+
+def collection_items(collection):
+    """Пары (ключ, значение) коллекции в формате журнала"""
+    if isinstance(collection, EggStore):
+        return ((egg_key, collection.to_dict(egg_key, record)) for egg_key, record in collection.items())
+    if isinstance(collection, UserStore):
+        return ((user_id, record.to_row()) for user_id, record in collection.items())
+    if isinstance(collection, set):
+        return ((key, 1) for key in collection)
+    return collection.items()
+
+
+def _int_keys(raw, name):
+    """Конвертирует ключи словаря в int (JSON сохраняет ключи как строки)"""
+    converted = {}
+    for key, value in raw.items():
+        try:
+            converted[int(key)] = value
+        except (ValueError, TypeError):
+            logger.warning(f"Invalid {name} entry: {key} -> {value}, skipping")
+    return converted
+
+
+def _warn_invalid(name, key, value):
+    logger.warning(f"Invalid {name} entry: {key} -> {value}, skipping")
+
+
+def _load_users(data):
+    """Таблица пользователей из снимка (или из прежних словарей по пользователям)"""
+    if 'users' in data:
+        return UserStore.from_table(data['users'])
+    return UserStore.from_legacy(data, on_invalid=_warn_invalid)
+
+
+class JsonStorage:
+    """Снимок состояния в JSON файле и журнал изменений после него"""
+
+    name = 'json'
+    sharded = False
+
+    def __init__(self, data_file, snapshot_interval=6 * 3600, journal_max_bytes=8 * 1024 * 1024, warm_snapshot=True,
+                 snapshot_format='json'):
+        self.data_file = data_file
+        # Формат записи снимка; при чтении формат определяется автоматически
+        self.codec = get_codec(snapshot_format)
+        self.snapshot_interval = snapshot_interval
+        self.journal_max_bytes = journal_max_bytes
+        self.journal = MutationJournal(data_file + '.journal')
+        # Бинарный снимок, который пишется при штатной остановке для быстрого перезапуска
+        self.warm_file = data_file + '.warm'
+        self.warm_snapshot = warm_snapshot
+        self.last_snapshot_time = time.monotonic()
+
+    def load(self, timer=None):
+        """Загружает снимок и догоняет его записями журнала"""
+        timer = timer or PhaseTimer('Load')
+        logger.info(f"Loading data from: {self.data_file}")
+        logger.info(f"Current working directory: {os.getcwd()}")
+        logger.info(f"File exists: {os.path.exists(self.data_file)}")
+
+        state = None
+        if self.warm_snapshot and os.path.exists(self.warm_file):
+            try:
+                with timer.phase('warm_snapshot'):
+                    state = self._load_warm()
+                logger.info(f"Loaded warm snapshot {self.warm_file} (journal seq {state['journal_seq']})")
+            except Exception as e:
+                logger.error(f"Error loading warm snapshot {self.warm_file}, falling back to {self.data_file}: {e}", exc_info=True)
+                state = None
+
+        if state is None:
+            state = self._load_json(timer)
+
+        # Догоняем снимок изменениями из журнала
+        with timer.phase('journal'):
+            self._replay_journal(state)
+        return state
+
+    def _load_warm(self):
+        """Состояние из бинарного снимка"""
+        sections = load_file(self.warm_file)
+        return {
+            'eggs': EggStore.from_columns(sections['eggs']),
+            'users': UserStore.from_table(sections['users']),
+            'ton_payments': _int_keys(sections['ton_payments'], 'ton_payments'),
+            'journal_seq': int(sections.get('journal_seq', 0))
+        }
+
+    def _load_json(self, timer):
+        """Состояние из JSON снимка"""
+        if os.path.exists(self.data_file):
+            try:
+                logger.info(f"Data file size: {os.path.getsize(self.data_file)} bytes")
+                with timer.phase('read'):
+                    with open(self.data_file, 'rb') as f:
+                        raw = f.read()
+                with timer.phase('parse'):
+                    codec = detect_codec(raw)
+                    data = codec.decode(raw)
+                del raw
+                logger.info(f"Snapshot format: {codec.name}")
+
+                with timer.phase('decode'):
+                    state = {
+                        # Яйца хранятся в файле в прежнем формате eggs_detail / hatched_eggs / multi_eggs
+                        'eggs': EggStore.from_legacy(
+                            data.get('eggs_detail', {}),  # {egg_key: {sender_id, egg_id, hatched_by, timestamp_sent, timestamp_hatched, is_multi, max_hatches, hatched_count, hatched_by_list, hatched_at_list}}
+                            data.get('hatched_eggs', []),
+                            data.get('multi_eggs', {})  # {egg_key: {hatched_by_list: [user_id1, user_id2, ...], hatched_count: int}}
+                        ),
+                        'users': _load_users(data),  # {user_id: UserRecord} - счетчики, поинты, реферер, задания
+                        'ton_payments': _int_keys(data.get('ton_payments', {}), 'ton_payments'),  # {user_id: [{'date': '2024-01-01', 'amount': 0.1, 'tx_hash': '...'}]}
+                        'journal_seq': int(data.get('journal_seq', 0))  # Последняя запись журнала, вошедшая в снимок
+                    }
+
+                # Логируем загруженные данные для отладки
+                users = state['users']
+                logger.info(f"Loaded data: {users.count_with('points')} users with points, {users.count_with('referrer')} referrers")
+            except Exception as e:
+                logger.error(f"Error loading data from {self.data_file}: {e}", exc_info=True)
+                return default_state()
+            return state
+        logger.warning(f"Data file {self.data_file} does not exist, using default data")
+        return default_state()
+
+    def _replay_journal(self, state):
+        """Применяет к загруженному снимку записи журнала, сделанные после него"""
+        collections = {name: state[name] for name in COLLECTIONS}
+        # Записи, сделанные до EggStore и UserStore, ссылаются на прежние коллекции
+        collections.update(legacy_egg_collections(state['eggs']))
+        collections.update(legacy_user_collections(state['users']))
+        replayed = 0
+        for record in self.journal.replay(state['journal_seq']):
+            apply_journal_record(collections, record)
+            state['journal_seq'] = max(state['journal_seq'], record.get('n', 0))
+            replayed += 1
+        if replayed:
+            logger.info(f"Replayed {replayed} journal record(s) from {self.journal.path}, last seq {state['journal_seq']}")
+
+    def wants_snapshot(self, force=False):
+        """Нужно ли свернуть журнал в снимок"""
+        return (
+            force
+            or self.journal.size >= self.journal_max_bytes
+            or time.monotonic() - self.last_snapshot_time >= self.snapshot_interval
+        )
+
+    def write_entries(self, entries):
+        """Дописывает записи мутаций в журнал"""
+        self.journal.append(entries)
+
+    def write_snapshot(self, data, journal_seq):
+        """Записывает снимок данных в файл и очищает журнал"""
+        data['journal_seq'] = journal_seq
+        try:
+            # Логируем что сохраняем
+            users_count = len(data['users']['rows'])
+            eggs_count = len(data['eggs_detail'])
+            logger.info(f"Saving data to {self.data_file}: {users_count} users, {eggs_count} eggs")
+
+            # Временный файл, потом атомарное переименование
+            started = time.perf_counter()
+            dump_file(self.data_file, data, self.codec)
+
+            file_size = os.path.getsize(self.data_file)
+            logger.info(
+                f"Data saved successfully to {self.data_file} "
+                f"(format: {self.codec.name}, size: {file_size} bytes, {(time.perf_counter() - started) * 1000:.0f}ms)"
+            )
+        except Exception as e:
+            logger.error(f"Error saving data to {self.data_file}: {e}", exc_info=True)
+            # Пробрасываем ошибку, чтобы поток сохранения повторил запись
+            raise
+
+        # Снимок уже содержит все изменения из журнала
+        self.journal.reset()
+        self.last_snapshot_time = time.monotonic()
+        # Бинарный снимок старее нового JSON снимка - при запуске он больше не нужен
+        if os.path.exists(self.warm_file):
+            os.remove(self.warm_file)
+
+    def write_warm_snapshot(self, sections, journal_seq):
+        """Пишет бинарный снимок для быстрого перезапуска (после финального JSON снимка)"""
+        if not self.warm_snapshot:
+            return
+        started = time.perf_counter()
+        dump_file(self.warm_file, dict(sections, journal_seq=journal_seq), CODECS['binary'])
+        logger.info(
+            f"Warm snapshot saved to {self.warm_file} "
+            f"({os.path.getsize(self.warm_file)} bytes, {(time.perf_counter() - started) * 1000:.0f}ms)"
+        )
+
+    def close(self):
+        self.journal.close()
+
+
+# Прежние имена коллекций (журналы и сбросы до EggStore / UserStore) -> коллекция шарда
+SHARD_COLLECTIONS = dict(
+    {'eggs_detail': 'eggs', 'hatched_eggs': 'eggs', 'multi_eggs': 'eggs', 'daily_eggs_sent': 'users', 'completed_tasks': 'users'},
+    **{name: 'users' for name in LEGACY_FIELDS},
+    **{name: name for name in COLLECTIONS}
+)
+
+
+class ShardedStorage:
+    """Снимок, разбитый на файлы по коллекциям и группам user_id, и общий журнал после него.
+    Шард помечается измененным при записи мутации, при компактизации переписываются
+    только измененные шарды - объем записи зависит от изменений, а не от размера состояния"""
+
+    name = 'sharded'
+    sharded = True
+
+    def __init__(self, shard_dir, buckets=16, snapshot_interval=6 * 3600, journal_max_bytes=8 * 1024 * 1024,
+                 snapshot_format='json', legacy_storage=None):
+        self.shard_dir = shard_dir
+        os.makedirs(shard_dir, exist_ok=True)
+        self.manifest_file = os.path.join(shard_dir, 'manifest.json')
+        self.buckets = max(1, buckets)
+        self.codec = get_codec(snapshot_format)
+        self.snapshot_interval = snapshot_interval
+        self.journal_max_bytes = journal_max_bytes
+        self.journal = MutationJournal(os.path.join(shard_dir, 'journal'))
+        # Хранилище, из которого данные переносятся при первом запуске
+        self.legacy_storage = legacy_storage
+        self.last_snapshot_time = time.monotonic()
+        self._dirty = set()  # {(коллекция, номер шарда)}
+        # (коллекция, номер шарда) -> ключи, попавшие в шард: компактизация не перебирает коллекции.
+        # Удаленные ключи остаются до перезаписи шарда
+        self._members = {}
+        self._stale_buckets = 0  # Число шардов до смены SHARD_BUCKETS - лишние файлы удаляются после перезаписи
+
+    def shard_file(self, collection, bucket):
+        return os.path.join(self.shard_dir, f"{collection}.{bucket:03d}.shard")
+
+    def bucket_of(self, collection, key):
+        """Номер шарда элемента: по user_id (для яиц - по отправителю из ключа)"""
+        if collection == 'eggs':
+            key = split_egg_key(key)[0]
+        try:
+            return int(key) % self.buckets
+        except (TypeError, ValueError):
+            return 0
+
+    def mark_dirty(self, keys=(), cleared=()):
+        """Помечает шарды, затронутые мутацией: keys - пары (коллекция, ключ)"""
+        for name in cleared:
+            collection = SHARD_COLLECTIONS.get(name)
+            if collection is not None:
+                # Наборы ключей не очищаются: у пользователей сбрасываются поля, а не записи
+                self._dirty.update((collection, bucket) for bucket in range(self.buckets))
+        for name, key in keys:
+            collection = SHARD_COLLECTIONS.get(name)
+            if collection is not None:
+                if collection != 'eggs':
+                    try:
+                        key = int(key)
+                    except (TypeError, ValueError):
+                        pass
+                bucket = (collection, self.bucket_of(collection, key))
+                self._dirty.add(bucket)
+                self._members.setdefault(bucket, set()).add(key)
+
+    def _track_members(self, collections):
+        """Раскладывает ключи загруженных коллекций по шардам (один раз при запуске)"""
+        self._members = {}
+        for collection in COLLECTIONS:
+            for key in list(collections[collection]):
+                self._members.setdefault((collection, self.bucket_of(collection, key)), set()).add(key)
+
+    def _mark_record(self, record):
+        self.mark_dirty([(name, key) for name, key, _ in record.get('s', ())], record.get('c', ()))
+
+    def load(self, timer=None):
+        """Загружает шарды и догоняет их записями журнала"""
+        timer = timer or PhaseTimer('Load')
+        logger.info(f"Loading data from shards: {self.shard_dir}")
+        if not os.path.exists(self.manifest_file):
+            with timer.phase('migrate'):
+                return self._migrate()
+
+        manifest = load_file(self.manifest_file)
+        state = default_state()
+        state['journal_seq'] = int(manifest.get('journal_seq', 0))
+        stored_buckets = int(manifest.get('buckets', self.buckets))
+        with timer.phase('shards'):
+            for collection in COLLECTIONS:
+                for bucket in range(stored_buckets):
+                    path = self.shard_file(collection, bucket)
+                    if os.path.exists(path):
+                        self._load_shard(state, collection, load_file(path))
+            state['eggs'].sort_indexes()
+        if stored_buckets != self.buckets:
+            # Число шардов изменилось - при следующей компактизации все шарды переписываются
+            logger.info(f"Resharding {self.shard_dir}: {stored_buckets} -> {self.buckets} buckets")
+            self._stale_buckets = stored_buckets
+            self.mark_dirty(cleared=COLLECTIONS)
+
+        with timer.phase('journal'):
+            replayed = 0
+            collections = {name: state[name] for name in COLLECTIONS}
+            collections.update(legacy_egg_collections(state['eggs']))
+            collections.update(legacy_user_collections(state['users']))
+            for record in self.journal.replay(state['journal_seq']):
+                apply_journal_record(collections, record)
+                # Восстановленные из журнала изменения еще не записаны в шарды
+                self._mark_record(record)
+                state['journal_seq'] = max(state['journal_seq'], record.get('n', 0))
+                replayed += 1
+        if replayed:
+            logger.info(f"Replayed {replayed} journal record(s) from {self.journal.path}, last seq {state['journal_seq']}")
+        self._track_members(state)
+
+        users = state['users']
+        logger.info(
+            f"Loaded data from shards: {users.count_with('points')} users with points, "
+            f"{users.count_with('referrer')} referrers, {len(state['eggs'])} eggs"
+        )
+        return state
+
+    def _load_shard(self, state, collection, shard):
+        if collection == 'eggs':
+            state['eggs'].load_columns(shard['eggs'])
+        elif collection == 'users':
+            state['users'].load_table(shard['users'])
+        else:
+            state['ton_payments'].update(_int_keys(shard['ton_payments'], 'ton_payments'))
+
+    def _migrate(self):
+        """Первый запуск: переносит данные из JSON хранилища и пишет все шарды"""
+        state = self.legacy_storage.load() if self.legacy_storage is not None else default_state()
+        self.mark_dirty(cleared=COLLECTIONS)
+        self._track_members(state)
+        self.write_shards({name: state[name] for name in COLLECTIONS}, state['journal_seq'])
+        logger.info(f"Migrated {len(state['eggs'])} eggs and {len(state['users'])} users into {self.shard_dir}")
+        return state
+
+    def wants_snapshot(self, force=False):
+        """Нужно ли переписать измененные шарды и очистить журнал"""
+        return (
+            force
+            or self.journal.size >= self.journal_max_bytes
+            or time.monotonic() - self.last_snapshot_time >= self.snapshot_interval
+        )
+
+    def write_entries(self, entries):
+        """Дописывает записи мутаций в журнал и помечает затронутые шарды"""
+        self.journal.append(entries)
+        for entry in entries:
+            self._mark_record(entry)
+
+    def write_shards(self, collections, journal_seq):
+        """Переписывает измененные шарды из живых коллекций и очищает журнал"""
+        dirty = sorted(self._dirty)
+        if dirty:
+            started = time.perf_counter()
+            written = 0
+            try:
+                for collection, bucket, shard in self._build_shards(collections, dirty):
+                    dump_file(self.shard_file(collection, bucket), shard, self.codec)
+                    # Шард записан - при ошибке на следующем повторяются только оставшиеся
+                    self._dirty.discard((collection, bucket))
+                    written += 1
+            except Exception as e:
+                logger.error(f"Error saving shards to {self.shard_dir}: {e}", exc_info=True)
+                # Пробрасываем ошибку, чтобы поток сохранения повторил запись
+                raise
+            logger.info(
+                f"Saved {written} of {len(COLLECTIONS) * self.buckets} shard(s) to {self.shard_dir} "
+                f"(format: {self.codec.name}, {(time.perf_counter() - started) * 1000:.0f}ms)"
+            )
+
+        # Журнал очищается только после записи всех измененных шардов и манифеста
+        dump_file(self.manifest_file, {'buckets': self.buckets, 'journal_seq': journal_seq}, CODECS['json'])
+        self.journal.reset()
+        self.last_snapshot_time = time.monotonic()
+        if self._stale_buckets > self.buckets:
+            for collection in COLLECTIONS:
+                for bucket in range(self.buckets, self._stale_buckets):
+                    if os.path.exists(self.shard_file(collection, bucket)):
+                        os.remove(self.shard_file(collection, bucket))
+        self._stale_buckets = 0
+
+    def _build_shards(self, collections, dirty):
+        """Содержимое измененных шардов: (коллекция, номер, данные)"""
+        for collection, bucket in dirty:
+            # Ключи шарда берутся из его набора, удаленные из коллекции выбрасываются
+            members = self._members.setdefault((collection, bucket), set())
+            keys = []
+            removed = []
+            for key in list(members):
+                (keys if key in collections[collection] else removed).append(key)
+            members.difference_update(removed)
+            if collection == 'eggs':
+                shard = {'eggs': collections['eggs'].to_columns(keys)}
+            elif collection == 'users':
+                shard = {'users': collections['users'].to_table(keys)}
+            else:
+                payments = collections['ton_payments']
+                shard = {'ton_payments': {
+                    user_id: [dict(p) for p in list(payments[user_id])] for user_id in keys if user_id in payments
+                }}
+            yield collection, bucket, shard
+
+    def write_warm_snapshot(self, sections, journal_seq):
+        # Шарды и так читаются без полного JSON снимка
+        pass
+
+    def close(self):
+        self.journal.close()
+
+
+def _replay_eggs(eggs, journal_path, journal_seq):
+    """Догоняет яйца снимка записями журнала (изменения пользователей пропускаются)"""
+    collections = {'eggs': eggs}
+    collections.update(legacy_egg_collections(eggs))
+    for record in MutationJournal(journal_path).replay(journal_seq):
+        apply_journal_record(collections, record)
+
+
+def read_json_eggs(data_file):
+    """Читает яйца из снимка и журнала для Eggchain Explorer (в формате eggs_detail / hatched_eggs)"""
+    data = load_file(data_file)
+    eggs = EggStore.from_legacy(data.get('eggs_detail', {}), data.get('hatched_eggs', []), data.get('multi_eggs', {}))
+    _replay_eggs(eggs, data_file + '.journal', int(data.get('journal_seq', 0)))
+    eggs_detail, hatched_eggs, _ = eggs.export_legacy()
+    return {'eggs_detail': eggs_detail, 'hatched_eggs': hatched_eggs}
+
+
+def read_shard_eggs(shard_dir):
+    """Читает яйца из шардов и журнала для Eggchain Explorer (в формате eggs_detail / hatched_eggs)"""
+    manifest = load_file(os.path.join(shard_dir, 'manifest.json'))
+    eggs = EggStore()
+    for bucket in range(int(manifest.get('buckets', 0))):
+        path = os.path.join(shard_dir, f"eggs.{bucket:03d}.shard")
+        if os.path.exists(path):
+            eggs.load_columns(load_file(path)['eggs'])
+    eggs.sort_indexes()
+    _replay_eggs(eggs, os.path.join(shard_dir, 'journal'), int(manifest.get('journal_seq', 0)))
+    eggs_detail, hatched_eggs, _ = eggs.export_legacy()
+    return {'eggs_detail': eggs_detail, 'hatched_eggs': hatched_eggs}
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS eggs (
+    egg_key TEXT PRIMARY KEY,
+    egg_id TEXT,
+    sender_id INTEGER,
+    recipient_id INTEGER,
+    hatched_by INTEGER,
+    timestamp_sent TEXT,
+    timestamp_hatched TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    is_multi INTEGER NOT NULL DEFAULT 0,
+    max_hatches INTEGER NOT NULL DEFAULT 1,
+    hatched_count INTEGER NOT NULL DEFAULT 0,
+    hatched_by_list TEXT,
+    hatched_at_list TEXT
+);
+
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    eggs_hatched INTEGER,
+    eggs_hatched_by_others INTEGER,
+    eggs_sent INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS points (
+    user_id INTEGER PRIMARY KEY,
+    points INTEGER,
+    referral_earnings INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS referrals (
+    user_id INTEGER PRIMARY KEY,
+    referrer_id INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS daily_quotas (
+    user_id INTEGER PRIMARY KEY,
+    date TEXT,
+    count INTEGER NOT NULL DEFAULT 0,
+    paid_eggs INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS tasks (
+    user_id INTEGER NOT NULL,
+    task TEXT NOT NULL,
+    PRIMARY KEY (user_id, task)
+);
+
+CREATE TABLE IF NOT EXISTS payments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    tx_hash TEXT,
+    date TEXT,
+    amount REAL,
+    eggs INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_eggs_sender ON eggs(sender_id);
+CREATE INDEX IF NOT EXISTS idx_eggs_hatched_by ON eggs(hatched_by);
+CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id);
+CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(user_id);
+"""
+
+# Прежние коллекции-счетчики -> колонки таблиц users и points (для сброса отдельных счетчиков)
+SQLITE_COLUMNS = {
+    'eggs_hatched_by_user': ('users', 'eggs_hatched'),
+    'user_eggs_hatched_by_others': ('users', 'eggs_hatched_by_others'),
+    'eggs_sent_by_user': ('users', 'eggs_sent'),
+    'egg_points': ('points', 'points'),
+    'referral_earnings': ('points', 'referral_earnings')
+}
+
+
+def _connect_sqlite(db_file, readonly=False):
+    """Открывает соединение с базой в режиме WAL"""
+    if readonly:
+        conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True, check_same_thread=False)
+    else:
+        conn = sqlite3.connect(db_file, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def _egg_from_row(row):
+    """Строка таблицы eggs -> запись eggs_detail"""
+    (egg_key, egg_id, sender_id, hatched_by, ts_sent, ts_hatched, status, is_multi, max_hatches, hatched_count,
+     hatched_list, hatched_at_list) = row
+    return {
+        'sender_id': sender_id,
+        'egg_id': egg_id,
+        'hatched_by': hatched_by,
+        'timestamp_sent': ts_sent,
+        'timestamp_hatched': ts_hatched,
+        'is_multi': bool(is_multi),
+        'max_hatches': max_hatches,
+        'hatched_count': hatched_count,
+        'hatched_by_list': json.loads(hatched_list) if hatched_list else [],
+        'hatched_at_list': json.loads(hatched_at_list) if hatched_at_list else []
+    }
+
+
+EGG_COLUMNS = (
+    "egg_key, egg_id, sender_id, hatched_by, timestamp_sent, timestamp_hatched, "
+    "status, is_multi, max_hatches, hatched_count, hatched_by_list, hatched_at_list"
+)
+
+
+class SqliteStorage:
+    """Хранилище в SQLite: изменения пишутся пачками в одной транзакции"""
+
+    name = 'sqlite'
+    sharded = False
+
+    def __init__(self, db_file, legacy_storage=None):
+        self.db_file = db_file
+        self.conn = _connect_sqlite(db_file)
+        self.conn.executescript(SQLITE_SCHEMA)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(eggs)")]
+        if 'detail' in columns:
+            # Колонка прежних версий схемы (всегда 1) больше не нужна
+            self.conn.execute("ALTER TABLE eggs DROP COLUMN detail")
+        if 'hatched_at_list' not in columns:
+            self.conn.execute("ALTER TABLE eggs ADD COLUMN hatched_at_list TEXT")
+        self.conn.commit()
+        # Хранилище, из которого данные переносятся при первом запуске
+        self.legacy_storage = legacy_storage
+
+    def _meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def load(self, timer=None):
+        """Читает состояние из базы (при первом запуске переносит данные из JSON)"""
+        timer = timer or PhaseTimer('Load')
+        logger.info(f"Loading data from SQLite: {self.db_file}")
+        if self._meta('initialized') is None:
+            with timer.phase('migrate'):
+                self._migrate()
+
+        state = default_state()
+        cur = self.conn.cursor()
+        with timer.phase('eggs'):
+            self._load_eggs(cur, state['eggs'])
+        with timer.phase('users'):
+            self._load_users(cur, state['users'])
+        with timer.phase('payments'):
+            self._load_payments(cur, state['ton_payments'])
+
+        users = state['users']
+        logger.info(
+            f"Loaded data from SQLite: {users.count_with('points')} users with points, "
+            f"{users.count_with('referrer')} referrers, {len(state['eggs'])} eggs"
+        )
+        return state
+
+    def _load_eggs(self, cur, eggs):
+        eggs.bulk_load()
+        for row in cur.execute(f"SELECT {EGG_COLUMNS} FROM eggs"):
+            eggs.import_dict(row[0], _egg_from_row(row), hatched=row[6] == 'hatched')
+        eggs.sort_indexes()
+
+    def _load_users(self, cur, users):
+        for user_id, eggs_hatched, hatched_by_others, eggs_sent, username in cur.execute(
+            "SELECT user_id, eggs_hatched, eggs_hatched_by_others, eggs_sent, username FROM users "
+            "WHERE eggs_hatched IS NOT NULL OR eggs_hatched_by_others IS NOT NULL OR eggs_sent IS NOT NULL "
+            "OR username IS NOT NULL"
+        ):
+            record = users.record(user_id)
+            record.eggs_hatched = eggs_hatched or 0
+            record.hatched_by_others = hatched_by_others or 0
+            record.eggs_sent = eggs_sent or 0
+            if username:
+                users.set_username(user_id, username)
+        for user_id, points, referral_earnings in cur.execute("SELECT user_id, points, referral_earnings FROM points"):
+            record = users.record(user_id)
+            record.points = points or 0
+            record.referral_earnings = referral_earnings or 0
+        for user_id, referrer_id in cur.execute("SELECT user_id, referrer_id FROM referrals"):
+            users.set_referrer(user_id, referrer_id)
+        for user_id, day, count, paid_eggs in cur.execute("SELECT user_id, date, count, paid_eggs FROM daily_quotas"):
+            record = users.record(user_id)
+            record.daily_date, record.daily_count, record.paid_eggs = day, count, paid_eggs
+        for user_id, task in cur.execute("SELECT user_id, task FROM tasks"):
+            users.record(user_id).tasks |= tasks_to_flags({task: True})
+
+    def _load_payments(self, cur, ton_payments):
+        for user_id, tx_hash, day, amount, egg_count in cur.execute(
+            "SELECT user_id, tx_hash, date, amount, eggs FROM payments ORDER BY id"
+        ):
+            ton_payments.setdefault(user_id, []).append(
+                {'date': day, 'amount': amount, 'tx_hash': tx_hash, 'eggs': egg_count}
+            )
+
+    def _migrate(self):
+        """Переносит данные из JSON хранилища при первом запуске"""
+        if self.legacy_storage is not None:
+            state = self.legacy_storage.load()
+            with self.conn:
+                cur = self.conn.cursor()
+                for name in COLLECTIONS:
+                    for key, value in collection_items(state[name]):
+                        self._write(cur, name, key, value)
+            logger.info(f"Migrated {len(state['eggs'])} eggs and {len(state['users'])} users into {self.db_file}")
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES('initialized', ?)", (str(int(time.time())),))
+
+    def wants_snapshot(self, force=False):
+        # Снимков нет: каждая пачка мутаций - своя транзакция, и при остановке тоже
+        return False
+
+    def write_warm_snapshot(self, sections, journal_seq):
+        # Состояние читается из базы, бинарный снимок не используется
+        pass
+
+    def write_entries(self, entries):
+        """Применяет пачку записей мутаций в одной транзакции"""
+        if not entries:
+            return
+        with self.conn:
+            cur = self.conn.cursor()
+            for entry in entries:
+                for name in entry.get('c', ()):
+                    self._clear(cur, name)
+                for name, key, value in entry.get('s', ()):
+                    self._write(cur, name, key, value)
+
+    def _write(self, cur, name, key, value):
+        """Записывает один элемент коллекции (value None - удаление)"""
+        if name == 'eggs':
+            if value is None:
+                cur.execute("DELETE FROM eggs WHERE egg_key = ?", (key,))
+                return
+            cur.execute(
+                "INSERT OR REPLACE INTO eggs(egg_key, egg_id, sender_id, hatched_by, timestamp_sent, timestamp_hatched, "
+                "status, is_multi, max_hatches, hatched_count, hatched_by_list, hatched_at_list) "
+                "VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key, value.get('egg_id'), value.get('sender_id'), value.get('hatched_by'),
+                    value.get('timestamp_sent'), value.get('timestamp_hatched'),
+                    'hatched' if value.get('hatched') else 'pending', int(bool(value.get('is_multi'))),
+                    value.get('max_hatches', 1), value.get('hatched_count', 0),
+                    json.dumps(value.get('hatched_by_list') or []),
+                    json.dumps(value.get('hatched_at_list') or [])
+                )
+            )
+        elif name == 'users':
+            self._write_user(cur, key, value)
+        elif name == 'referrers':
+            if value is None:
+                cur.execute("DELETE FROM referrals WHERE user_id = ?", (key,))
+            else:
+                cur.execute("INSERT OR REPLACE INTO referrals(user_id, referrer_id) VALUES(?, ?)", (key, value))
+        elif name == 'daily_eggs_sent':
+            if value is None:
+                cur.execute("DELETE FROM daily_quotas WHERE user_id = ?", (key,))
+            else:
+                cur.execute(
+                    "INSERT OR REPLACE INTO daily_quotas(user_id, date, count, paid_eggs) VALUES(?, ?, ?, ?)",
+                    (key, value.get('date'), value.get('count', 0), value.get('paid_eggs', 0))
+                )
+        elif name == 'completed_tasks':
+            cur.execute("DELETE FROM tasks WHERE user_id = ?", (key,))
+            for task, done in (value or {}).items():
+                if done:
+                    cur.execute("INSERT INTO tasks(user_id, task) VALUES(?, ?)", (key, task))
+        elif name == 'ton_payments':
+            cur.execute("DELETE FROM payments WHERE user_id = ?", (key,))
+            for payment in value or []:
+                cur.execute(
+                    "INSERT INTO payments(user_id, tx_hash, date, amount, eggs) VALUES(?, ?, ?, ?, ?)",
+                    (key, payment.get('tx_hash'), payment.get('date'), payment.get('amount'), payment.get('eggs'))
+                )
+
+    def _write_user(self, cur, user_id, row):
+        """Раскладывает строку пользователя по таблицам users, points, referrals, daily_quotas и tasks"""
+        if row is None:
+            cur.execute(
+                "UPDATE users SET eggs_hatched = NULL, eggs_hatched_by_others = NULL, eggs_sent = NULL, username = NULL "
+                "WHERE user_id = ?",
+                (user_id,)
+            )
+            for table in ('points', 'referrals', 'daily_quotas', 'tasks'):
+                cur.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+            return
+        # Строки журнала до появления username короче USER_FIELDS
+        row = list(row) + [None] * (len(USER_FIELDS) - len(row))
+        eggs_hatched, hatched_by_others, eggs_sent, points, referral_earnings, referrer, tasks, day, count, paid_eggs, username = row
+        cur.execute(
+            "INSERT INTO users(user_id, eggs_hatched, eggs_hatched_by_others, eggs_sent, username) VALUES(?, ?, ?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET eggs_hatched = excluded.eggs_hatched, "
+            "eggs_hatched_by_others = excluded.eggs_hatched_by_others, eggs_sent = excluded.eggs_sent, "
+            "username = excluded.username",
+            (user_id, eggs_hatched, hatched_by_others, eggs_sent, username)
+        )
+        cur.execute(
+            "INSERT OR REPLACE INTO points(user_id, points, referral_earnings) VALUES(?, ?, ?)",
+            (user_id, points, referral_earnings)
+        )
+        self._write(cur, 'referrers', user_id, referrer)
+        daily = {'date': day, 'count': count, 'paid_eggs': paid_eggs} if day is not None or paid_eggs else None
+        self._write(cur, 'daily_eggs_sent', user_id, daily)
+        self._write(cur, 'completed_tasks', user_id, flags_to_tasks(tasks))
+
+    def _clear(self, cur, name):
+        """Очищает коллекцию целиком"""
+        if name == 'users':
+            cur.execute("UPDATE users SET eggs_hatched = NULL, eggs_hatched_by_others = NULL, eggs_sent = NULL, username = NULL")
+            for table in ('points', 'referrals', 'daily_quotas', 'tasks'):
+                cur.execute(f"DELETE FROM {table}")
+        elif name in SQLITE_COLUMNS:
+            table, column = SQLITE_COLUMNS[name]
+            cur.execute(f"UPDATE {table} SET {column} = NULL")
+        elif name == 'eggs':
+            cur.execute("DELETE FROM eggs")
+        elif name == 'hatched_eggs':
+            # Прежняя коллекция hatched_eggs - признак вылупления обычных яиц
+            cur.execute("UPDATE eggs SET status = 'pending'")
+        elif name == 'referrers':
+            cur.execute("DELETE FROM referrals")
+        elif name == 'daily_eggs_sent':
+            cur.execute("DELETE FROM daily_quotas")
+        elif name == 'completed_tasks':
+            cur.execute("DELETE FROM tasks")
+        elif name == 'ton_payments':
+            cur.execute("DELETE FROM payments")
+
+    def close(self):
+        self.conn.close()
+
+
+def read_sqlite_eggs(db_file):
+    """Читает яйца из базы для Eggchain Explorer (отдельное соединение только для чтения)"""
+    conn = _connect_sqlite(db_file, readonly=True)
+    try:
+        eggs_detail = {}
+        hatched_eggs = []
+        for row in conn.execute(f"SELECT {EGG_COLUMNS} FROM eggs"):
+            if row[6] == 'hatched':
+                hatched_eggs.append(row[0])
+            eggs_detail[row[0]] = _egg_from_row(row)
+        return {'eggs_detail': eggs_detail, 'hatched_eggs': hatched_eggs}
+    finally:
+        conn.close()
+
+
+def open_storage(backend, data_file, db_file, snapshot_interval=6 * 3600, journal_max_bytes=8 * 1024 * 1024, warm_snapshot=True,
+                 snapshot_format='json', shard_dir=None, shard_buckets=16):
+    """Создает хранилище по имени бэкенда"""
+    json_storage = JsonStorage(
+        data_file, snapshot_interval=snapshot_interval, journal_max_bytes=journal_max_bytes,
+        warm_snapshot=warm_snapshot and backend not in ('sqlite', 'sharded'), snapshot_format=snapshot_format
+    )
+    if backend == 'sqlite':
+        return SqliteStorage(db_file, legacy_storage=json_storage)
+    if backend == 'sharded':
+        return ShardedStorage(
+            shard_dir or data_file + '.shards', buckets=shard_buckets, snapshot_interval=snapshot_interval,
+            journal_max_bytes=journal_max_bytes, snapshot_format=snapshot_format, legacy_storage=json_storage
+        )
+    if backend != 'json':
+        logger.warning(f"Unknown STORAGE_BACKEND '{backend}', using json")
+    return json_storage
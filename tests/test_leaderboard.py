@@ -0,0 +1,31 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from leaderboard import RankIndex, rank_key, split_rank_key  # noqa: E402
+from user_store import UserStore  # noqa: E402
+
+LARGE_ID = (1 << 52) - 1
+
+
+def test_large_user_id_round_trip():
+    for points in (0, 1, 100, -5):
+        assert split_rank_key(rank_key(LARGE_ID, points)) == (LARGE_ID, points)
+
+
+def test_large_user_id_ordering():
+    index = RankIndex([rank_key(LARGE_ID, 10), rank_key(1, 11), rank_key(2, 10), rank_key(LARGE_ID - 1, 9)])
+    assert [split_rank_key(key) for key in index.slice(0, 10)] == [
+        (1, 11), (2, 10), (LARGE_ID, 10), (LARGE_ID - 1, 9)
+    ]
+
+
+def test_leaderboard_with_large_user_id():
+    store = UserStore()
+    store.record(LARGE_ID).points = 5
+    store.record(100).points = 7
+    store.build_leaderboard()
+    store.add_points(LARGE_ID, 3)
+    assert store.leaderboard(10) == [(LARGE_ID, 8), (100, 7)]
+    assert store.points_rank(LARGE_ID) == 1
@@ -0,0 +1,499 @@
+"""
+Таблица пользователей бота
+Вместо восьми параллельных словарей (eggs_hatched_by_user, egg_points, referrers, ...)
+на каждого пользователя одна запись UserRecord с __slots__. Выполненные задания
+хранятся битовыми флагами, в снимке таблица пишется как столбцы + строки.
+Справочник username -> user_id (без учета регистра) строится по username из записей,
+обратный индекс реферер -> рефералы - по полю referrer. Рейтинг по поинтам и
+многоуровневые показатели рефералов (downline.py) строятся при первом запросе и
+дальше обновляются при каждом начислении (add_points) и смене реферера
+"""
+
+import threading
+
+from downline import DownlineIndex
+from leaderboard import RankIndex, rank_key, split_rank_key
+
+DOWNLINE_LEVELS = 3  # Уровней рефералов по умолчанию
+
+# Битовые флаги заданий (имена совпадают с ключами completed_tasks в API)
+TASK_FLAGS = {
+    'send_100_eggs': 1,
+    'hatch_333_eggs': 2,
+    'subscribed_to_hatch_egg': 4
+}
+
+# Поля записи в порядке столбцов снимка и журнала
+USER_FIELDS = (
+    'eggs_hatched', 'hatched_by_others', 'eggs_sent', 'points', 'referral_earnings',
+    'referrer', 'tasks', 'daily_date', 'daily_count', 'paid_eggs', 'username'
+)
+
+# Прежние коллекции -> поле записи (журналы до UserStore и сброс отдельных счетчиков)
+LEGACY_FIELDS = {
+    'eggs_hatched_by_user': 'eggs_hatched',
+    'user_eggs_hatched_by_others': 'hatched_by_others',
+    'eggs_sent_by_user': 'eggs_sent',
+    'egg_points': 'points',
+    'referral_earnings': 'referral_earnings',
+    'referrers': 'referrer'
+}
+
+
+def tasks_to_flags(tasks):
+    """{'send_100_eggs': True, ...} -> битовые флаги"""
+    flags = 0
+    for name, done in (tasks or {}).items():
+        if done and name in TASK_FLAGS:
+            flags |= TASK_FLAGS[name]
+    return flags
+
+
+def flags_to_tasks(flags):
+    """Битовые флаги -> {'send_100_eggs': True, ...}"""
+    return {name: True for name, bit in TASK_FLAGS.items() if flags & bit}
+
+
+class UserRecord:
+    """Все счетчики одного пользователя"""
+
+    __slots__ = USER_FIELDS
+
+    def __init__(self, eggs_hatched=0, hatched_by_others=0, eggs_sent=0, points=0, referral_earnings=0,
+                 referrer=None, tasks=0, daily_date=None, daily_count=0, paid_eggs=0, username=None):
+        self.eggs_hatched = eggs_hatched  # Сколько яиц вылупил пользователь (hatched_by_me)
+        self.hatched_by_others = hatched_by_others  # Сколько его яиц вылупили другие (my_eggs_hatched)
+        self.eggs_sent = eggs_sent
+        self.points = points
+        self.referral_earnings = referral_earnings  # Сколько заработал на рефералах
+        self.referrer = referrer  # Кто привел пользователя
+        self.tasks = tasks  # Битовые флаги TASK_FLAGS
+        self.daily_date = daily_date  # День (ISO), к которому относится daily_count
+        self.daily_count = daily_count
+        self.paid_eggs = paid_eggs
+        self.username = username  # Последний известный username из обновлений Telegram
+
+    def has_task(self, name):
+        return bool(self.tasks & TASK_FLAGS[name])
+
+    def complete_task(self, name):
+        self.tasks |= TASK_FLAGS[name]
+
+    def to_row(self):
+        return [getattr(self, field) for field in USER_FIELDS]
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*row)
+
+
+# Запись для чтения несуществующего пользователя - не изменять
+EMPTY_USER = UserRecord()
+
+
+class UserStore:
+    """Все пользователи бота: user_id -> UserRecord"""
+
+    def __init__(self):
+        self._records = {}
+        self._by_username = {}  # username в нижнем регистре -> user_id
+        self._by_referrer = {}  # referrer_id -> user_id (один реферал) или множество user_id
+        self._points_rank = None  # RankIndex пользователей с поинтами (None - еще не построен)
+        self._rank_lock = threading.Lock()  # Рейтинг читается из потока API
+        self._downline = None  # DownlineIndex (None - еще не построен)
+        self._downline_levels = DOWNLINE_LEVELS
+        self._downline_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, user_id):
+        return user_id in self._records
+
+    def __iter__(self):
+        return iter(list(self._records))
+
+    def get(self, user_id, default=None):
+        return self._records.get(user_id, default)
+
+    def record(self, user_id):
+        """Запись пользователя (создается при первом изменении)"""
+        record = self._records.get(user_id)
+        if record is None:
+            record = self._records[user_id] = UserRecord()
+        return record
+
+    def items(self):
+        """Копия списка (user_id, UserRecord) - безопасно итерировать из другого потока"""
+        return list(self._records.items())
+
+    def find_username(self, username):
+        """user_id по username (без учета регистра и @) или None"""
+        return self._by_username.get(username.lstrip('@').lower())
+
+    def set_username(self, user_id, username):
+        """Запоминает username пользователя из обновления.
+        Возвращает список user_id, чьи записи изменились (пустой - ничего не изменилось)"""
+        changed = []
+        if username:
+            holder = self._by_username.get(username.lower())
+            if holder is not None and holder != user_id:
+                # Username перешел к другому пользователю - у прежнего владельца он устарел
+                old = self._records.get(holder)
+                if old is not None and old.username and old.username.lower() == username.lower():
+                    old.username = None
+                    changed.append(holder)
+        record = self._records.get(user_id)
+        if record is None and not username:
+            return changed
+        record = self.record(user_id)
+        if record.username != username:
+            # Переименование: старое имя больше не ведет к пользователю
+            self._unindex_username(user_id, record)
+            record.username = username
+            changed.append(user_id)
+        if username:
+            self._by_username[username.lower()] = user_id
+        return changed
+
+    def _index_username(self, user_id, record):
+        if record.username:
+            self._by_username[record.username.lower()] = user_id
+
+    def _unindex_username(self, user_id, record):
+        if record is not None and record.username:
+            name = record.username.lower()
+            if self._by_username.get(name) == user_id:
+                del self._by_username[name]
+
+    def set_referrer(self, user_id, referrer_id):
+        """Назначает (или снимает при None) реферера пользователя"""
+        record = self.record(user_id)
+        if record.referrer != referrer_id:
+            with self._downline_lock:
+                downline = self._downline
+                if downline is not None and record.referrer is not None:
+                    downline.unlink(user_id)
+                self._unindex_referrer(user_id, record)
+                record.referrer = referrer_id
+                self._index_referrer(user_id, record)
+                if downline is not None and referrer_id is not None:
+                    downline.link(user_id)
+        return record
+
+    def referral_count(self, referrer_id):
+        """Сколько пользователей привел referrer_id"""
+        referrals = self._by_referrer.get(referrer_id)
+        if referrals is None:
+            return 0
+        return len(referrals) if isinstance(referrals, set) else 1
+
+    def referrals(self, referrer_id):
+        """user_id рефералов referrer_id"""
+        referrals = self._by_referrer.get(referrer_id)
+        if referrals is None:
+            return []
+        return list(referrals) if isinstance(referrals, set) else [referrals]
+
+    # --- Рейтинг по поинтам ---
+
+    def add_points(self, user_id, amount):
+        """Начисляет поинты и обновляет рейтинг"""
+        record = self.record(user_id)
+        return self.set_points(user_id, record.points + amount)
+
+    def set_points(self, user_id, points):
+        record = self.record(user_id)
+        with self._downline_lock:
+            with self._rank_lock:
+                old = record.points
+                record.points = points
+                if self._points_rank is not None:
+                    self._rerank(user_id, old, points)
+            if self._downline is not None:
+                self._downline.points_changed(user_id, points - old)
+        return record
+
+    def _rerank(self, user_id, old, new):
+        if old == new:
+            return
+        if old:
+            self._points_rank.discard(rank_key(user_id, old))
+        if new:
+            self._points_rank.add(rank_key(user_id, new))
+
+    def _ranked(self):
+        # Вызывается под _rank_lock
+        if self._points_rank is None:
+            self._points_rank = RankIndex(
+                rank_key(user_id, record.points) for user_id, record in self.items() if record.points
+            )
+        return self._points_rank
+
+    def _drop_rank(self):
+        """Массовое изменение поинтов - рейтинг будет построен заново при запросе"""
+        with self._rank_lock:
+            self._points_rank = None
+
+    def build_leaderboard(self):
+        """Строит рейтинг заранее (при запуске), чтобы первый запрос API не ждал построения"""
+        with self._rank_lock:
+            return len(self._ranked())
+
+    def leaderboard(self, limit, offset=0):
+        """Страница рейтинга: [(user_id, points), ...] от лидера"""
+        with self._rank_lock:
+            return [split_rank_key(key) for key in self._ranked().slice(offset, limit)]
+
+    def points_rank(self, user_id):
+        """Место пользователя в рейтинге (с 1) или None, если поинтов нет"""
+        with self._rank_lock:
+            record = self._records.get(user_id)
+            if record is None or not record.points:
+                return None
+            return self._ranked().position(rank_key(user_id, record.points)) + 1
+
+    def ranked_count(self):
+        """Сколько пользователей в рейтинге"""
+        with self._rank_lock:
+            return len(self._ranked())
+
+    # --- Рефералы по уровням ---
+
+    def _referrer_of(self, user_id):
+        record = self._records.get(user_id)
+        return record.referrer if record is not None else None
+
+    def _points_of(self, user_id):
+        record = self._records.get(user_id)
+        return record.points if record is not None else 0
+
+    def _downlines(self):
+        # Вызывается под _downline_lock
+        if self._downline is None:
+            self._downline = DownlineIndex(self._downline_levels, self._referrer_of, self._points_of)
+            self._downline.build(list(self._records))
+        return self._downline
+
+    def _drop_downline(self):
+        """Массовое изменение рефереров или поинтов - показатели будут построены заново при запросе"""
+        with self._downline_lock:
+            self._downline = None
+
+    def build_downline(self, levels=None):
+        """Строит показатели рефералов заранее (при запуске); levels - число уровней"""
+        with self._downline_lock:
+            if levels is not None and levels != self._downline_levels:
+                self._downline_levels = levels
+                self._downline = None
+            return len(self._downlines())
+
+    def downline(self, user_id):
+        """(рефералов на уровнях 1..k, их поинтов на уровнях 1..k)"""
+        with self._downline_lock:
+            return self._downlines().get(user_id)
+
+    def _index_referrer(self, user_id, record):
+        referrer_id = record.referrer
+        if referrer_id is None:
+            return
+        referrals = self._by_referrer.get(referrer_id)
+        if referrals is None:
+            self._by_referrer[referrer_id] = user_id
+        elif isinstance(referrals, set):
+            referrals.add(user_id)
+        elif referrals != user_id:
+            self._by_referrer[referrer_id] = {referrals, user_id}
+
+    def _unindex_referrer(self, user_id, record):
+        if record is None or record.referrer is None:
+            return
+        referrals = self._by_referrer.get(record.referrer)
+        if referrals is None:
+            return
+        if isinstance(referrals, set):
+            referrals.discard(user_id)
+            if len(referrals) == 1:
+                self._by_referrer[record.referrer] = next(iter(referrals))
+        elif referrals == user_id:
+            del self._by_referrer[record.referrer]
+
+    def count_with(self, field):
+        """Сколько пользователей имеют ненулевое значение поля"""
+        return sum(1 for record in list(self._records.values()) if getattr(record, field))
+
+    def clear(self):
+        self._records.clear()
+        self._by_username.clear()
+        self._by_referrer.clear()
+        self._drop_rank()
+        self._drop_downline()
+
+    def reset_counters(self):
+        """Обнуляет все счетчики, сохраняя только рефереров и username"""
+        for user_id, record in self.items():
+            if record.referrer is None and record.username is None:
+                del self._records[user_id]
+            else:
+                self._records[user_id] = UserRecord(referrer=record.referrer, username=record.username)
+        self._drop_rank()
+        self._drop_downline()
+
+    def clear_field(self, field):
+        """Сбрасывает одно поле у всех пользователей"""
+        default = getattr(EMPTY_USER, field)
+        for record in list(self._records.values()):
+            setattr(record, field, default)
+        if field == 'referrer':
+            self._by_referrer.clear()
+            self._drop_downline()
+        elif field == 'points':
+            self._drop_rank()
+            self._drop_downline()
+
+    # --- Журнал и снимок ---
+
+    def to_row(self, user_id):
+        """Строка пользователя для журнала или None"""
+        record = self._records.get(user_id)
+        return record.to_row() if record is not None else None
+
+    def __setitem__(self, user_id, row):
+        # Применение записи журнала: row - строка формата to_row()
+        user_id = int(user_id)
+        record = UserRecord.from_row(row)
+        old = self._records.get(user_id)
+        self._unindex_username(user_id, old)
+        self._unindex_referrer(user_id, old)
+        with self._downline_lock:
+            downline = self._downline
+            if downline is not None and old is not None and old.referrer is not None:
+                downline.unlink(user_id)
+            with self._rank_lock:
+                self._records[user_id] = record
+                if self._points_rank is not None:
+                    self._rerank(user_id, old.points if old is not None else 0, record.points)
+            # Без реферера поинты пользователя не входят ни в чьи уровни
+            if downline is not None and record.referrer is not None:
+                downline.link(user_id)
+        self._index_username(user_id, record)
+        self._index_referrer(user_id, record)
+
+    def pop(self, user_id, default=None):
+        old = self._records.get(user_id)
+        self._unindex_username(user_id, old)
+        self._unindex_referrer(user_id, old)
+        with self._downline_lock:
+            if self._downline is not None and old is not None and old.referrer is not None:
+                self._downline.unlink(user_id)
+            with self._rank_lock:
+                if old is not None and self._points_rank is not None:
+                    self._rerank(user_id, old.points, 0)
+                return self._records.pop(user_id, default)
+
+    def to_table(self, user_ids=None):
+        """Компактная таблица для снимка: {'columns': [...], 'rows': [[user_id, ...], ...]}.
+        user_ids - только эти пользователи (шард хранилища)"""
+        if user_ids is None:
+            items = self.items()
+        else:
+            items = [(user_id, self._records[user_id]) for user_id in user_ids if user_id in self._records]
+        return {
+            'columns': list(USER_FIELDS),
+            'rows': [[user_id] + record.to_row() for user_id, record in items]
+        }
+
+    @classmethod
+    def from_table(cls, table):
+        store = cls()
+        store.load_table(table)
+        return store
+
+    def load_table(self, table):
+        """Добавляет пользователей из таблицы to_table() (шарды загружаются по очереди)"""
+        columns = table.get('columns', USER_FIELDS)
+        for row in table.get('rows', ()):
+            user_id = int(row[0])
+            self._unindex_referrer(user_id, self._records.get(user_id))
+            record = self._records[user_id] = UserRecord(**dict(zip(columns, row[1:])))
+            self._index_username(user_id, record)
+            self._index_referrer(user_id, record)
+        self._drop_rank()
+        self._drop_downline()
+
+    @classmethod
+    def from_legacy(cls, data, on_invalid=None):
+        """Строит таблицу из прежних словарей снимка (ключи - строки user_id)"""
+        store = cls()
+        for name, field in LEGACY_FIELDS.items():
+            for key, value in data.get(name, {}).items():
+                try:
+                    if field == 'referrer':
+                        store.set_referrer(int(key), int(value))
+                    else:
+                        setattr(store.record(int(key)), field, int(value))
+                except (ValueError, TypeError):
+                    if on_invalid:
+                        on_invalid(name, key, value)
+        for key, value in data.get('daily_eggs_sent', {}).items():
+            try:
+                _apply_daily(store.record(int(key)), value)
+            except (ValueError, TypeError):
+                if on_invalid:
+                    on_invalid('daily_eggs_sent', key, value)
+        for key, value in data.get('completed_tasks', {}).items():
+            try:
+                store.record(int(key)).tasks = tasks_to_flags(value)
+            except (ValueError, TypeError):
+                if on_invalid:
+                    on_invalid('completed_tasks', key, value)
+        return store
+
+
+def _apply_daily(record, value):
+    value = value or {}
+    record.daily_date = value.get('date')
+    record.daily_count = value.get('count', 0)
+    record.paid_eggs = value.get('paid_eggs', 0)
+
+
+class _LegacyField:
+    """Применяет записи журнала прежней коллекции-счетчика к UserStore"""
+
+    def __init__(self, store, field):
+        self.store = store
+        self.field = field
+
+    def __setitem__(self, user_id, value):
+        record = self.store.record(int(user_id))
+        if self.field == 'daily':
+            _apply_daily(record, value)
+        elif self.field == 'referrer':
+            self.store.set_referrer(int(user_id), value)
+        elif self.field == 'points':
+            self.store.set_points(int(user_id), value)
+        elif self.field == 'tasks':
+            record.tasks = tasks_to_flags(value)
+        else:
+            setattr(record, self.field, value)
+
+    def pop(self, user_id, default=None):
+        record = self.store.get(int(user_id))
+        if record is not None:
+            self.__setitem__(user_id, None if self.field in ('daily', 'tasks', 'referrer') else 0)
+        return default
+
+    def clear(self):
+        if self.field == 'daily':
+            for field in ('daily_date', 'daily_count', 'paid_eggs'):
+                self.store.clear_field(field)
+        else:
+            self.store.clear_field(self.field)
+
+
+def legacy_collections(store):
+    """Коллекции прежнего формата поверх UserStore - для журналов и сбросов по отдельным счетчикам"""
+    collections = {name: _LegacyField(store, field) for name, field in LEGACY_FIELDS.items()}
+    collections['daily_eggs_sent'] = _LegacyField(store, 'daily')
+    collections['completed_tasks'] = _LegacyField(store, 'tasks')
+    return collections